@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''Compare the speed of the colorizer engines on the example captures
+
+With --styles each capture is colorized in every style from one analysis
+the same way as the --styles option of colorize_lecroy.py.
+'''
+
+from __future__ import print_function
+
+import sys
+import os
+import timeit
+from optparse import OptionParser
+
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+script_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, script_dir)
+
+import colorize_lecroy as cl
+from PIL import ImageChops
+
+
+def main():
+    parser = OptionParser(usage='%prog [-s settings | --styles=style,...] [-n repeat] [-r]')
+    parser.add_option('-s', dest='setting_file', help='style file')
+    parser.add_option('--styles', dest='styles', help='comma separated list of styles to render together')
+    parser.add_option('-n', dest='repeat', type='int', default=10, help='number of timing runs [10]')
+    parser.add_option('-r', dest='no_reconstruct', action='store_true', default=False,
+        help='disable trace reconstruction')
+    options, args = parser.parse_args()
+
+    if options.styles is not None:
+        style_dir, color_styles = cl.find_styles(script_dir)
+        setting_files = [cl.resolve_style(s.strip(), style_dir, color_styles) for s in options.styles.split(',')]
+    else:
+        setting_files = [options.setting_file]
+    settings = [cl.ColorizerSettings(setting_file=f, \
+        defaults_file=os.path.join(script_dir, 'data', 'default_settings.cfg'), script_dir=script_dir) \
+        for f in setting_files]
+    example_dir = os.path.join(script_dir, 'examples')
+    examples = sorted(os.path.join(example_dir, f) for f in os.listdir(example_dir) if f.endswith('.bmp'))
+
+    colorizers = [(e, [cl.LecroyColorizer(s, e) for s in settings]) for e in cl.ENGINES]
+
+    print('Best of {0} runs per capture (ms), {1} style(s)\n'.format(options.repeat, len(settings)))
+    print('{0:<28}'.format('capture') + ''.join('{0:>12}'.format(e) for e, _ in colorizers) + '   identical')
+
+    totals = dict((e, 0.0) for e, _ in colorizers)
+    for f in examples:
+        outputs = []
+        row = '{0:<28}'.format(os.path.basename(f))
+        for e, cs in colorizers:
+            # Warm up the layer cache
+            outputs.extend(r.image for r in cl.colorize_styles(cs, f, options.no_reconstruct))
+            t = min(timeit.repeat(lambda: cl.colorize_styles(cs, f, options.no_reconstruct), number=1, \
+                repeat=options.repeat))
+            totals[e] += t
+            row += '{0:12.2f}'.format(t * 1000.0)
+
+        n = len(settings)
+        same = all(ImageChops.difference(outputs[i % n], o).getbbox() is None for i, o in enumerate(outputs))
+        print(row + '   ' + ('yes' if same else 'NO'))
+
+    print('{0:<28}'.format('total') + ''.join('{0:12.2f}'.format(totals[e] * 1000.0) for e, _ in colorizers))
+    base = totals[colorizers[0][0]]
+    print('{0:<28}'.format('speedup') + ''.join('{0:11.2f}x'.format(base / totals[e]) for e, _ in colorizers))
+
+
+if __name__ == '__main__':
+    main()
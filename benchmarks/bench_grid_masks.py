@@ -0,0 +1,66 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''Compare the cost of loading the grid masks from PNG files and from the
+precompiled mask bundle
+
+The bundle is compiled into a temporary directory with copies of the grid
+images so that the data directory is left untouched.
+'''
+
+from __future__ import print_function
+
+import sys
+import os
+import shutil
+import tempfile
+import timeit
+
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+script_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, script_dir)
+
+import colorize_lecroy as cl
+from PIL import Image
+
+
+def main():
+    data_dir = os.path.join(script_dir, 'data')
+    settings = cl.ColorizerSettings(defaults_file=os.path.join(data_dir, 'default_settings.cfg'), \
+        script_dir=script_dir)
+    names = sorted(g[cl.GRID_IMAGE] for g in settings.grids.values())
+
+    bundle_dir = tempfile.mkdtemp(prefix='grid_masks_')
+    try:
+        # The bundle entries are checked against the size and mtime of their sources
+        for n in names:
+            shutil.copy2(os.path.join(data_dir, n), os.path.join(bundle_dir, n))
+        print('Compiling grid mask bundle')
+        cl.GridMaskBundle(bundle_dir).compile(names)
+
+        def png_decode():
+            for n in names:
+                Image.open(os.path.join(data_dir, n)).convert('RGB').convert('1')
+
+        def bundle_cold():
+            b = cl.GridMaskBundle(bundle_dir)
+            for n in names:
+                b.get(n)
+
+        warm = cl.GridMaskBundle(bundle_dir)
+        def bundle_warm():
+            for n in names:
+                warm.get(n)
+
+        repeat = 20
+        print('Loading {0} grid masks, best of {1} runs'.format(len(names), repeat))
+        for label, fn in [('PNG decode', png_decode), ('bundle (cold, mmap)', bundle_cold), \
+            ('bundle (warm)', bundle_warm)]:
+            t = min(timeit.repeat(fn, number=1, repeat=repeat))
+            print('  {0:<22} {1:8.3f} ms  ({2:.3f} ms/mask)'.format(label, t * 1000.0, t * 1000.0 / len(names)))
+    finally:
+        shutil.rmtree(bundle_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
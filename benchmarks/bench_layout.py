@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''Measure how the colorizer throughput scales with the capture size
+
+Synthetic captures for the larger layout profiles are made by enlarging the
+example captures. Each one must colorize to the enlarged output of the
+original capture. The time per capture is reported along with how it grows
+relative to the number of pixels, which should be close to 1.0 for linear
+scaling.
+
+  bench_layout.py [-n repeat] [-s settings] [--engine=...] [--recon-backend=...] [-o results.json]
+'''
+
+from __future__ import print_function
+
+import sys
+import os
+import io
+import json
+import timeit
+from optparse import OptionParser
+
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+script_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, script_dir)
+
+import colorize_lecroy as cl
+from PIL import Image, ImageChops
+
+
+def enlarge(in_file, scale):
+    '''Make a synthetic BMP capture enlarged by a whole number scale'''
+    im = Image.open(in_file).convert('1')
+    if scale != 1:
+        im = im.resize((im.size[0] * scale, im.size[1] * scale), Image.NEAREST)
+    buf = io.BytesIO()
+    im.save(buf, 'BMP')
+    return buf.getvalue()
+
+
+def time_captures(colorizer, captures, repeat):
+    '''Best time in milliseconds to colorize and encode all of the captures'''
+    def run():
+        for data in captures:
+            colorizer.render_to_file(colorizer.analyze(io.BytesIO(data)), io.BytesIO(), False, format='PNG')
+
+    run() # Warm up the layer cache
+    return min(timeit.repeat(run, number=1, repeat=repeat)) * 1000.0
+
+
+def main():
+    parser = OptionParser(usage='%prog [-n repeat] [-s settings] [--engine=...] [-o results.json]')
+    parser.add_option('-n', dest='repeat', type='int', default=5, help='number of timing runs [5]')
+    parser.add_option('-s', dest='setting_file', help='style file')
+    parser.add_option('--engine', dest='engine', type='choice', choices=cl.ENGINES, default='composite',
+        help='rendering engine [composite]')
+    parser.add_option('--recon-backend', dest='recon_backend', type='choice', choices=cl.RECON_BACKENDS,
+        default='auto', help='trace reconstruction backend [auto]')
+    parser.add_option('-o', dest='out_file', help='save the results as JSON')
+    options, args = parser.parse_args()
+
+    settings = cl.load_settings(options.setting_file, script_dir, cache=False)
+    colorizer = cl.LecroyColorizer(settings, options.engine, options.recon_backend)
+    example_dir = os.path.join(script_dir, 'examples')
+    examples = sorted(os.path.join(example_dir, f) for f in os.listdir(example_dir) if f.endswith('.bmp'))
+
+    profiles = [('base', settings.image_size, 1)]
+    for name, (size, scale) in sorted(settings.layout_profiles.items(), key=lambda p: p[1][1]):
+        if scale != 1:
+            profiles.append((name, tuple(size), scale))
+
+    # The enlarged captures must match the enlarged output of the originals
+    for f in examples:
+        expected = colorizer.colorize(f, False).image.convert('RGB')
+        for name, size, scale in profiles[1:]:
+            im = colorizer.colorize(io.BytesIO(enlarge(f, scale)), False).image.convert('RGB')
+            if ImageChops.difference(im, expected.resize(size, Image.NEAREST)).getbbox() is not None:
+                print('error: {0} output differs for {1}'.format(name, f))
+                sys.exit(1)
+
+    print('{0} engine, {1} captures, best of {2} runs\n'.format(options.engine, len(examples), options.repeat))
+    print('{0:<12}{1:>12}{2:>14}{3:>14}{4:>10}'.format('profile', 'size', 'ms/capture', 'Mpixel/s', 'scaling'))
+
+    results = {}
+    base = None
+    for name, size, scale in profiles:
+        captures = [enlarge(f, scale) for f in examples]
+        ms = time_captures(colorizer, captures, options.repeat) / len(captures)
+        pixels = size[0] * size[1]
+        if base is None:
+            base = (ms, pixels)
+        # Growth in time over the growth in pixels
+        scaling = (ms / base[0]) / (float(pixels) / base[1])
+        results[name] = {'size': list(size), 'scale': scale, 'ms': ms, 'scaling': scaling}
+        print('{0:<12}{1:>12}{2:14.2f}{3:14.1f}{4:10.2f}'.format(name, '{0}x{1}'.format(*size), ms, \
+            pixels / ms / 1000.0, scaling))
+
+    if options.out_file is not None:
+        with open(options.out_file, 'w') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
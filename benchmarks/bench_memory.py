@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''Measure the peak memory used to colorize the example captures
+
+Each engine is run in a new interpreter that colorizes every example capture
+to a PNG file. The peak resident set size is reported along with the growth
+over the interpreter after the imports, which is the memory that each extra
+worker process costs for the colorizing itself.
+
+  bench_memory.py [-n repeat] [-s settings] [--indexed] [-o results.json]
+'''
+
+from __future__ import print_function
+
+import sys
+import os
+import json
+import shutil
+import subprocess
+import tempfile
+from optparse import OptionParser
+
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+script_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, script_dir)
+
+import colorize_lecroy as cl
+
+# Colorize the examples in a fresh interpreter and report the peak RSS in kB
+RSS_RUNNER = r'''
+import sys, os, json, resource
+sys.path.insert(0, sys.argv[1])
+import colorize_lecroy as cl
+from PIL import Image, ImageChops, ImageDraw, ImageColor, PngImagePlugin, BmpImagePlugin
+if cl._have_numpy():
+    cl.np._load()
+
+def peak_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+script_dir, out_dir, engine, recon_backend, setting_file, indexed, repeat = sys.argv[1:8]
+settings = cl.load_settings(setting_file or None, script_dir, cache=False)
+colorizer = cl.LecroyColorizer(settings, engine, recon_backend, indexed == '1')
+examples = sys.argv[8:]
+
+base = peak_kb()
+for _ in range(int(repeat)):
+    for f in examples:
+        out_file = os.path.join(out_dir, os.path.splitext(os.path.basename(f))[0] + '.png')
+        colorizer.render_to_file(colorizer.analyze(f), out_file, False)
+
+print(json.dumps({'base_kb': base, 'peak_kb': peak_kb()}))
+'''
+
+
+def measure(engine, recon_backend, setting_file, indexed, repeat, examples):
+    '''Peak RSS of a run in kB'''
+    out_dir = tempfile.mkdtemp()
+    try:
+        output = subprocess.check_output([sys.executable, '-c', RSS_RUNNER, script_dir, out_dir, engine, \
+            recon_backend, setting_file or '', '1' if indexed else '0', str(repeat)] + examples)
+    finally:
+        shutil.rmtree(out_dir)
+    return json.loads(output.decode('utf-8'))
+
+
+def main():
+    parser = OptionParser(usage='%prog [-n repeat] [-s settings] [--indexed] [-o results.json]')
+    parser.add_option('-n', dest='repeat', type='int', default=3, help='number of passes over the examples [3]')
+    parser.add_option('-s', dest='setting_file', help='style file')
+    parser.add_option('--indexed', dest='indexed', action='store_true', default=False,
+        help='write indexed PNG output')
+    parser.add_option('--recon-backend', dest='recon_backend', type='choice', choices=cl.RECON_BACKENDS,
+        default='auto', help='trace reconstruction backend for the full frame engines [auto]')
+    parser.add_option('-o', dest='out_file', help='save the results as JSON')
+    options, args = parser.parse_args()
+
+    example_dir = os.path.join(script_dir, 'examples')
+    examples = sorted(os.path.join(example_dir, f) for f in os.listdir(example_dir) if f.endswith('.bmp'))
+
+    print('Peak RSS for {0} captures, {1} passes\n'.format(len(examples), options.repeat))
+    print('{0:<12}{1:>12}{2:>12}{3:>12}'.format('engine', 'base (kB)', 'peak (kB)', 'growth (kB)'))
+
+    results = {}
+    for engine in cl.ENGINES:
+        r = measure(engine, options.recon_backend, options.setting_file, options.indexed, options.repeat, \
+            examples)
+        r['growth_kb'] = r['peak_kb'] - r['base_kb']
+        results[engine] = r
+        print('{0:<12}{1:12d}{2:12d}{3:12d}'.format(engine, r['base_kb'], r['peak_kb'], r['growth_kb']))
+
+    if options.out_file is not None:
+        with open(options.out_file, 'w') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
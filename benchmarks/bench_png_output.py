@@ -0,0 +1,75 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''Compare the size and encode time of RGB and indexed PNG output on the example captures'''
+
+from __future__ import print_function
+
+import sys
+import os
+import io
+import timeit
+from optparse import OptionParser
+
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+script_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, script_dir)
+
+import colorize_lecroy as cl
+from PIL import ImageChops
+
+
+def encode(im, save_options):
+    buf = io.BytesIO()
+    im.save(buf, 'PNG', **save_options)
+    return buf.getvalue()
+
+
+def main():
+    parser = OptionParser(usage='%prog [-s settings] [-n repeat]')
+    parser.add_option('-s', dest='setting_file', help='style file')
+    parser.add_option('-n', dest='repeat', type='int', default=5, help='number of timing runs [5]')
+    options, args = parser.parse_args()
+
+    settings = cl.ColorizerSettings(setting_file=options.setting_file, \
+        defaults_file=os.path.join(script_dir, 'data', 'default_settings.cfg'), script_dir=script_dir)
+    example_dir = os.path.join(script_dir, 'examples')
+    examples = sorted(os.path.join(example_dir, f) for f in os.listdir(example_dir) if f.endswith('.bmp'))
+
+    rgb_colorizer = cl.LecroyColorizer(settings)
+    indexed_colorizer = cl.LecroyColorizer(settings, indexed=True)
+
+    # Output modes: (name, indexed, save options)
+    modes = [('rgb', False, {})]
+    for level in (1, 6, 9):
+        for strategy in ('default', 'filtered', 'rle'):
+            modes.append(('indexed L{0} {1}'.format(level, strategy), True, \
+                cl.png_save_options(level, strategy)))
+
+    images = []
+    for f in examples:
+        rgb = rgb_colorizer.colorize(f, False).image
+        indexed = indexed_colorizer.colorize(f, False).image
+        if ImageChops.difference(rgb, indexed.convert('RGB')).getbbox() is not None:
+            print('error: Indexed output differs for {0}'.format(f))
+            sys.exit(1)
+        images.append((rgb, indexed))
+
+    print('Total for {0} captures, best of {1} runs\n'.format(len(images), options.repeat))
+    print('{0:<24}{1:>12}{2:>12}{3:>14}'.format('output', 'bytes', 'ratio', 'encode (ms)'))
+
+    base_size = None
+    for name, indexed, save_options in modes:
+        size = 0
+        elapsed = 0.0
+        for rgb, idx in images:
+            im = idx if indexed else rgb
+            size += len(encode(im, save_options))
+            elapsed += min(timeit.repeat(lambda: encode(im, save_options), number=1, repeat=options.repeat))
+        if base_size is None:
+            base_size = size
+        print('{0:<24}{1:12d}{2:11.2f}x{3:14.2f}'.format(name, size, float(size) / base_size, elapsed * 1000.0))
+
+
+if __name__ == '__main__':
+    main()
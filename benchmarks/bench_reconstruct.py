@@ -0,0 +1,62 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''Micro-benchmark for the trace reconstruction backends'''
+
+from __future__ import print_function
+
+import sys
+import os
+import timeit
+
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+script_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, script_dir)
+
+import colorize_lecroy as cl
+from PIL import Image, ImageChops
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    settings = cl.ColorizerSettings(defaults_file=os.path.join(script_dir, 'data', 'default_settings.cfg'), \
+        script_dir=script_dir)
+    example_dir = os.path.join(script_dir, 'examples')
+    examples = sorted(os.path.join(example_dir, f) for f in os.listdir(example_dir) if f.endswith('.bmp'))
+
+    backends = [b for b in cl.RECON_BACKENDS if b != 'auto']
+    if not cl._have_numpy():
+        print('NumPy is not installed. Only the Pillow backend is available.')
+        backends = ['pil']
+
+    colorizers = [(b, cl.LecroyColorizer(settings, recon_backend=b)) for b in backends]
+
+    print('Reconstruction mask, best of {0} runs per capture (ms)\n'.format(repeat))
+    print('{0:<28}'.format('capture') + ''.join('{0:>10}'.format(b) for b, _ in colorizers) + '   identical')
+
+    totals = dict((b, 0.0) for b, _ in colorizers)
+    for f in examples:
+        mim = Image.open(f).convert('RGB').convert('1')
+        grid_name = colorizers[0][1].identify_grid(mim)
+
+        masks = []
+        row = '{0:<28}'.format(os.path.basename(f))
+        for b, c in colorizers:
+            gr_mask = c._static_layers(grid_name).gr_mask
+            masks.append(c._reconstruction_mask(gr_mask, mim, grid_name))
+            t = min(timeit.repeat(lambda: c._reconstruction_mask(gr_mask, mim, grid_name), \
+                number=1, repeat=repeat))
+            totals[b] += t
+            row += '{0:10.3f}'.format(t * 1000.0)
+
+        same = all(ImageChops.difference(masks[0], m).getbbox() is None for m in masks[1:])
+        print(row + '   ' + ('yes' if same else 'NO'))
+
+    print('{0:<28}'.format('total') + ''.join('{0:10.3f}'.format(totals[b] * 1000.0) for b, _ in colorizers))
+    base = totals[colorizers[0][0]]
+    print('{0:<28}'.format('speedup') + ''.join('{0:9.2f}x'.format(base / totals[b]) for b, _ in colorizers))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''Measure the cold start time of the command line fast paths
+
+Each command is run in a new interpreter that imports the module and calls
+main() like the installed colorize_lecroy script, so the module is loaded
+from compiled bytecode. The median wall time is reported along with the
+slowest imports, measured like "python -X importtime" by timing every first
+import. Pillow and NumPy must not be loaded by these commands.
+
+The times can be compared with saved results or measured side by side with
+another copy of the colorizer, such as a checkout of the previous release.
+
+  bench_startup.py [-n repeat] [-o results.json] [--baseline=results.json] [--baseline-dir=dir]
+      [-t threshold]
+'''
+
+from __future__ import print_function
+
+import sys
+import os
+import json
+import shutil
+import subprocess
+import tempfile
+import timeit
+from optparse import OptionParser
+
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+script_dir = os.path.dirname(bench_dir)
+
+# Modules that the fast paths must not import
+HEAVY_MODULES = ('PIL', 'numpy')
+
+# Run the colorizer like the installed script
+ENTRY_POINT = r'''
+import sys
+sys.path.insert(0, sys.argv[1])
+sys.argv = ['colorize_lecroy'] + sys.argv[2:]
+import colorize_lecroy
+colorize_lecroy.main()
+'''
+
+# Run the colorizer in a fresh interpreter and report the time for each first import
+IMPORT_TIMER = r'''
+import sys, time, json
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+
+import_times = {}
+_import = builtins.__import__
+def timed_import(name, *args, **kwargs):
+    if name in sys.modules:
+        return _import(name, *args, **kwargs)
+    start = time.time()
+    try:
+        return _import(name, *args, **kwargs)
+    finally:
+        import_times.setdefault(name, (time.time() - start) * 1000.0)
+builtins.__import__ = timed_import
+
+report_file = sys.argv[1]
+sys.path.insert(0, sys.argv[2])
+sys.argv = ['colorize_lecroy'] + sys.argv[3:]
+try:
+    import colorize_lecroy
+    colorize_lecroy.main()
+except SystemExit:
+    pass
+
+with open(report_file, 'w') as fh:
+    json.dump({'imports': import_times, 'modules': sorted(sys.modules.keys())}, fh)
+'''
+
+
+def commands(tmp_dir):
+    return [
+        ('help', ['-h']),
+        ('version', ['--version']),
+        ('list-styles', ['--list-styles']),
+        ('new-style', ['--new-style', os.path.join(tmp_dir, 'new_style.cfg')])
+    ]
+
+
+def compile_module(colorizer_dir):
+    '''Make sure the module is compiled so the timed runs load the bytecode'''
+    subprocess.call([sys.executable, '-m', 'py_compile', os.path.join(colorizer_dir, 'colorize_lecroy.py')])
+
+
+def time_command(colorizer_dir, args, repeat):
+    '''Median wall time in milliseconds to run the colorizer
+
+    Returns None if the command fails.
+    '''
+    devnull = open(os.devnull, 'w')
+    samples = []
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        status = subprocess.call([sys.executable, '-c', ENTRY_POINT, colorizer_dir] + args, stdout=devnull, \
+            stderr=devnull)
+        samples.append((timeit.default_timer() - start) * 1000.0)
+        if status != 0:
+            devnull.close()
+            return None
+    devnull.close()
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+def trace_imports(args, tmp_dir):
+    '''Get the import times and loaded modules for a command'''
+    report_file = os.path.join(tmp_dir, 'imports.json')
+    devnull = open(os.devnull, 'w')
+    subprocess.call([sys.executable, '-c', IMPORT_TIMER, report_file, script_dir] + args, stdout=devnull, \
+        stderr=devnull)
+    devnull.close()
+    with open(report_file) as fh:
+        return json.load(fh)
+
+
+def main():
+    parser = OptionParser(usage='%prog [-n repeat] [-o results.json] [--baseline=results.json] [--baseline-dir=dir]')
+    parser.add_option('-n', dest='repeat', type='int', default=11, help='number of runs per command [11]')
+    parser.add_option('-o', dest='out_file', help='save the results as JSON')
+    parser.add_option('--baseline', dest='baseline', help='JSON results to compare against')
+    parser.add_option('--baseline-dir', dest='baseline_dir',
+        help='directory with another colorize_lecroy.py to time side by side')
+    parser.add_option('-t', '--threshold', dest='threshold', type='float', default=0.20,
+        help='fractional slowdown that counts as a regression [0.20]')
+    parser.add_option('--top', dest='top', type='int', default=5, help='number of slowest imports to show [5]')
+    options, args = parser.parse_args()
+
+    baseline = {}
+    if options.baseline is not None:
+        with open(options.baseline) as fh:
+            baseline = json.load(fh)
+
+    compile_module(script_dir)
+    if options.baseline_dir is not None:
+        compile_module(options.baseline_dir)
+
+    tmp_dir = tempfile.mkdtemp()
+    failures = 0
+    results = {}
+    try:
+        if baseline or options.baseline_dir is not None:
+            print('{0:<14}{1:>10}{2:>12}{3:>9}'.format('command', 'time', 'baseline', 'change'))
+        for name, cmd in commands(tmp_dir):
+            ms = time_command(script_dir, cmd, options.repeat)
+            if ms is None:
+                print('error: {0} failed'.format(name))
+                failures += 1
+                continue
+            trace = trace_imports(cmd, tmp_dir)
+            heavy = [m for m in HEAVY_MODULES if m in trace['modules']]
+            results[name] = {'ms': ms, 'heavy_modules': heavy}
+
+            base_ms = None
+            if options.baseline_dir is not None:
+                base_ms = time_command(options.baseline_dir, cmd, options.repeat)
+                results[name]['baseline_ms'] = base_ms
+            elif name in baseline:
+                base_ms = baseline[name]['ms']
+
+            line = '{0:<14}{1:8.1f}ms'.format(name, ms)
+            if options.baseline_dir is not None and base_ms is None:
+                line += '{0:>12}'.format('n/a') # Not supported by the baseline
+            elif base_ms is not None:
+                line += '{0:10.1f}ms{1:+8.0f}%'.format(base_ms, (ms / base_ms - 1.0) * 100.0)
+                if ms > base_ms * (1.0 + options.threshold):
+                    line += '   REGRESSION'
+                    failures += 1
+            if heavy:
+                line += '   loads ' + ', '.join(heavy)
+                failures += 1
+            print(line)
+
+            slowest = sorted(trace['imports'].items(), key=lambda t: -t[1])[:options.top]
+            for module, t in slowest:
+                print('    {0:<24}{1:8.1f}ms'.format(module, t))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if options.out_file is not None:
+        with open(options.out_file, 'w') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+
+    sys.exit(1 if failures > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''Time each stage of the colorizer for every example capture and style
+
+  bench_suite.py run [-o results.json] [-n repeat] [--engine=...] [--recon-backend=...]
+  bench_suite.py compare baseline.json results.json [-t threshold]
+
+The run command writes the median time of each stage in milliseconds as JSON.
+Stages that don't run for a capture are left out. The compare command reports
+the stages that are slower than the baseline by more than the threshold and
+exits with a non-zero status if there are any. The total of each stage is
+listed with n/a for the stages that weren't timed.
+'''
+
+from __future__ import print_function
+
+import sys
+import os
+import io
+import json
+import platform
+import timeit
+from optparse import OptionParser
+
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+script_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, script_dir)
+
+import colorize_lecroy as cl
+
+EXAMPLES = ('example_single', 'example_dual', 'example_quad', 'example_xy', 'example_xy_dual', \
+    'example_single_param')
+
+# Stages in the order they happen. BMP captures are validated from their
+# header while they are decoded so they have no validate stage.
+STAGES = ('decode', 'validate', 'identify', 'boxes', 'layers', 'composite', 'reconstruct', 'palette', \
+    'encode', 'total')
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def time_capture(colorizer, in_file, repeat):
+    '''Median time of each stage in milliseconds'''
+    colorizer.colorize(in_file, False) # Warm up the layer cache
+
+    samples = dict((s, []) for s in STAGES)
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        result = colorizer.colorize(in_file, False)
+        encode_start = timeit.default_timer()
+        result.image.save(io.BytesIO(), 'PNG')
+        end = timeit.default_timer()
+
+        for stage in STAGES:
+            if stage in result.timings:
+                samples[stage].append(result.timings[stage])
+        samples['encode'].append(end - encode_start)
+        samples['total'].append(end - start)
+
+    return dict((s, median(v) * 1000.0) for s, v in samples.items() if v)
+
+
+def run(args):
+    parser = OptionParser(usage='%prog run [-o results.json] [-n repeat]')
+    parser.add_option('-o', dest='out_file', help='JSON results file [stdout]')
+    parser.add_option('-n', dest='repeat', type='int', default=10, help='number of timing runs [10]')
+    parser.add_option('--engine', dest='engine', type='choice', choices=cl.ENGINES, default='composite',
+        help='rendering engine [composite]')
+    parser.add_option('--recon-backend', dest='recon_backend', type='choice', choices=cl.RECON_BACKENDS,
+        default='auto', help='trace reconstruction backend [auto]')
+    options, args = parser.parse_args(args)
+
+    example_dir = os.path.join(script_dir, 'examples')
+    style_dir, color_styles = cl.find_styles(script_dir)
+    styles = [('default', None)] + [(s, os.path.join(style_dir, color_styles[s])) for s in sorted(color_styles)]
+
+    results = {}
+    for style, setting_file in styles:
+        settings = cl.load_settings(setting_file, script_dir)
+        colorizer = cl.LecroyColorizer(settings, options.engine, options.recon_backend)
+        for name in EXAMPLES:
+            key = '{0}/{1}'.format(name, style)
+            results[key] = time_capture(colorizer, os.path.join(example_dir, name + '.bmp'), options.repeat)
+            print('  {0:<36} {1:8.2f}ms'.format(key, results[key]['total']), file=sys.stderr)
+
+    report = {
+        'version': cl.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'engine': options.engine,
+        'recon_backend': options.recon_backend,
+        'repeat': options.repeat,
+        'stages': list(STAGES),
+        'results': results
+    }
+
+    if options.out_file is None:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        with open(options.out_file, 'w') as fh:
+            json.dump(report, fh, indent=2, sort_keys=True)
+    return 0
+
+
+def stage_total(report, stage):
+    '''Total time of a stage over all captures or n/a when it wasn't timed'''
+    times = [r[stage] for r in report['results'].values() if stage in r]
+    return '{0:.2f}ms'.format(sum(times)) if times else 'n/a'
+
+
+def compare(args):
+    parser = OptionParser(usage='%prog compare baseline.json results.json [-t threshold]')
+    parser.add_option('-t', '--threshold', dest='threshold', type='float', default=0.10,
+        help='fractional slowdown that counts as a regression [0.10]')
+    parser.add_option('--min-ms', dest='min_ms', type='float', default=0.1,
+        help='ignore differences smaller than this many milliseconds [0.1]')
+    options, args = parser.parse_args(args)
+    if len(args) != 2:
+        parser.error('Need a baseline and a results file')
+
+    with open(args[0]) as fh:
+        baseline = json.load(fh)
+    with open(args[1]) as fh:
+        current = json.load(fh)
+
+    regressions = 0
+    for key in sorted(baseline['results']):
+        if key not in current['results']:
+            print('  {0}: missing from results'.format(key))
+            continue
+        for stage in STAGES:
+            base_t = baseline['results'][key].get(stage)
+            cur_t = current['results'][key].get(stage)
+            if base_t is None or cur_t is None or cur_t - base_t < options.min_ms:
+                continue
+            if cur_t > base_t * (1.0 + options.threshold):
+                regressions += 1
+                print('  REGRESSION {0} {1}: {2:.2f}ms -> {3:.2f}ms ({4:+.0f}%)'.format(key, stage, \
+                    base_t, cur_t, (cur_t / base_t - 1.0) * 100.0 if base_t > 0 else float('inf')))
+
+    print('\n  {0:<12}{1:>12}{2:>12}'.format('stage', 'baseline', 'results'))
+    for stage in STAGES:
+        print('  {0:<12}{1:>12}{2:>12}'.format(stage, stage_total(baseline, stage), stage_total(current, stage)))
+
+    base_total = sum(r['total'] for r in baseline['results'].values())
+    cur_total = sum(r['total'] for k, r in current['results'].items() if k in baseline['results'])
+    print('Total {0:.2f}ms -> {1:.2f}ms, {2} regression(s) over {3:.0f}%'.format(base_total, cur_total, \
+        regressions, options.threshold * 100.0))
+    return 1 if regressions > 0 else 0
+
+
+def main():
+    commands = {'run': run, 'compare': compare}
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        print(__doc__)
+        sys.exit(1)
+    sys.exit(commands[sys.argv[1]](sys.argv[2:]))
+
+
+if __name__ == '__main__':
+    main()
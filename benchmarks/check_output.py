@@ -0,0 +1,188 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''Check that every rendering path produces the baseline images
+
+The example captures are colorized in every style with and without trace
+reconstruction by each engine, reconstruction backend, and indexed mode and
+compared with baseline images. The baseline is rendered by the command line of
+another copy of the colorizer, such as a checkout of the previous release, or
+read from a directory saved with --save. Without either the composite engine
+with the Pillow backend of this copy is the baseline.
+
+The paths that must match a full render are also checked: analyze() and
+render() against colorize(), crops and thumbnails against cropping and resizing
+the full image, and ColorizerSequence against colorizing each capture. The
+exit status is non-zero when any image differs.
+
+  check_output.py [--baseline-dir=dir | --refs=dir] [--save=dir]
+'''
+
+from __future__ import print_function
+
+import sys
+import os
+import io
+import shutil
+import subprocess
+import tempfile
+from optparse import OptionParser
+
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+script_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, script_dir)
+
+import colorize_lecroy as cl
+from PIL import Image, ImageChops
+
+# Crops and thumbnails checked against the full image
+CROPS = ((None, (200, 200)), ('grid', None), ((100, 50, 400, 300), None), ((100, 50, 400, 300), (97, 61)), \
+    ('grid', (320, 240)))
+
+
+def same_image(a, b):
+    return a.size == b.size and ImageChops.difference(a.convert('RGB'), b.convert('RGB')).getbbox() is None
+
+
+def reference_name(example, style, no_reconstruct):
+    return '{0}_{1}{2}.png'.format(example, style, '_r' if no_reconstruct else '')
+
+
+def render_baseline_dir(baseline_dir, cases, out_dir):
+    '''Render the reference images with the command line of another copy'''
+    for f, style, no_reconstruct in cases:
+        args = [sys.executable, os.path.join(baseline_dir, 'colorize_lecroy.py'), '-i', f, '-o', \
+            os.path.join(out_dir, reference_name(os.path.splitext(os.path.basename(f))[0], style, no_reconstruct))]
+        if style != 'default':
+            args += ['-s', style]
+        if no_reconstruct:
+            args.append('-r')
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(args, stdout=devnull)
+
+
+def render_references(settings, cases, out_dir):
+    '''Render the reference images with the composite engine and Pillow backend'''
+    colorizers = dict((style, cl.LecroyColorizer(s, 'composite', 'pil')) for style, s in settings)
+    for f, style, no_reconstruct in cases:
+        im = colorizers[style].colorize(f, no_reconstruct).image
+        im.save(os.path.join(out_dir, reference_name(os.path.splitext(os.path.basename(f))[0], style, \
+            no_reconstruct)))
+
+
+def check_engine(settings, engine, recon_backend, indexed, examples, ref_dir):
+    '''Colorize the examples in every style and compare them with the references
+
+    Returns a list of the mismatches.
+    '''
+    colorizers = [cl.LecroyColorizer(s, engine, recon_backend, indexed) for _, s in settings]
+    styles = [style for style, _ in settings]
+    bad = []
+    for f in examples:
+        name = os.path.splitext(os.path.basename(f))[0]
+        for no_reconstruct in (False, True):
+            # Render the styles from one analysis like --styles
+            results = cl.colorize_styles(colorizers, f, no_reconstruct)
+            for style, c, result in zip(styles, colorizers, results):
+                case = '{0} {1}{2}'.format(name, style, ' -r' if no_reconstruct else '')
+                ref = Image.open(os.path.join(ref_dir, reference_name(name, style, no_reconstruct)))
+                if not same_image(result.image, ref):
+                    bad.append(case)
+
+                # The banded engine writes PNG output a band at a time
+                if engine == 'banded':
+                    fh = io.BytesIO()
+                    c.render_to_file(c.analyze(f), fh, no_reconstruct, 'PNG')
+                    fh.seek(0)
+                    if not same_image(Image.open(fh), ref):
+                        bad.append(case + ' written in bands')
+
+        # Analyzing and rendering separately is the same as colorizing
+        c = colorizers[0]
+        if not same_image(c.render(c.analyze(f), False).image, c.colorize(f, False).image):
+            bad.append('{0} analyze and render'.format(name))
+
+        # Crops and thumbnails only render their pixels
+        analysis = c.analyze(f)
+        full = c.render(analysis, False).image
+        for crop, thumbnail in CROPS:
+            box = c.crop_box(analysis.grid_name, crop if crop is not None else (0, 0) + full.size)
+            expected = full.crop(box)
+            if thumbnail is not None:
+                expected = expected.resize(cl.thumbnail_size(expected.size, thumbnail), Image.NEAREST)
+            if not same_image(c.render(analysis, False, crop, thumbnail).image, expected):
+                bad.append('{0} crop {1} thumbnail {2}'.format(name, crop, thumbnail))
+
+    # Only the changed areas are rendered for a sequence
+    for c, style in zip(colorizers, styles):
+        sequence = cl.ColorizerSequence(c)
+        for f in examples + examples[::-1] + [examples[0]] * 2:
+            if not same_image(sequence.colorize(f).image, c.colorize(f, False).image):
+                bad.append('{0} {1} sequence'.format(os.path.basename(f), style))
+
+    return bad
+
+
+def main():
+    parser = OptionParser(usage='%prog [--baseline-dir=dir | --refs=dir] [--save=dir]')
+    parser.add_option('--baseline-dir', dest='baseline_dir',
+        help='render the baseline with another copy of the colorizer')
+    parser.add_option('--refs', dest='refs', help='directory of saved baseline images')
+    parser.add_option('--save', dest='save', help='save the baseline images to a directory')
+    options, args = parser.parse_args()
+
+    example_dir = os.path.join(script_dir, 'examples')
+    examples = sorted(os.path.join(example_dir, f) for f in os.listdir(example_dir) if f.endswith('.bmp'))
+    style_dir, color_styles = cl.find_styles(script_dir)
+    settings = [('default', cl.load_settings(None, script_dir, cache=False))] + \
+        [(s, cl.load_settings(os.path.join(style_dir, color_styles[s]), script_dir, cache=False)) \
+        for s in sorted(color_styles)]
+    cases = [(f, style, no_reconstruct) for f in examples for style, _ in settings for no_reconstruct in (False, True)]
+
+    tmp_dir = None
+    if options.refs is not None:
+        ref_dir = options.refs
+    else:
+        ref_dir = tmp_dir = tempfile.mkdtemp()
+
+    try:
+        if options.baseline_dir is not None:
+            print('Rendering the baseline with {0}'.format(options.baseline_dir))
+            render_baseline_dir(options.baseline_dir, cases, ref_dir)
+        elif options.refs is None:
+            render_references(settings, cases, ref_dir)
+
+        if options.save is not None:
+            if not os.path.isdir(options.save):
+                os.makedirs(options.save)
+            for f, style, no_reconstruct in cases:
+                name = reference_name(os.path.splitext(os.path.basename(f))[0], style, no_reconstruct)
+                shutil.copy(os.path.join(ref_dir, name), options.save)
+            print('Saved {0} baseline images to {1}'.format(len(cases), options.save))
+            return 0
+
+        if not cl._have_numpy():
+            print('NumPy is not installed, the numpy backend falls back to pil')
+
+        failures = 0
+        for engine in cl.ENGINES:
+            # The banded engine always uses the sparse backend
+            backends = ('sparse',) if engine == 'banded' else ('pil', 'numpy', 'sparse')
+            for recon_backend in backends:
+                for indexed in (False, True):
+                    bad = check_engine(settings, engine, recon_backend, indexed, examples, ref_dir)
+                    print('{0:<10} {1:<7} {2:<8} {3}'.format(engine, recon_backend, \
+                        'indexed' if indexed else 'rgb', 'ok' if not bad else '{0} FAILED'.format(len(bad))))
+                    for b in bad:
+                        print('  ' + b)
+                    failures += len(bad)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+    print('{0} failure(s)'.format(failures))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
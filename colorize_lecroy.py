@@ -34,417 +34,3924 @@ import sys
 import os
 import ast
 import re
+import glob
+import time
+import timeit
+import struct
+import math
+import zlib
+import importlib
+import io
+import signal
+import collections
+import bisect
+import fnmatch
+import copy
 
-from optparse import OptionParser
+from optparse import OptionParser, Values
 
 import ConfigParser
 from ConfigParser import SafeConfigParser
 
-import PIL
-from PIL import Image
-from PIL import ImageChops
-from PIL import ImageDraw
+
+class _LazyModule(object):
+    '''Import a module on first use
+
+    Pillow and NumPy are a large part of the startup time so they are
+    not loaded for the command line options that don't need them.
+    '''
+    def __init__(self, name):
+        self._lazy_name = name
+        self._lazy_module = None
+
+    def _load(self):
+        if self._lazy_module is None:
+            self._lazy_module = importlib.import_module(self._lazy_name)
+        return self._lazy_module
+
+    def __getattr__(self, attr):
+        value = getattr(self._load(), attr)
+        setattr(self, attr, value) # Skip __getattr__ next time
+        return value
+
+
+Image = _LazyModule('PIL.Image')
+ImageChops = _LazyModule('PIL.ImageChops')
+ImageDraw = _LazyModule('PIL.ImageDraw')
+ImageColor = _LazyModule('PIL.ImageColor')
+ImageMath = _LazyModule('PIL.ImageMath')
+multiprocessing = _LazyModule('multiprocessing')
+
+# Modules that are only needed for the server, batch, watch, and cache modes
+threading = _LazyModule('threading')
+socket = _LazyModule('socket')
+json = _LazyModule('json')
+hashlib = _LazyModule('hashlib')
+tempfile = _LazyModule('tempfile')
+mmap = _LazyModule('mmap')
+pickle = _LazyModule('cPickle')
+Queue = _LazyModule('Queue')
+
+# NumPy is optional
+np = _LazyModule('numpy')
+
+def _have_numpy():
+    '''Check if NumPy can be imported'''
+    try:
+        np._load()
+    except ImportError:
+        return False
+    return True
 
 # Screen capture dimensions are 832x696
 IMAGE_SIZE = (832, 696)
 
+# Screen geometry that the coordinates in the settings are given for. The
+# [layout] section of the settings overrides these.
+DEFAULT_LAYOUT = {
+    'image-size': IMAGE_SIZE,
+    'channel-box-width': 126,
+    'menu-box-width': 136,
+    'box-text-offset': 12,
+    'min-box-height': 20,
+    'delay-box-height': 25,
+    'xy-delay-box-height': 35
+}
+
 GRID_ID = 0
 GRID_IMAGE = 1
 GRID_DESCR = 2
 
+# The composite engine layers RGB images. The palette engine renders
+# a single label image that is colored by a palette. The banded engine
+# renders labels a band of rows at a time to limit memory use.
+ENGINES = ('composite', 'palette', 'banded')
+
+# Rows per band for the banded engine
+BAND_HEIGHT = 64
+
+# Colors painted on the label images besides the regions
+LABEL_COLORS = ('background', 'grid', 'grid-background', 'trace', 'trace-reconstruction', 'left-marker', \
+    'channels-text', 'channels-background', 'menu-text', 'menu-background')
+
+# Trace reconstruction can evaluate every pixel with Pillow or NumPy or only
+# check the neighbors of the grid line pixels with the sparse backend
+RECON_BACKENDS = ('auto', 'pil', 'numpy', 'sparse')
+
+# zlib compression strategies for PNG output
+PNG_STRATEGIES = {'default': 0, 'filtered': 1, 'huffman': 2, 'rle': 3, 'fixed': 4}
+
+# Output formats that can store indexed images. Others are saved as RGB.
+PALETTE_FORMATS = ('PNG', 'GIF', 'BMP', 'TIFF', 'PCX')
+
+# Grid line pixel types for the sparse reconstruction index
+RECON_HORIZ = 0
+RECON_VERT = 1
+RECON_CROSS = 2
+
+# Precompiled grid masks are stored in the data directory
+GRID_BUNDLE_FILE = 'grid_masks.bin'
+GRID_BUNDLE_MAGIC = b'LCGM'
+GRID_BUNDLE_VERSION = 1
+
+
+class GridMaskBundle(object):
+    '''Bit-packed mode '1' grid masks
+
+    The masks are taken from a precompiled bundle file when it is present and
+    current. Otherwise each grid image is decoded the first time it is needed.
+    Either way the packed masks stay in memory so that no image file is read
+    more than once per process.
+
+    Bundle format (little endian):
+      magic, version, entry count
+      per entry: name, width, height, source size, source mtime, data offset, data length
+      packed mask data
+    '''
+    _header = struct.Struct('<4sHH')
+    _entry = struct.Struct('<HHHIdII')
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.bundle_file = os.path.join(data_dir, GRID_BUNDLE_FILE)
+        self._packed = {} # image name -> (size, packed bytes)
+        self._bundle = None
+
+    def get(self, image_name):
+        '''Get the mode '1' mask for a grid image'''
+        packed = self._packed.get(image_name)
+        if packed is None:
+            packed = self._from_bundle(image_name)
+            if packed is None:
+                packed = self._decode(image_name)
+            self._packed[image_name] = packed
+
+        size, data = packed
+        return Image.frombytes('1', size, data)
+
+    def _source_stat(self, image_name):
+        st = os.stat(os.path.join(self.data_dir, image_name))
+        return (st.st_size, float(int(st.st_mtime)))
+
+    def _decode(self, image_name):
+        '''Decode a grid image into a packed mask'''
+        grid_image_file = os.path.join(self.data_dir, image_name)
+        gr_mask = Image.open(grid_image_file).convert('RGB').convert('1')
+        return (gr_mask.size, gr_mask.tobytes())
+
+    def _from_bundle(self, image_name):
+        '''Look up a packed mask in the bundle file
+
+        Returns None if the bundle is missing, invalid, or out of date
+        with the source image.
+        '''
+        if self._bundle is None:
+            self._bundle = self._read_index()
+
+        entry = self._bundle[1].get(image_name)
+        if entry is None:
+            return None
+
+        size, src_stat, offset, length = entry
+        try:
+            if self._source_stat(image_name) != src_stat:
+                return None
+        except OSError:
+            return None
+
+        return (size, self._bundle[0][offset:offset + length])
+
+    def _read_index(self):
+        '''Memory map the bundle file and read its index'''
+        index = {}
+        try:
+            with open(self.bundle_file, 'rb') as fh:
+                bmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return (None, index)
+
+        try:
+            magic, version, count = self._header.unpack_from(bmap, 0)
+            if magic != GRID_BUNDLE_MAGIC or version != GRID_BUNDLE_VERSION:
+                return (None, index)
+
+            pos = self._header.size
+            for _ in range(count):
+                name_len, width, height, src_size, src_mtime, offset, length = self._entry.unpack_from(bmap, pos)
+                pos += self._entry.size
+                name = bmap[pos:pos + name_len].decode('utf-8')
+                pos += name_len
+                index[name] = ((width, height), (src_size, src_mtime), offset, length)
+        except struct.error:
+            return (None, {})
+
+        return (bmap, index)
+
+    def compile(self, image_names):
+        '''Write a bundle file with the packed masks for a set of grid images'''
+        entries = []
+        for name in sorted(set(image_names)):
+            size, data = self._decode(name)
+            entries.append((name.encode('utf-8'), size, self._source_stat(name), data))
+
+        offset = self._header.size + sum(self._entry.size + len(e[0]) for e in entries)
+        with open(self.bundle_file, 'wb') as fh:
+            fh.write(self._header.pack(GRID_BUNDLE_MAGIC, GRID_BUNDLE_VERSION, len(entries)))
+            for name, size, src_stat, data in entries:
+                fh.write(self._entry.pack(len(name), size[0], size[1], src_stat[0], src_stat[1], \
+                    offset, len(data)))
+                fh.write(name)
+                offset += len(data)
+            for e in entries:
+                fh.write(e[3])
+
+        # Force the new bundle to be used on the next lookup
+        self._packed = {}
+        self._bundle = None
+
+
+_grid_mask_bundles = {}
+
+def grid_mask_bundle(data_dir):
+    '''Get the shared grid mask bundle for a data directory'''
+    bundle = _grid_mask_bundles.get(data_dir)
+    if bundle is None:
+        bundle = GridMaskBundle(data_dir)
+        _grid_mask_bundles[data_dir] = bundle
+    return bundle
+
+
+class GridIndex(object):
+    '''Identify grids from a signature of their test points
+
+    The test points of every grid are merged into one set of probes that is
+    read from a capture at once. The probe values are its signature and each
+    signature is looked up in a table of the ones seen before. New signatures
+    are matched against the grid tests in the order of the settings so the
+    first grid that matches is chosen as before.
+
+    The tests are checked when the index is built. A ValueError is raised for
+    points outside of the image, grids with contradicting or identical tests,
+    and grids that can't be identified because an earlier grid's tests are a
+    subset of theirs.
+    '''
+    # Limit on the number of signatures kept in the lookup table
+    MAX_SIGNATURES = 1024
+
+    def __init__(self, grid_test_points, size):
+        self.order = list(grid_test_points.keys())
+        grid_test_points = dict((key, _grid_test_pixels(key, points)) for key, points in grid_test_points.items())
+        self.probes = sorted(set(tp for points in grid_test_points.values() for pixels in points \
+            for tp in pixels))
+        self.signatures = {}
+
+        probe_index = dict((tp, i) for i, tp in enumerate(self.probes))
+        width, height = size
+        self.tests = []
+        for key in self.order:
+            tests = {}
+            for pixels, value in zip(grid_test_points[key], (255, 0)):
+                for tp in pixels:
+                    if not (0 <= tp[0] < width and 0 <= tp[1] < height):
+                        raise ValueError, 'Grid test point {0} for {1} is outside of the image'.format(tp, key)
+                    i = probe_index[tp]
+                    if tests.get(i, value) != value:
+                        raise ValueError, 'Grid test point {0} for {1} is both white and black'.format(tp, key)
+                    tests[i] = value
+            self.tests.append((key, frozenset(tests.items())))
+
+        # A grid can't be identified when an earlier one matches all of its captures
+        for j, (key, tests) in enumerate(self.tests):
+            for prev_key, prev_tests in self.tests[:j]:
+                if prev_tests == tests:
+                    raise ValueError, 'Grids {0} and {1} have the same test points'.format(prev_key, key)
+                if prev_tests <= tests:
+                    raise ValueError, 'Grid {0} is never identified because the test points of {1} ' \
+                        'also match it'.format(key, prev_key)
+
+    def identify(self, im):
+        '''Identify the grid of a mode '1' mask
+
+        Returns the grid name or 'Unknown'.
+        '''
+        px = im.load()
+        signature = tuple([px[tp] for tp in self.probes])
+        grid_name = self.signatures.get(signature)
+        if grid_name is None:
+            grid_name = 'Unknown'
+            for key, tests in self.tests:
+                if all(signature[i] == value for i, value in tests):
+                    grid_name = key
+                    break
+
+            if len(self.signatures) >= self.MAX_SIGNATURES:
+                self.signatures.clear()
+            self.signatures[signature] = grid_name
+        return grid_name
+
+
+def _grid_test_pixels(key, points):
+    '''Check the test points of a grid and convert them to tuples
+
+    Returns a pair of tuples with the white and black (x, y) pixels.
+    '''
+    if not isinstance(points, (list, tuple)) or len(points) != 2:
+        raise ValueError, 'Grid test points for {0} must be a pair of white and black pixels'.format(key)
+
+    pixels = []
+    for tps in points:
+        if tps is None:
+            tps = ()
+        if not isinstance(tps, (list, tuple)):
+            raise ValueError, 'Invalid grid test points {0} for {1}'.format(tps, key)
+        for tp in tps:
+            if not isinstance(tp, (list, tuple)) or len(tp) != 2 or \
+                not all(isinstance(v, (int, long)) for v in tp):
+                raise ValueError, 'Invalid grid test point {0} for {1}'.format(tp, key)
+        pixels.append(tuple(tuple(tp) for tp in tps))
+    return tuple(pixels)
+
+
+_grid_indexes = {}
+
+def grid_index(settings):
+    '''Get the shared grid index for the test points of the settings'''
+    key = (tuple(settings.grid_test_points.items()), settings.image_size)
+    try:
+        index = _grid_indexes.get(key)
+    except TypeError: # Test points given as lists
+        key = (tuple((k, _grid_test_pixels(k, v)) for k, v in settings.grid_test_points.items()), \
+            settings.image_size)
+        index = _grid_indexes.get(key)
+    if index is None:
+        index = GridIndex(settings.grid_test_points, settings.image_size)
+        _grid_indexes[key] = index
+    return index
+
+def _mask_to_array(im):
+    '''Convert a mode '1' image to a boolean NumPy array'''
+    width, height = im.size
+    bits = np.unpackbits(np.frombuffer(im.tobytes(), dtype=np.uint8))
+    return bits.reshape(height, -1)[:, :width].view(bool)
+
+def _array_to_mask(a):
+    '''Convert a boolean NumPy array to a mode '1' image'''
+    height, width = a.shape
+    return Image.frombytes('1', (width, height), np.packbits(a, axis=1).tobytes())
+
+def _band_box(box, top):
+    '''Move a box into the coordinates of a band of rows starting at top'''
+    return (box[0], box[1] - top, box[2], box[3] - top)
+
+
+def _crop_rows(im, top, bottom):
+    '''Crop a band of full width rows
+
+    Rows above and below the image wrap around to match ImageChops.offset().
+    '''
+    width, height = im.size
+    if top >= 0 and bottom <= height:
+        return im.crop((0, top, width, bottom))
+
+    band = Image.new(im.mode, (width, bottom - top))
+    if top < 0:
+        band.paste(im.crop((0, height + top, width, height)), (0, 0))
+    band.paste(im.crop((0, max(top, 0), width, min(bottom, height))), (0, max(-top, 0)))
+    if bottom > height:
+        band.paste(im.crop((0, 0, width, bottom - height)), (0, height - top))
+    return band
+
+
+def _column_bytes(im, box):
+    '''Get the pixels of a column of a mode '1' image as bytes that are 0 for black'''
+    column = im.crop(box)
+    if column.size[0] != 1:
+        column = column.convert('L')
+    # Each row of a 1-pixel wide mask is packed into its own byte
+    return column.tobytes()
+
+def _nearest_samples(start, length, size):
+    '''Get the source positions that a nearest neighbor resize samples
+
+    The positions are found by resizing a line of coordinates so they always
+    match Image.resize().
+    '''
+    if size == length:
+        return range(start, start + length)
+    line = Image.new('I', (length, 1))
+    line.putdata(range(start, start + length))
+    return list(line.resize((size, 1), Image.NEAREST).getdata())
+
+def _sample_image(im, box, size):
+    '''Crop an image and resize it with nearest neighbor sampling'''
+    im = im.crop(box)
+    return im if im.size == size else im.resize(size, Image.NEAREST)
+
+
+class PngBandWriter(object):
+    '''Write a PNG image a band of rows at a time
+
+    The rows of each band are compressed as they arrive and written as an IDAT
+    chunk so the whole image never has to be held in memory. RGB and P images
+    are supported. RGB rows use the Up filter. Small palettes are packed into
+    fewer bits per pixel the same way as Pillow does.
+    '''
+    def __init__(self, fh, size, mode, palette=None, compress_level=None, compress_type=None):
+        if mode == 'RGB':
+            bits, color_type, self._rawmode = 8, 2, 'RGB'
+            self._filter = b'\x02'
+        elif mode == 'P':
+            colors = max(min(len(palette) // 3, 256), 2)
+            bits = 1 if colors <= 2 else 2 if colors <= 4 else 4 if colors <= 16 else 8
+            color_type = 3
+            self._rawmode = 'P' if bits == 8 else 'P;{0}'.format(bits)
+            self._filter = b'\x00'
+        else:
+            raise ValueError, 'Unsupported mode for PNG band output: {0}'.format(mode)
+
+        self.fh = fh
+        self.size = size
+        self.rows = 0
+        self._last_row = None # Previous row for the Up filter
+        level = 6 if compress_level is None else compress_level
+        strategy = 0 if compress_type is None else compress_type
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 15, 9, strategy)
+
+        fh.write(b'\x89PNG\r\n\x1a\n')
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', size[0], size[1], bits, color_type, 0, 0, 0))
+        if mode == 'P':
+            self._chunk(b'PLTE', bytes(bytearray(palette[:colors * 3])))
+
+    def _chunk(self, kind, data):
+        self.fh.write(struct.pack('>I', len(data)) + kind + data)
+        self.fh.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    def write(self, band):
+        '''Add the next band of rows'''
+        if self._filter == b'\x02':
+            # Subtract the row above
+            width, height = band.size
+            above = Image.new(band.mode, band.size)
+            if self._last_row is not None:
+                above.paste(self._last_row, (0, 0))
+            above.paste(band.crop((0, 0, width, height - 1)), (0, 1))
+            self._last_row = band.crop((0, height - 1, width, height))
+            band = ImageChops.subtract_modulo(band, above)
+
+        data = band.tobytes('raw', self._rawmode)
+        stride = len(data) // band.size[1]
+        # Every row starts with the filter type
+        rows = b''.join(self._filter + data[i:i + stride] for i in range(0, len(data), stride))
+        self.rows += band.size[1]
+
+        compressed = self._compressor.compress(rows)
+        if compressed:
+            self._chunk(b'IDAT', compressed)
+
+    def close(self):
+        '''Finish the image'''
+        if self.rows != self.size[1]:
+            raise ValueError, 'PNG image has {0} of {1} rows'.format(self.rows, self.size[1])
+        self._chunk(b'IDAT', self._compressor.flush())
+        self._chunk(b'IEND', b'')
+
+
+class _StaticLayers(object):
+    '''Capture independent layers for one grid type and style'''
+    def __init__(self):
+        self.regions = None       # Region colors for the ink in each part of the screen
+        self.background = None    # Background with grid fills and colored grid lines
+        self.gr_mask = None       # Grid mask (grid lines are 0)
+        self.grid_lines = None    # Inverted grid mask (grid lines are 1)
+        self.grid_bbox = None     # Bounding box of the grid lines
+        self.recon_border = None  # Mask excluding everything outside the grid boxes
+        self.recon_color = None   # Solid trace reconstruction color
+        self.region_labels = None     # Palette engine labels for the ink
+        self.background_labels = None # Palette engine labels for the background and grid lines
+        self.gr_array = None      # Grid mask as a NumPy array
+        self.recon_index = None   # Grid line pixels and neighbors for sparse reconstruction
+        self.band_index = {}      # Sparse reconstruction index for each band of the banded engine
+        self.samples = {}         # Layers sampled for crops and thumbnails
+
+
+# Zero copy slices of the pixel data in a file mapping
+try:
+    _buffer = buffer
+except NameError:
+    def _buffer(obj, offset, size):
+        return memoryview(obj)[offset:offset + size]
+
+
+_bmp_file_header = struct.Struct('<2sIHHI')
+_bmp_info_header = struct.Struct('<IiiHHIIiiII')
+
+def bmp_mask_from_buffer(buf, size=IMAGE_SIZE):
+    '''Build a mode '1' mask from a 1bpp black and white BMP in a buffer
+
+    The header is checked for an uncompressed 1bpp image with the expected size
+    and a black and white palette. Any size is accepted when size is None. The
+    mask is decoded straight from the row data.
+    Returns None if the buffer isn't a suitable BMP.
+    '''
+    try:
+        magic, _, _, _, data_offset = _bmp_file_header.unpack_from(buf, 0)
+        header_size, width, height, planes, bpp, compression, _, _, _, num_colors, _ = \
+            _bmp_info_header.unpack_from(buf, _bmp_file_header.size)
+    except struct.error:
+        return None
+
+    if magic != b'BM' or header_size < _bmp_info_header.size or planes != 1 or bpp != 1 \
+        or compression != 0 or (size is not None and (width, abs(height)) != size):
+        return None
+    size = (width, abs(height))
+
+    # The palette must have a black and a white entry in either order
+    if num_colors not in (0, 2):
+        return None
+    palette_offset = _bmp_file_header.size + header_size
+    palette = (buf[palette_offset:palette_offset + 3], buf[palette_offset + 4:palette_offset + 7])
+    if palette == (b'\xff\xff\xff', b'\x00\x00\x00'):
+        rawmode = '1;I' # Index 0 is white
+    elif palette == (b'\x00\x00\x00', b'\xff\xff\xff'):
+        rawmode = '1'
+    else:
+        return None
+
+    # Rows are padded to 32-bits and stored bottom-up unless the height is negative
+    stride = ((width + 31) // 32) * 4
+    if data_offset + stride * abs(height) > len(buf):
+        return None
+
+    orientation = -1 if height > 0 else 1
+    pixels = _buffer(buf, data_offset, stride * abs(height))
+    return Image.frombuffer('1', size, pixels, 'raw', rawmode, stride, orientation)
+
+def read_bmp_mask(in_file, size=IMAGE_SIZE):
+    '''Read a 1bpp black and white BMP file directly into a mode '1' mask
+
+    The file is memory mapped so that no intermediate copies are made.
+    Returns None if the file isn't a suitable BMP.
+    '''
+    with open(in_file, 'rb') as fh:
+        if fh.read(2) != b'BM':
+            return None
+        try:
+            bmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            return None
+
+    try:
+        return bmp_mask_from_buffer(bmap, size)
+    finally:
+        bmap.close()
+
+
+class _StageTimer(object):
+    '''Record the elapsed time between successive stages'''
+    def __init__(self):
+        self.timings = {}
+        self._last = timeit.default_timer()
+
+    def mark(self, stage):
+        now = timeit.default_timer()
+        self.timings[stage] = self.timings.get(stage, 0.0) + (now - self._last)
+        self._last = now
+
+
+class _CountingChops(object):
+    '''ImageChops with every operation counted as a full-frame allocation'''
+    def __init__(self, profile):
+        self.profile = profile
+
+    def __getattr__(self, name):
+        op = getattr(ImageChops, name)
+        def counted(*args, **kwargs):
+            self.profile.count('frames')
+            return op(*args, **kwargs)
+        return counted
+
+
+class ColorizerProfile(object):
+    '''Totals of the stage times and counters for a colorizer
+
+    The timings of the reconstruction backends are totalled as
+    "reconstruct-<backend>" and split into "reconstruct-<backend>:<stage>".
+
+    Counters:
+      frames:        Number of full-frame images and arrays allocated. ImageChops
+                     operations are counted as they are called and the other
+                     allocations where they are made.
+      bytes_read:    Bytes read from the captures
+      bytes_written: Bytes written for the colorized images
+    '''
+    def __init__(self):
+        self.runs = 0
+        self.timings = {}
+        self.counters = {'frames': 0, 'bytes_read': 0, 'bytes_written': 0}
+
+    def add_timings(self, timings):
+        for stage, t in timings.items():
+            self.timings[stage] = self.timings.get(stage, 0.0) + t
+
+    def count(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def merge(self, profile):
+        '''Add the totals from another profile or its dict form'''
+        if isinstance(profile, ColorizerProfile):
+            profile = profile.as_dict()
+        self.runs += profile['runs']
+        self.add_timings(dict((k, v / 1000.0) for k, v in profile['timings_ms'].items()))
+        for counter, n in profile['counters'].items():
+            self.count(counter, n)
+
+    def as_dict(self):
+        runs = max(self.runs, 1)
+        return {
+            'runs': self.runs,
+            'timings_ms': dict((k, v * 1000.0) for k, v in self.timings.items()),
+            'mean_ms': dict((k, v * 1000.0 / runs) for k, v in self.timings.items()),
+            'counters': dict(self.counters)
+        }
+
+
+class _CountingWriter(object):
+    '''Count the bytes written to a file object'''
+    def __init__(self, fh):
+        self.fh = fh
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        return self.fh.write(data)
+
+    def flush(self):
+        self.fh.flush()
+
+
+def _input_size(in_file):
+    '''Number of bytes read for a capture'''
+    if isinstance(in_file, basestring):
+        return os.path.getsize(in_file)
+    if isinstance(in_file, Image.Image):
+        return in_file.info.get('file_size', 0)
+    if hasattr(in_file, 'tell'):
+        return in_file.tell()
+    return 0
+
+
+def _save_format(out_file, format=None):
+    '''Get the image format for saving to a file name or file object
+
+    Returns None when it can't be determined.
+    '''
+    if format is not None:
+        return format.upper()
+    if not isinstance(out_file, basestring):
+        return None
+    Image.init()
+    return Image.EXTENSION.get(os.path.splitext(out_file)[1].lower())
+
+
+def _size_names(sizes):
+    '''Describe a set of image sizes'''
+    return ' or '.join('{0}x{1}'.format(*size) for size in sorted(sizes))
+
+
+class ColorizeResult(object):
+    '''Colorized image and the information found while processing a capture'''
+    def __init__(self, source_format=None, source_mode=None, size=None, validation=None):
+        self.image = None         # Colorized RGB image
+        self.mask = None          # Mode '1' mask of the capture
+        self.grid_name = None     # Key for the identified grid
+        self.channel_boxes = []   # Boxes detected in the channel list
+        self.menu_boxes = []      # Boxes detected in the menu list
+        self.source_format = source_format # Format of the capture file
+        self.source_mode = source_mode     # Image mode of the capture file
+        self.size = size          # Size of the capture
+        self.validation = validation # How the capture was validated ('header', 'mode', or 'histogram')
+        self.timings = {}         # Elapsed time in seconds for each stage
+        self.geometry = None      # Settings the grid and boxes were found with
+        self.reconstruction = {}  # Reconstructed pixels for each grid geometry and backend
+        self.labels = None        # Label images shared by the styles rendering the capture
+
+    def rendered(self, image, timings):
+        '''Copy of the analysis for a rendered image'''
+        result = ColorizeResult(self.source_format, self.source_mode, self.size, self.validation)
+        result.mask = self.mask
+        result.grid_name = self.grid_name
+        result.channel_boxes = self.channel_boxes
+        result.menu_boxes = self.menu_boxes
+        result.geometry = self.geometry
+        result.reconstruction = self.reconstruction
+        result.labels = self.labels
+        result.image = image
+        result.timings = dict(self.timings)
+        for stage, t in timings.items():
+            result.timings[stage] = result.timings.get(stage, 0.0) + t
+        return result
+
+
+# Limit on the number of channel and menu box layouts kept by a colorizer
+MAX_BOX_LAYOUTS = 256
+
 class LecroyColorizer(object):
     '''Colorize screen captures from Lecroy 93xx series oscilloscopes'''
 
-    def __init__(self, settings):
+    def __init__(self, settings, engine='composite', recon_backend='auto', indexed=False, profile=None):
+        if engine not in ENGINES:
+            raise ValueError, 'Unknown colorizer engine: {0}'.format(engine)
+        if recon_backend not in RECON_BACKENDS:
+            raise ValueError, 'Unknown reconstruction backend: {0}'.format(recon_backend)
+
+        # The banded engine reconstructs each band from the sparse index. Otherwise
+        # the index is only used when NumPy can build it quickly.
+        if engine == 'banded':
+            recon_backend = 'sparse'
+        elif recon_backend == 'auto':
+            recon_backend = 'sparse' if _have_numpy() else 'pil'
+        # Fall back to Pillow when NumPy isn't installed
+        if recon_backend == 'numpy' and not _have_numpy():
+            recon_backend = 'pil'
+
         self.settings = settings
+        self.engine = engine
+        self.recon_backend = recon_backend
+        self.indexed = indexed
+        self.profile = profile # ColorizerProfile for instrumentation, disabled when None
+        self._layer_cache = {}
+        self._layer_key = None
+        self._layer_lock = threading.Lock()
+        self._labels = {}
+        self._palette = []
+        self._palette_size = 0
+        self._key_labels = None # Colorizer and lookup table for labels shared with other styles
+        self._layouts = {} # Colorizers for the captures of other layout profiles
+        self._box_layouts = {} # Channel and menu boxes found for the contents of the detection columns
 
     def identify_grid(self, im):
-        '''Identify which grid is used in the image'''
+        '''Identify which grid is used in the image
+
+        im can be a file name, an image, or a mode '1' mask which is used
+        without conversion.
+        '''
         
         if not isinstance(im, Image.Image):
             # Read the image
             im = Image.open(im)
 
-        bw_im = im.convert('1')
+        bw_im = im if im.mode == '1' else im.convert('1')
+        return grid_index(self.settings).identify(bw_im)
+
+
+    def colorize(self, in_file, no_reconstruct, crop=None, thumbnail=None):
+        '''colorize the input image
+
+        in_file can be a file name, a file object, or an image. See render()
+        for crop and thumbnail.
+        Returns a ColorizeResult.
+        '''
+        return self.render(self.analyze(in_file), no_reconstruct, crop, thumbnail)
+
+    def analyze(self, in_file):
+        '''Read a capture and find everything that doesn't depend on the colors
+
+        Returns a ColorizeResult without an image that can be rendered by any
+        colorizer with the same geometry settings.
+        '''
+        timer = _StageTimer()
+        mim, result = self._read_capture(in_file, timer)
+        if self.profile is not None:
+            self.profile.count('bytes_read', _input_size(in_file))
+
+        # Captures of other sizes are analyzed with the settings of their layout profile
+        c = self._layout_colorizer(mim.size)
+
+        # Identify the grid type
+        grid_name = c.identify_grid(mim)
+        if grid_name == 'Unknown':
+            raise ValueError, 'Cannot identify image grid'
+        timer.mark('identify')
+
+        # Find the boxes for the channel labels and the menu buttons
+        channel_boxes, menu_boxes = c._find_boxes(mim)
+        timer.mark('boxes')
+
+        result.mask = mim
+        result.grid_name = grid_name
+        result.channel_boxes = channel_boxes
+        result.menu_boxes = menu_boxes
+        result.geometry = c.geometry_key()
+        result.timings = timer.timings
+        if self.profile is not None:
+            self.profile.add_timings(timer.timings)
+        return result
+
+    def render(self, analysis, no_reconstruct, crop=None, thumbnail=None):
+        '''Render an analyzed capture in the style of this colorizer
+
+        The trace reconstruction is stored in the analysis and reused by other
+        colorizers rendering the same capture.
+
+        crop is a box (left, upper, right, lower) or 'grid' for the area
+        around the grids. thumbnail is the largest (width, height) of the
+        image. Only the pixels of the output image are rendered. The result is
+        the same as cropping the full image and resizing it with nearest
+        neighbor sampling.
+        Returns a new ColorizeResult with the image.
+        '''
+        c = self._layout_colorizer(analysis.mask.size)
+        if c is not self:
+            return c.render(analysis, no_reconstruct, crop, thumbnail)
+
+        if analysis.geometry != self.geometry_key():
+            raise ValueError, 'Capture was analyzed with different grid and box settings'
+
+        timer = _StageTimer()
+        layers = self._static_layers(analysis.grid_name)
+        timer.mark('layers')
+
+        if crop is not None or thumbnail is not None:
+            cim = self._render_sampled(analysis, layers, crop, thumbnail, no_reconstruct, timer)
+        elif self.engine == 'banded':
+            cim = self._render_banded(analysis, layers, no_reconstruct, timer)
+        elif self._uses_labels():
+            cim = self._render_palette(analysis, layers, no_reconstruct, timer)
+        else:
+            cim = self._render_composite(analysis, layers, no_reconstruct, timer)
+
+        if self.profile is not None:
+            self.profile.runs += 1
+            self.profile.add_timings(timer.timings)
+        return analysis.rendered(cim, timer.timings)
+
+    def render_to_file(self, analysis, out_file, no_reconstruct, format=None, crop=None, thumbnail=None, \
+        **save_options):
+        '''Render an analyzed capture and save it to a file name or file object
+
+        The banded engine writes full size PNG output a band at a time without
+        building the whole image. Returns the ColorizeResult which has no image
+        when the output was written in bands.
+        '''
+        c = self._layout_colorizer(analysis.mask.size)
+        if c is not self:
+            return c.render_to_file(analysis, out_file, no_reconstruct, format, crop, thumbnail, **save_options)
+
+        if isinstance(out_file, basestring) and format is None:
+            is_png = os.path.splitext(out_file)[1].lower() == '.png'
+        else:
+            is_png = format is not None and format.upper() == 'PNG'
+
+        if self.engine != 'banded' or not is_png or crop is not None or thumbnail is not None:
+            result = self.render(analysis, no_reconstruct, crop, thumbnail)
+            self.save(result.image, out_file, format, **save_options)
+            return result
+
+        if analysis.geometry != self.geometry_key():
+            raise ValueError, 'Capture was analyzed with different grid and box settings'
+
+        timer = _StageTimer()
+        layers = self._static_layers(analysis.grid_name)
+        timer.mark('layers')
+
+        fh = open(out_file, 'wb') if isinstance(out_file, basestring) else out_file
+        writer = _CountingWriter(fh) if self.profile is not None else fh
+        try:
+            if self.indexed:
+                png = PngBandWriter(writer, analysis.mask.size, 'P', self._palette[:self._palette_size * 3], \
+                    save_options.get('compress_level'), save_options.get('compress_type'))
+            else:
+                png = PngBandWriter(writer, analysis.mask.size, 'RGB', None, save_options.get('compress_level'), \
+                    save_options.get('compress_type'))
+            for _, band in self._render_bands(analysis, layers, no_reconstruct, timer):
+                png.write(band)
+                timer.mark('encode')
+            png.close()
+            timer.mark('encode')
+        finally:
+            if fh is not out_file:
+                fh.close()
+
+        if self.profile is not None:
+            self.profile.runs += 1
+            self.profile.add_timings(timer.timings)
+            self.profile.count('bytes_written', writer.count)
+        return analysis.rendered(None, timer.timings)
+
+    def save(self, im, out_file, format=None, **save_options):
+        '''Save a colorized image to a file name or file object
+
+        Indexed images are converted to RGB for formats without palettes.
+        '''
+        if im.mode == 'P' and _save_format(out_file, format) not in PALETTE_FORMATS:
+            im = im.convert('RGB')
+
+        if self.profile is None:
+            im.save(out_file, format, **save_options)
+        elif isinstance(out_file, basestring):
+            im.save(out_file, format, **save_options)
+            self.profile.count('bytes_written', os.path.getsize(out_file))
+        else:
+            writer = _CountingWriter(out_file)
+            im.save(writer, format, **save_options)
+            self.profile.count('bytes_written', writer.count)
+
+    def _count_frames(self, n=1):
+        '''Record full-frame allocations when instrumented'''
+        if self.profile is not None:
+            self.profile.count('frames', n)
+
+    def _chops(self):
+        '''Get ImageChops or a wrapper counting its operations when instrumented'''
+        if self.profile is None:
+            return ImageChops
+        return _CountingChops(self.profile)
+
+    def _add_recon_timings(self, timings):
+        '''Record the stage timings of the trace reconstruction when instrumented'''
+        if self.profile is not None:
+            prefix = 'reconstruct-' + self.recon_backend
+            self.profile.add_timings(dict((prefix + ':' + stage, t) for stage, t in timings.items()))
+
+    def geometry_key(self):
+        '''Snapshot of the settings used to analyze a capture'''
+        s = self.settings
+        return (tuple(sorted(s.grid_test_points.items())), tuple(sorted(s.box_detection.items())), \
+            tuple(sorted(s.layout.items())), s.scale)
+
+    def _layout_colorizer(self, size):
+        '''Get the colorizer for captures of a size
+
+        Captures that aren't the size of the settings are colorized with a copy
+        of the settings scaled for their layout profile.
+        '''
+        if size == self.settings.image_size:
+            return self
+
+        key = (size, self._settings_key(), self.geometry_key())
+        with self._layer_lock:
+            c = self._layouts.get(key)
+            if c is None:
+                settings = self.settings.scaled(self.settings.layout_scale(size))
+                c = LecroyColorizer(settings, self.engine, self.recon_backend, self.indexed)
+                self._layouts[key] = c
+        c.profile = self.profile
+        return c
+
+    def _read_capture(self, in_file, timer):
+        '''Read and validate a capture
+
+        1bpp BMP files are validated from their header and read directly into a
+        mask. Other files and images are validated from their histogram.
+        Returns the mode '1' mask and a ColorizeResult describing the source.
+        '''
+        sizes = self.settings.capture_sizes()
+        if isinstance(in_file, basestring):
+            mim = read_bmp_mask(in_file, None)
+            timer.mark('decode')
+            if mim is not None and mim.size not in sizes:
+                raise ValueError, 'Not a proper {0} black and white image'.format(_size_names(sizes))
+            if mim is not None:
+                self._count_frames()
+                return (mim, ColorizeResult(source_format='BMP', source_mode='1', size=mim.size, \
+                    validation='header'))
+
+        if isinstance(in_file, Image.Image):
+            src_im = in_file
+            # Masks are black and white by definition
+            if src_im.mode == '1' and src_im.size in sizes:
+                timer.mark('decode')
+                return (src_im, ColorizeResult(source_mode='1', size=src_im.size, validation='mode'))
+        else:
+            src_im = Image.open(in_file)
+            src_im.load()
+            self._count_frames()
+        result = ColorizeResult(source_format=src_im.format, source_mode=src_im.mode, size=src_im.size, \
+            validation='histogram')
+
+        im = src_im.convert('RGB')
+        self._count_frames()
+        timer.mark('decode')
+
+        # Validate the image to ensure it is from a 93xx scope
+        valid = True
+        if im.size not in sizes: valid = False
+        
+        # The histogram should have all values at 0 and 255 with nothing but 0's in between
+        red_hist = im.histogram()[:256]
+        for color in red_hist[1:255]:
+            if color != 0: valid = False
+            
+        if not valid:
+            raise ValueError, 'Not a proper {0} black and white image'.format(_size_names(sizes))
+
+        # The image is valid... proceed
+        mim = im.convert('1')
+        self._count_frames()
+        timer.mark('validate')
+        return (mim, result)
+
+    def _uses_labels(self):
+        '''Check if captures are rendered as label images'''
+        return self.engine in ('palette', 'banded') or self.indexed
+
+    def _capture_layers(self, analysis, layers):
+        '''Get the region and background layers with the boxes of a capture painted on them'''
+        if self._uses_labels():
+            m, bg_im = self._label_layers(layers, analysis.grid_name)
+            fill = self._labels.__getitem__
+        else:
+            m, bg_im, fill = layers.regions, layers.background, self.settings.colors.__getitem__
+
+        # Paint the text and backgrounds for the channel and menu boxes over the static layers
+        if analysis.channel_boxes or analysis.menu_boxes:
+            m = m.copy()
+            bg_im = bg_im.copy()
+            self._count_frames(2)
+            self._paint_capture_boxes(m, bg_im, layers, analysis.channel_boxes, analysis.menu_boxes, fill)
+
+        return (m, bg_im)
+
+    def _render_composite(self, analysis, layers, no_reconstruct, timer):
+        '''Render a capture by compositing RGB layers'''
+        mim = analysis.mask
+        m, bg_im = self._capture_layers(analysis, layers)
+
+        # Remove the grid from the original image mask
+        chops = self._chops()
+        ol_mask = chops.subtract(chops.invert(mim), layers.grid_lines)
+
+        # Overlay the colorized regions over the background. Screening the regions onto
+        # the capture would leave them unchanged wherever the mask selects them so the
+        # capture itself isn't needed.
+        cim = Image.composite(m, bg_im, ol_mask)
+        self._count_frames()
+        timer.mark('composite')
+
+
+        if not no_reconstruct:
+            cim = self._reconstruct_trace(cim, layers, analysis)
+            timer.mark('reconstruct')
+
+        return cim
+
+    def _render_palette(self, analysis, layers, no_reconstruct, timer):
+        '''Render a capture as a map of color labels
+
+        Every output pixel is selected from one label image that is
+        converted to RGB with the style palette in a single step. Indexed
+        colorizers return the label image with a palette of the style colors.
+        '''
+        label_im = None
+        if analysis.labels is not None:
+            label_im = self._shared_labels(analysis, no_reconstruct, timer)
+        if label_im is None:
+            label_im = self._render_labels(analysis, layers, no_reconstruct, timer)
+
+        if self.indexed:
+            # Only store the colors that are used so that small palettes get fewer bits per pixel
+            label_im.putpalette(self._palette[:self._palette_size * 3])
+            timer.mark('palette')
+            return label_im
+
+        label_im.putpalette(self._palette)
+        cim = label_im.convert('RGB')
+        self._count_frames()
+        timer.mark('palette')
+        return cim
+
+    def _render_labels(self, analysis, layers, no_reconstruct, timer):
+        '''Render the label image of a capture'''
+        mim = analysis.mask
+        m, bg_im = self._capture_layers(analysis, layers)
+
+        # Region labels for the ink that isn't part of the grid, background labels everywhere else
+        chops = self._chops()
+        ol_mask = chops.subtract(chops.invert(mim), layers.grid_lines)
+        label_im = Image.composite(m, bg_im, ol_mask)
+        self._count_frames()
+        timer.mark('composite')
+
+        if not no_reconstruct:
+            recon = self._reconstruction(layers, analysis)
+            if self.recon_backend == 'sparse':
+                if recon:
+                    ImageDraw.Draw(label_im).point(recon, fill=self._labels['trace-reconstruction'])
+            else:
+                label_im.paste(self._labels['trace-reconstruction'], None, chops.invert(recon))
+            timer.mark('reconstruct')
+
+        return label_im
+
+    def _shared_labels(self, analysis, no_reconstruct, timer):
+        '''Get the label image of a capture from the labels shared by several styles
+
+        Styles that only differ in their colors paint the same areas. The
+        capture is rendered once with a label for every painted color name and
+        each style maps these to its own labels with a lookup table.
+        Returns None when the style has too many color names to share labels.
+        '''
+        if self._key_labels is None or self._key_labels[0] != self._layer_key:
+            s = self.settings
+            names = sorted(set(LABEL_COLORS).union(s.regions, s.opt_regions).intersection(s.colors))
+            if len(names) > 255:
+                return None
+            # Label 0 stays black for the ink outside of any region
+            settings = copy.copy(self.settings)
+            settings.colors = dict((k, (0, 0, i + 1)) for i, k in enumerate(names))
+            c = LecroyColorizer(settings, 'palette', self.recon_backend)
+            lut = [0] + [self._labels[k] for k in names] + [0] * (255 - len(names))
+            self._key_labels = (self._layer_key, c, lut)
+
+        _, c, lut = self._key_labels
+        key = (c._settings_key(), bool(no_reconstruct))
+        key_im = analysis.labels.get(key)
+        if key_im is None:
+            key_im = c._render_labels(analysis, c._static_layers(analysis.grid_name), no_reconstruct, timer)
+            analysis.labels[key] = key_im
+
+        label_im = key_im.point(lut)
+        self._count_frames()
+        timer.mark('composite')
+        return label_im
+
+    def _render_banded(self, analysis, layers, no_reconstruct, timer):
+        '''Render a capture by assembling the bands from _render_bands()'''
+        cim = Image.new('P' if self.indexed else 'RGB', analysis.mask.size)
+        self._count_frames()
+        if self.indexed:
+            cim.putpalette(self._palette[:self._palette_size * 3])
+        for y, band in self._render_bands(analysis, layers, no_reconstruct, timer):
+            cim.paste(band, (0, y))
+            timer.mark('assemble')
+        return cim
+
+    def _render_bands(self, analysis, layers, no_reconstruct, timer, band_height=BAND_HEIGHT):
+        '''Render a capture as labels in bands of rows
+
+        Only the images for one band are allocated at a time. The trace
+        reconstruction checks the grid line pixels of each band with one row
+        above and below for the neighbors and is skipped for bands outside the
+        grid boxes.
+        Yields the top row and the image of each band.
+        '''
+        mim = analysis.mask
+        width, height = mim.size
+        recon_fill = self._labels['trace-reconstruction']
+        grid_boxes = self.settings.grid_boxes[analysis.grid_name]
+        recon_top = min(b[1] for b in grid_boxes) if grid_boxes else height
+        recon_bottom = max(b[3] for b in grid_boxes) + 1 if grid_boxes else 0
+
+        for y0 in range(0, height, band_height):
+            y1 = min(y0 + band_height, height)
+            band_box = (0, y0, width, y1)
+            m, bg_im = self._paint_labels(analysis.grid_name, layers.grid_lines, y0, y1)
+            self._paint_band_boxes(m, bg_im, layers, analysis, y0, y1)
+
+            ol_mask = ImageChops.subtract(ImageChops.invert(mim.crop(band_box)), layers.grid_lines.crop(band_box))
+            label_im = Image.composite(m, bg_im, ol_mask)
+            timer.mark('composite')
+
+            if not no_reconstruct and y0 < recon_bottom and y1 > recon_top:
+                recon = self._reconstruction_band(layers, mim, analysis.grid_name, y0, y1)
+                if recon:
+                    ImageDraw.Draw(label_im).point(recon, fill=recon_fill)
+                timer.mark('reconstruct')
+
+            if self.indexed:
+                label_im.putpalette(self._palette[:self._palette_size * 3])
+            else:
+                label_im.putpalette(self._palette)
+                label_im = label_im.convert('RGB')
+            timer.mark('palette')
+            yield (y0, label_im)
+
+    def _paint_band_boxes(self, m, bg_im, layers, analysis, y0, y1):
+        '''Paint the channel and menu boxes that overlap a band of rows'''
+        def band_boxes(boxes):
+            return [_band_box(b, y0) for b in boxes if b[1] < y1 and b[3] >= y0]
+
+        channel_boxes = band_boxes(analysis.channel_boxes)
+        menu_boxes = band_boxes(analysis.menu_boxes)
+        if not channel_boxes and not menu_boxes:
+            return
+
+        # Grid lines in the coordinates of the band
+        band_layers = _StaticLayers()
+        band_layers.grid_lines = layers.grid_lines.crop((0, y0, m.size[0], y1))
+        band_layers.grid_bbox = band_layers.grid_lines.getbbox()
+        self._paint_capture_boxes(m, bg_im, band_layers, channel_boxes, menu_boxes, self._labels.__getitem__)
+
+    def crop_box(self, grid_name, crop):
+        '''Get the box in the image for a crop
+
+        crop is a box or 'grid' for the area around the grids.
+        '''
+        if crop == 'grid':
+            boxes = self.settings.grid_boxes[grid_name]
+            crop = (min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes) + 1, \
+                max(b[3] for b in boxes) + 1)
+
+        width, height = self.settings.image_size
+        box = (max(crop[0], 0), max(crop[1], 0), min(crop[2], width), min(crop[3], height))
+        if box[2] <= box[0] or box[3] <= box[1]:
+            raise ValueError, 'Crop box {0} is outside of the image'.format(crop)
+        return box
+
+    def _render_sampled(self, analysis, layers, crop, thumbnail, no_reconstruct, timer):
+        '''Render a crop of a capture or a thumbnail
+
+        The layers are sampled at the pixels a nearest neighbor resize of the
+        crop would use and everything else is skipped.
+        '''
+        box = self.crop_box(analysis.grid_name, crop if crop is not None else (0, 0) + analysis.mask.size)
+        size = (box[2] - box[0], box[3] - box[1])
+        if thumbnail is not None:
+            size = thumbnail_size(size, thumbnail)
+
+        m, bg_im, grid_lines, xs, ys = self._sampled_layers(layers, analysis.grid_name, box, size)
+        self._paint_sampled_boxes(m, bg_im, grid_lines, analysis, xs, ys)
+
+        ol_mask = ImageChops.subtract(ImageChops.invert(_sample_image(analysis.mask, box, size)), grid_lines)
+        im = Image.composite(m, bg_im, ol_mask)
+        timer.mark('composite')
+
+        grid_boxes = self.settings.grid_boxes[analysis.grid_name]
+        crosses_grid = any(b[0] < box[2] and b[2] >= box[0] and b[1] < box[3] and b[3] >= box[1] \
+            for b in grid_boxes)
+        if not no_reconstruct and crosses_grid:
+            if self._uses_labels():
+                fill = self._labels['trace-reconstruction']
+            else:
+                fill = self.settings.colors['trace-reconstruction']
+
+            recon = self._sampled_reconstruction(layers, analysis, xs, ys)
+
+            # Move the sampled points to their position in the image
+            x_pos = collections.defaultdict(list)
+            for u, x in enumerate(xs):
+                x_pos[x].append(u)
+            y_pos = collections.defaultdict(list)
+            for v, y in enumerate(ys):
+                y_pos[y].append(v)
+
+            points = []
+            for i in range(0, len(recon), 2):
+                for u in x_pos.get(recon[i], ()):
+                    for v in y_pos.get(recon[i + 1], ()):
+                        points.extend((u, v))
+            if points:
+                ImageDraw.Draw(im).point(points, fill=fill)
+            timer.mark('reconstruct')
+
+        if self._uses_labels():
+            if self.indexed:
+                im.putpalette(self._palette[:self._palette_size * 3])
+            else:
+                im.putpalette(self._palette)
+                im = im.convert('RGB')
+            timer.mark('palette')
+        return im
+
+    def _sampled_reconstruction(self, layers, analysis, xs, ys):
+        '''Find the reconstructed pixels at the sampled columns and rows
+
+        Only the grid line pixels that are sampled are tested, using the
+        sparse index whatever the backend is. The backends reconstruct the
+        same pixels so the output is unchanged. Returns a flat list of x, y
+        coordinates.
+        '''
+        if layers.recon_index is None:
+            layers.recon_index = self._build_recon_index(layers, analysis.grid_name)
+        points, neighbor_a, neighbor_b = layers.recon_index
+        mim = analysis.mask
+        width, height = mim.size
+
+        if _have_numpy():
+            cols = np.zeros(width, dtype=bool)
+            cols[xs] = True
+            rows = np.zeros(height, dtype=bool)
+            rows[ys] = True
+            sampled = cols[points[:, 0]] & rows[points[:, 1]]
+
+            # Read the neighbors from the packed mask rows
+            data = np.frombuffer(mim.tobytes(), dtype=np.uint8)
+            stride = (width + 7) // 8
+            def ink(n):
+                y, x = np.divmod(n, width)
+                return (data[y * stride + (x >> 3)] >> (7 - (x & 7))) & 1 == 0
+
+            hits = ink(neighbor_a[sampled]) & ink(neighbor_b[sampled])
+            return points[sampled][hits].ravel().tolist()
+
+        cols = set(xs)
+        rows = set(ys)
+        pixels = mim.load()
+        hits = []
+        for i in range(len(points)):
+            x, y = points[i]
+            if x in cols and y in rows:
+                a, b = neighbor_a[i], neighbor_b[i]
+                if not pixels[a % width, a // width] and not pixels[b % width, b // width]:
+                    hits.extend((x, y))
+        return hits
+
+    def _sampled_layers(self, layers, grid_name, box, size):
+        '''Get copies of the region, background, and grid line layers sampled for a crop
+
+        The samples are kept for the most recent crops since thumbnails
+        are usually made at the same size. Returns the layers and the
+        source positions of the columns and rows.
+        '''
+        key = (box, size)
+        samples = layers.samples.get(key)
+        if samples is None:
+            if self._uses_labels():
+                m, bg_im = self._label_layers(layers, grid_name)
+            else:
+                m, bg_im = layers.regions, layers.background
+
+            samples = (_sample_image(m, box, size), _sample_image(bg_im, box, size), \
+                _sample_image(layers.grid_lines, box, size), _nearest_samples(box[0], box[2] - box[0], size[0]), \
+                _nearest_samples(box[1], box[3] - box[1], size[1]))
+            if len(layers.samples) >= 8:
+                layers.samples.clear()
+            layers.samples[key] = samples
+
+        m, bg_im, grid_lines, xs, ys = samples
+        return (m.copy(), bg_im.copy(), grid_lines, xs, ys)
+
+    def _paint_sampled_boxes(self, m, bg_im, grid_lines, analysis, xs, ys):
+        '''Paint the channel and menu boxes on sampled layers
+
+        This matches _paint_capture_boxes() at the sampled positions.
+        '''
+        fill = self._labels.__getitem__ if self._uses_labels() else self.settings.colors.__getitem__
+
+        def sampled(rect):
+            # Sampled pixels inside a rectangle that includes its right and bottom edges
+            u0, u1 = bisect.bisect_left(xs, rect[0]), bisect.bisect_right(xs, rect[2])
+            v0, v1 = bisect.bisect_left(ys, rect[1]), bisect.bisect_right(ys, rect[3])
+            return (u0, v0, u1, v1) if u1 > u0 and v1 > v0 else None
+
+        m_drawer = ImageDraw.Draw(m)
+        for boxes, text in ((analysis.channel_boxes, 'channels-text'), (analysis.menu_boxes, 'menu-text')):
+            for box in boxes:
+                r = sampled(self._box_text_rect(box))
+                if r is not None:
+                    m_drawer.rectangle((r[0], r[1], r[2] - 1, r[3] - 1), fill=fill(text))
+        del m_drawer
+
+        for boxes, background in ((analysis.channel_boxes, 'channels-background'), \
+            (analysis.menu_boxes, 'menu-background')):
+            for box in boxes:
+                r = sampled(box)
+                if r is not None:
+                    bg_im.paste(fill(background), r)
+                    bg_im.paste(fill('grid'), r, grid_lines.crop(r))
+
+    def _render_region(self, analysis, capture_layers, layers, box, no_reconstruct):
+        '''Render part of a capture
+
+        capture_layers are the layers from _capture_layers(). Returns an
+        image of the box that matches the same area of a full render.
+        '''
+        m, bg_im = capture_layers
+        ol_mask = ImageChops.subtract(ImageChops.invert(analysis.mask.crop(box)), layers.grid_lines.crop(box))
+        im = Image.composite(m.crop(box), bg_im.crop(box), ol_mask)
+
+        if not no_reconstruct:
+            if self._uses_labels():
+                fill = self._labels['trace-reconstruction']
+            else:
+                fill = self.settings.colors['trace-reconstruction']
+
+            recon = self._reconstruction(layers, analysis)
+            if self.recon_backend == 'sparse':
+                # Move the points inside the box to the origin of the region
+                points = []
+                for i in range(0, len(recon), 2):
+                    x, y = recon[i], recon[i + 1]
+                    if box[0] <= x < box[2] and box[1] <= y < box[3]:
+                        points.extend((x - box[0], y - box[1]))
+                if points:
+                    ImageDraw.Draw(im).point(points, fill=fill)
+            else:
+                im.paste(fill, None, ImageChops.invert(recon.crop(box)))
+
+        if self._uses_labels():
+            if self.indexed:
+                im.putpalette(self._palette[:self._palette_size * 3])
+            else:
+                im.putpalette(self._palette)
+                im = im.convert('RGB')
+        return im
+
+    def sequence(self, no_reconstruct=False):
+        '''Create a ColorizerSequence for a series of captures'''
+        return ColorizerSequence(self, no_reconstruct)
+
+    def _settings_key(self):
+        '''Snapshot of the settings that the static layers are built from'''
+        s = self.settings
+        return (s.script_dir, tuple(sorted(s.colors.items())), tuple(sorted(s.regions.items())), \
+            tuple(sorted(s.opt_regions.items())), tuple(sorted(s.grids.items())), \
+            tuple(sorted(s.grid_boxes.items())), tuple(sorted(s.layout.items())), s.scale)
+
+    def _static_layers(self, grid_name):
+        '''Get the layers that only depend on the grid type and the style
+
+        The layers are built on first use and kept until the settings change.
+        '''
+        key = self._settings_key()
+        with self._layer_lock:
+            if key != self._layer_key:
+                self._layer_cache = {}
+                self._layer_key = key
+                self._build_palette()
+
+            layers = self._layer_cache.get(grid_name)
+            if layers is None:
+                layers = self._build_static_layers(grid_name)
+                self._layer_cache[grid_name] = layers
+
+        return layers
+
+    def _build_palette(self):
+        '''Assign a label to each distinct color in the style'''
+        # Label 0 is black for ink outside of any region
+        self._labels = {}
+        self._palette = [0, 0, 0]
+        color_labels = {(0, 0, 0): 0}
+        for key in sorted(self.settings.colors.keys()):
+            rgb = self.settings.colors[key]
+            if isinstance(rgb, basestring):
+                rgb = ImageColor.getcolor(rgb, 'RGB')
+            if rgb not in color_labels:
+                color_labels[rgb] = len(color_labels)
+                self._palette.extend(rgb)
+            self._labels[key] = color_labels[rgb]
+
+        self._palette_size = len(color_labels)
+        if self._palette_size > 256:
+            raise ValueError, 'Too many colors for the palette engine'
+
+        self._palette.extend([0] * (768 - len(self._palette)))
+
+    def _build_static_layers(self, grid_name):
+        '''Render the capture independent layers for a grid type'''
+        layers = _StaticLayers()
+        image_size = self.settings.image_size
+
+        # Get the grid mask
+        bundle = grid_mask_bundle(os.path.join(self.settings.script_dir, 'data'))
+        layers.gr_mask = self._scale_mask(bundle.get(self.settings.grids[grid_name][GRID_IMAGE]))
+        layers.grid_lines = ImageChops.invert(layers.gr_mask)
+        layers.grid_bbox = layers.grid_lines.getbbox()
+
+        if self.engine == 'banded': # The labels are painted for each band
+            return layers
+
+        if self._uses_labels():
+            layers.region_labels, layers.background_labels = \
+                self._paint_labels(grid_name, layers.grid_lines, 0, image_size[1])
+
+        else:
+            colors = self.settings.colors
+
+            # Colorize the regions around the perimeter
+            layers.regions = Image.new('RGB', image_size, (0, 0, 0))
+            self._paint_regions(layers.regions, grid_name, colors.__getitem__)
+
+            # Create the background image
+            bg_im = Image.new('RGB', image_size, colors['background'])
+            self._paint_grid_background(bg_im, grid_name, colors.__getitem__)
+
+            # Add the colored grid lines to the background
+            gline_im = Image.new('RGB', image_size, colors['grid'])
+            layers.background = Image.composite(bg_im, gline_im, layers.gr_mask)
+
+            layers.recon_color = Image.new('RGB', image_size, colors['trace-reconstruction'])
+
+        # Mask out the grid borders from the reconstruction
+        border = Image.new('1', image_size, 1)
+        border_drawer = ImageDraw.Draw(border)
+        for box in self.settings.grid_boxes[grid_name]:
+            border_drawer.rectangle(box, 0)
+        del border_drawer
+        layers.recon_border = border
+
+        return layers
+
+    def _paint_labels(self, grid_name, grid_lines, y0, y1):
+        '''Paint the region and background labels for a band of rows
+
+        Returns the region and background label images for the band.
+        '''
+        width = self.settings.image_size[0]
+        fill = self._labels.__getitem__
+        region_labels = Image.new('L', (width, y1 - y0), 0)
+        self._paint_regions(region_labels, grid_name, fill, y0)
+
+        bg_im = Image.new('L', (width, y1 - y0), fill('background'))
+        self._paint_grid_background(bg_im, grid_name, fill, y0)
+        bg_im.paste(fill('grid'), None, _crop_rows(grid_lines, y0, y1))
+        return (region_labels, bg_im)
+
+    def _label_layers(self, layers, grid_name):
+        '''Get the full frame region and background labels
+
+        The banded engine only builds these for crops, thumbnails, sequences,
+        and persistence images.
+        '''
+        with self._layer_lock:
+            if layers.region_labels is None:
+                layers.region_labels, layers.background_labels = \
+                    self._paint_labels(grid_name, layers.grid_lines, 0, self.settings.image_size[1])
+        return (layers.region_labels, layers.background_labels)
+
+    def _scale_mask(self, mask):
+        '''Scale a grid mask to the layout of the settings'''
+        image_size = self.settings.image_size
+        if mask.size == image_size:
+            return mask
+
+        scale = self.settings.scale
+        if (mask.size[0] * scale, mask.size[1] * scale) != image_size:
+            raise ValueError, 'Grid mask is not {0}x{1}'.format(*image_size)
+        return mask.resize(image_size, Image.NEAREST)
+
+    def _paint_regions(self, m, grid_name, fill, y0=0):
+        '''Paint the fills for the ink in each region of the screen
+
+        fill maps a color name to the value painted for it. y0 is the row of
+        the image at the top of m.
+        '''
+        m_drawer = ImageDraw.Draw(m)
+        for key, box in self.settings.regions.items():
+            m_drawer.rectangle(_band_box(box, y0), fill=fill(key))
+
+        # Colorize additional regions for special grids
+        opt_regions = self.settings.opt_regions
+        if grid_name == 'param':
+            m_drawer.rectangle(_band_box(opt_regions['parameters'], y0), fill=fill('parameters'))
+            m_drawer.rectangle(_band_box(opt_regions['parameters-span'], y0), fill=fill('parameters-span'))
+        elif grid_name[0:2] == 'xy':
+            m_drawer.rectangle(_band_box(opt_regions['xy-cursors'], y0), fill=fill('xy-cursors'))
+            
+        # Find the bottommost grid so we can colorize the strip where the trigger delay marker
+        # appears.
+        max_y = 0
+        for box in self.settings.grid_boxes[grid_name]:
+            if box[3] > max_y:
+                max_y = box[3]
+
+        layout = self.settings.layout
+        scale = self.settings.scale
+        if grid_name == 'xy':
+            delay_box_height = layout['xy-delay-box-height']
+        else:
+            delay_box_height = layout['delay-box-height']
+        delay_box = (self.settings.regions['left-marker'][0], max_y - scale + 1, \
+            self.settings.regions['right-marker'][2], max_y + delay_box_height * scale)
+        m_drawer.rectangle(_band_box(delay_box, y0), fill=fill('left-marker'))
+
+        # Colorize the traces
+        for box in self.settings.grid_boxes[grid_name]:
+            m_drawer.rectangle(_band_box(box, y0), fill=fill('trace'))
+
+        del m_drawer
+
+    def _paint_grid_background(self, bg_im, grid_name, fill, y0=0):
+        '''Paint the grid backgrounds'''
+        bg_im_drawer = ImageDraw.Draw(bg_im)
+        for box in self.settings.grid_boxes[grid_name]:
+            bg_im_drawer.rectangle(_band_box(box, y0), fill=fill('grid-background'))
+        del bg_im_drawer
+
+    def _paint_capture_boxes(self, m, bg_im, layers, channel_boxes, menu_boxes, fill):
+        '''Paint the text and background for the channel and menu boxes in a capture'''
+        m_drawer = ImageDraw.Draw(m)
+        for box in channel_boxes:
+            m_drawer.rectangle(self._box_text_rect(box), fill=fill('channels-text'))
+
+        for box in menu_boxes:
+            m_drawer.rectangle(self._box_text_rect(box), fill=fill('menu-text'))
+        del m_drawer
+
+        for box in channel_boxes:
+            self._fill_background_box(bg_im, layers, box, fill('channels-background'), fill('grid'))
+        for box in menu_boxes:
+            self._fill_background_box(bg_im, layers, box, fill('menu-background'), fill('grid'))
+
+    def _box_text_rect(self, box):
+        '''Get the text area of a channel or menu box below its title bar'''
+        scale = self.settings.scale
+        return (box[0] + scale, box[1] + self.settings.layout['box-text-offset'] * scale, box[2] - scale, \
+            box[3] - scale)
+
+    def _fill_background_box(self, bg_im, layers, box, color, grid_color):
+        '''Fill a box on the background while keeping any grid lines on top'''
+        bg_im.paste(color, (box[0], box[1], box[2] + 1, box[3] + 1))
+
+        bb = layers.grid_bbox
+        if bb is not None and box[0] < bb[2] and box[2] >= bb[0] and box[1] < bb[3] and box[3] >= bb[1]:
+            grid_box = (box[0], box[1], box[2] + 1, box[3] + 1)
+            bg_im.paste(grid_color, grid_box, layers.grid_lines.crop(grid_box))
+
+    def _find_boxes(self, mim):
+        '''Scan down a 1-pixel wide column to find the channel and menu box regions
+
+        The boxes are kept for the contents of the columns so that captures with
+        the same channel and menu layout skip the search.
+        '''
+        channel_box_column = self.settings.box_detection['channel-box-column']
+        menu_box_column = self.settings.box_detection['menu-box-column']
+        layout = self.settings.layout
+        scale = self.settings.scale
+        
+        # Extract 1-pixel wide columns from mask image
+        channel_box_data = _column_bytes(mim, channel_box_column)
+        menu_box_data = _column_bytes(mim, menu_box_column)
+
+        key = (channel_box_column, menu_box_column, layout['channel-box-width'], layout['menu-box-width'], \
+            layout['min-box-height'], scale, channel_box_data, menu_box_data)
+        boxes = self._box_layouts.get(key)
+        if boxes is not None:
+            return (list(boxes[0]), list(boxes[1]))
+
+        channel_box_edges = self._find_box_edges(channel_box_data, channel_box_column[1])
+        channel_boxes = []
+        for edge in channel_box_edges:
+            box = (channel_box_column[0] + scale, edge[0], \
+                channel_box_column[0] + (layout['channel-box-width'] + 1) * scale - 1, edge[1])
+            channel_boxes.append(box)
+
+        menu_box_edges = self._find_box_edges(menu_box_data, menu_box_column[1])
+        menu_boxes = []
+        for edge in menu_box_edges:
+            box = (menu_box_column[0] + scale, edge[0], \
+                menu_box_column[0] + (layout['menu-box-width'] + 1) * scale - 1, edge[1])
+            menu_boxes.append(box)
+
+        if len(self._box_layouts) >= MAX_BOX_LAYOUTS:
+            self._box_layouts.clear()
+        self._box_layouts[key] = (tuple(channel_boxes), tuple(menu_boxes))
+        
+        return (channel_boxes, menu_boxes)
+
+            
+    def _find_box_edges(self, column_data, y_offset):
+        '''Search a column for continuous spans of dark pixels signifying the edge of a box
+
+        column_data is the column as bytes with 0 for dark pixels.
+        '''
+        scale = self.settings.scale
+        min_height = self.settings.layout['min-box-height'] * scale
+        box_edges = []
+        for run in re.finditer(b'\x00+', column_data):
+            # A span that runs off the end of the column isn't closed by the box border
+            if run.end() == len(column_data):
+                break
+            # The XY grid cursors have pixels in the same column we're testing for channel box edges
+            # Remove any edge that is too short to be a real box
+            if run.end() - run.start() > min_height: # Must be taller than the minimum box height
+                box_edges.append((run.start() + y_offset - scale, run.end() + y_offset + scale - 1))
+        return box_edges
+        
+    def _reconstruct_trace(self, cim, layers, analysis):
+        '''Reconstruct the trace portions covered by the grid'''
+        recon = self._reconstruction(layers, analysis)
+        timer = _StageTimer()
+        if self.recon_backend == 'sparse':
+            # Color the reconstructed pixels in place
+            if recon:
+                ImageDraw.Draw(cim).point(recon, fill=self.settings.colors['trace-reconstruction'])
+        else:
+            # Composite the reconstructed trac segments onto the colorized image
+            cim = self._chops().composite(cim, layers.recon_color, recon)
+        timer.mark('paint')
+        self._add_recon_timings(timer.timings)
+        return cim
+
+    def _reconstruction(self, layers, analysis):
+        '''Get the reconstructed pixels for an analyzed capture
+
+        The result only depends on the grid geometry so it is kept in the
+        analysis for other styles. Returns a list of points for the sparse
+        backend and a mask for the others.
+        '''
+        grid_name = analysis.grid_name
+        key = (self.recon_backend, self.settings.grids[grid_name][GRID_IMAGE], \
+            tuple(self.settings.grid_boxes[grid_name]))
+        recon = analysis.reconstruction.get(key)
+        if recon is None:
+            timer = _StageTimer()
+            if self.recon_backend == 'sparse':
+                recon = self._reconstruction_points(analysis.mask, grid_name, timer)
+            else:
+                recon = self._reconstruction_mask(layers.gr_mask, analysis.mask, grid_name, timer)
+            analysis.reconstruction[key] = recon
+            if self.profile is not None:
+                self.profile.add_timings({'reconstruct-' + self.recon_backend: sum(timer.timings.values())})
+                self._add_recon_timings(timer.timings)
+        return recon
+
+    def _reconstruction_mask(self, gr_mask, mim, grid_name, timer=None):
+        '''Find the grid line pixels covering a trace
+
+        The time of each stage is recorded in timer when it is a _StageTimer.
+        Returns a mask with the reconstructed pixels set to 0.
+        '''
+        if timer is None:
+            timer = _StageTimer()
+
+        if self.recon_backend == 'sparse':
+            points = self._reconstruction_points(mim, grid_name, timer)
+            recon = Image.new('1', mim.size, 255)
+            self._count_frames()
+            if points:
+                ImageDraw.Draw(recon).point(points, fill=0)
+            timer.mark('draw')
+            return recon
+
+        if self.recon_backend == 'numpy':
+            return self._reconstruction_mask_numpy(gr_mask, mim, grid_name, timer)
+
+        return self._reconstruction_mask_pil(gr_mask, mim, grid_name, timer)
+
+    def _reconstruction_points(self, mim, grid_name, timer=None):
+        '''Find the reconstructed pixels by checking only the grid lines
+
+        Returns a flat list of x, y coordinates.
+        '''
+        if timer is None:
+            timer = _StageTimer()
+
+        layers = self._static_layers(grid_name)
+        if layers.recon_index is None:
+            layers.recon_index = self._build_recon_index(layers, grid_name)
+        points, neighbor_a, neighbor_b = layers.recon_index
+        timer.mark('index')
+
+        # A grid line pixel is reconstructed when the trace is on both sides
+        if _have_numpy():
+            ink = _mask_to_array(mim).ravel()
+            self._count_frames()
+            ink = ~ink
+            self._count_frames()
+            timer.mark('arrays')
+            hits = ink[neighbor_a] & ink[neighbor_b]
+            hits = points[hits].ravel().tolist()
+            timer.mark('neighbors')
+            return hits
+
+        pixels = mim.convert('L')
+        self._count_frames()
+        pixels = bytearray(pixels.tobytes())
+        self._count_frames()
+        timer.mark('arrays')
+        hits = []
+        for i in range(len(neighbor_a)):
+            if not pixels[neighbor_a[i]] and not pixels[neighbor_b[i]]:
+                hits.extend(points[i])
+        timer.mark('neighbors')
+        return hits
+
+    def _build_recon_index(self, layers, grid_name):
+        '''Index the grid line pixels inside the grid boxes
+
+        Each pixel is classified as part of a horizontal line, a vertical
+        line, or a crossing using the same tests as the full frame
+        reconstruction. The pair of neighbors that must both be trace
+        pixels is recorded for each one.
+
+        Returns the pixel coordinates and the flat indices of their neighbors.
+        '''
+        gr_mask = layers.gr_mask
+        width, height = gr_mask.size
+        s = self.settings.scale # Grid lines are s pixels wide
+
+        # Neighbor offsets for each kind of pixel. Neighbors wrap around the edge
+        # of the frame to match ImageChops.offset().
+        offsets = {
+            RECON_HORIZ: ((0, -s), (0, s)),
+            RECON_VERT: ((-s, 0), (s, 0)),
+            RECON_CROSS: ((s, s), (-s, -s))
+        }
+
+        if _have_numpy():
+            return self._build_recon_index_numpy(layers, grid_name, offsets)
+
+        # Horizontal and vertical grid line pixels are 0
+        h_grm = ImageChops.logical_and(ImageChops.add(ImageChops.offset(gr_mask, s, 0), gr_mask), \
+            ImageChops.add(ImageChops.offset(gr_mask, -s, 0), gr_mask))
+        v_grm = ImageChops.logical_and(ImageChops.add(ImageChops.offset(gr_mask, 0, s), gr_mask), \
+            ImageChops.add(ImageChops.offset(gr_mask, 0, -s), gr_mask))
+
+        in_boxes = Image.new('1', gr_mask.size, 0)
+        in_boxes_drawer = ImageDraw.Draw(in_boxes)
+        for box in self.settings.grid_boxes[grid_name]:
+            in_boxes_drawer.rectangle(box, 255)
+        del in_boxes_drawer
+
+        kinds = [
+            (RECON_HORIZ, ImageChops.logical_and(ImageChops.invert(h_grm), v_grm)),
+            (RECON_VERT, ImageChops.logical_and(ImageChops.invert(v_grm), h_grm)),
+            (RECON_CROSS, ImageChops.logical_and(ImageChops.invert(h_grm), ImageChops.invert(v_grm)))
+        ]
+
+        points = []
+        neighbor_a = []
+        neighbor_b = []
+        for kind, kind_mask in kinds:
+            data = ImageChops.logical_and(kind_mask, in_boxes).convert('L').tobytes()
+            (ax, ay), (bx, by) = offsets[kind]
+            for run in re.finditer(b'[^\x00]+', data):
+                for i in range(run.start(), run.end()):
+                    y, x = divmod(i, width)
+                    points.append((x, y))
+                    neighbor_a.append(((y + ay) % height) * width + (x + ax) % width)
+                    neighbor_b.append(((y + by) % height) * width + (x + bx) % width)
+
+        return (points, neighbor_a, neighbor_b)
+
+    def _build_recon_index_numpy(self, layers, grid_name, offsets):
+        '''Index the grid line pixels inside the grid boxes with boolean arrays'''
+        if layers.gr_array is None:
+            layers.gr_array = _mask_to_array(layers.gr_mask)
+        g = layers.gr_array
+        height, width = g.shape
+        s = self.settings.scale
+
+        # Horizontal and vertical grid line pixels are False
+        h_grm = g | (np.roll(g, s, axis=1) & np.roll(g, -s, axis=1))
+        v_grm = g | (np.roll(g, s, axis=0) & np.roll(g, -s, axis=0))
+
+        in_boxes = np.zeros(g.shape, dtype=bool)
+        for box in self.settings.grid_boxes[grid_name]:
+            in_boxes[max(box[1], 0):max(box[3] + 1, 0), max(box[0], 0):max(box[2] + 1, 0)] = True
+
+        kinds = [
+            (RECON_HORIZ, ~h_grm & v_grm),
+            (RECON_VERT, ~v_grm & h_grm),
+            (RECON_CROSS, ~h_grm & ~v_grm)
+        ]
+
+        points = []
+        neighbor_a = []
+        neighbor_b = []
+        for kind, kind_mask in kinds:
+            y, x = np.nonzero(kind_mask & in_boxes)
+            (ax, ay), (bx, by) = offsets[kind]
+            points.append(np.column_stack((x, y)))
+            neighbor_a.append(((y + ay) % height) * width + (x + ax) % width)
+            neighbor_b.append(((y + by) % height) * width + (x + bx) % width)
+
+        return (np.concatenate(points).astype(np.intp), np.concatenate(neighbor_a).astype(np.intp), \
+            np.concatenate(neighbor_b).astype(np.intp))
+
+    def _reconstruction_band(self, layers, mim, grid_name, y0, y1):
+        '''Find the reconstructed pixels in a band of rows
+
+        Only the band and the rows above and below for the neighbor tests
+        are read from the mask. Returns a flat list of x, y coordinates
+        relative to the top of the band.
+        '''
+        points, neighbor_a, neighbor_b = self._band_recon_index(layers, grid_name, y0, y1)
+        s = self.settings.scale
+        pixels = _crop_rows(mim, y0 - s, y1 + s).convert('L').tobytes()
+
+        if _have_numpy():
+            ink = np.frombuffer(pixels, dtype=np.uint8) == 0
+            hits = ink[neighbor_a] & ink[neighbor_b]
+            return points[hits].ravel().tolist()
+
+        pixels = bytearray(pixels)
+        hits = []
+        for i in range(len(neighbor_a)):
+            if not pixels[neighbor_a[i]] and not pixels[neighbor_b[i]]:
+                hits.extend(points[i])
+        return hits
+
+    def _band_recon_index(self, layers, grid_name, y0, y1):
+        '''Get the part of the sparse reconstruction index for a band of rows
+
+        The points are relative to the band and the neighbors are indices into
+        the band with the rows above and below.
+        '''
+        if layers.recon_index is None:
+            layers.recon_index = self._build_recon_index(layers, grid_name)
+        index = layers.band_index.get((y0, y1))
+        if index is not None:
+            return index
+
+        width, height = layers.gr_mask.size
+        s = self.settings.scale
+        all_points, all_a, all_b = layers.recon_index
+
+        if _have_numpy():
+            in_band = (all_points[:, 1] >= y0) & (all_points[:, 1] < y1)
+            points = all_points[in_band] - (0, y0)
+            # Neighbors above the first row and below the last wrap into the halo rows
+            ya, xa = np.divmod(all_a[in_band], width)
+            yb, xb = np.divmod(all_b[in_band], width)
+            index = (points, ((ya - y0 + s) % height) * width + xa, ((yb - y0 + s) % height) * width + xb)
+            layers.band_index[(y0, y1)] = index
+            return index
+
+        def band_offset(n):
+            # Neighbors above the first row and below the last wrap into the halo rows
+            y, x = divmod(n, width)
+            return ((y - y0 + s) % height) * width + x
+
+        points = []
+        neighbor_a = []
+        neighbor_b = []
+        for i in range(len(all_points)):
+            x, y = all_points[i]
+            if y0 <= y < y1:
+                points.append((x, y - y0))
+                neighbor_a.append(band_offset(all_a[i]))
+                neighbor_b.append(band_offset(all_b[i]))
+
+        index = (points, neighbor_a, neighbor_b)
+        layers.band_index[(y0, y1)] = index
+        return index
+
+    def _reconstruction_mask_numpy(self, gr_mask, mim, grid_name, timer=None):
+        '''Find the reconstructed pixels with boolean arrays
+
+        This performs the same neighbor tests as the Pillow implementation
+        but only inside the grid boxes.
+        '''
+        if timer is None:
+            timer = _StageTimer()
+
+        layers = self._static_layers(grid_name)
+        if layers.gr_array is None:
+            layers.gr_array = _mask_to_array(gr_mask)
+        g = layers.gr_array
+        mk = _mask_to_array(mim)
+        self._count_frames()
+
+        height, width = mk.shape
+        s = self.settings.scale
+        recon = np.ones(mk.shape, dtype=bool)
+        self._count_frames()
+        timer.mark('arrays')
+        for box in self.settings.grid_boxes[grid_name]:
+            x0, y0 = max(box[0], 0), max(box[1], 0)
+            x1, y1 = min(box[2], width - 1), min(box[3], height - 1)
+            if x1 < x0 or y1 < y0:
+                continue
+
+            # Take the box with a halo as wide as the grid lines. Neighbors wrap around the
+            # edge of the frame to match ImageChops.offset().
+            rows = np.arange(y0 - s, y1 + s + 1) % height
+            cols = np.arange(x0 - s, x1 + s + 1) % width
+            bg = g[np.ix_(rows, cols)]
+            bm = mk[np.ix_(rows, cols)]
+            c = slice(s, -s) # The box without the halo
+            lo = slice(None, -2 * s) # Shifted up or left
+            hi = slice(2 * s, None) # Shifted down or right
+
+            # Horizontal and vertical grid line pixels are False
+            h_grm = bg[c, c] | (bg[c, lo] & bg[c, hi])
+            v_grm = bg[c, c] | (bg[lo, c] & bg[hi, c])
+
+            # Horizontal lines bounded by trace pixels above and below
+            h_mim = bm[lo, c] | bm[hi, c] | ~v_grm | h_grm
+            # Vertical lines bounded by trace pixels left and right
+            v_mim = bm[c, lo] | bm[c, hi] | ~h_grm | v_grm
+            # Cross points with trace pixels in the upper left and lower right corners
+            d_mim = bm[lo, lo] | bm[hi, hi] | h_grm | v_grm
+
+            recon[y0:y1 + 1, x0:x1 + 1] = h_mim & v_mim & d_mim
+        timer.mark('neighbors')
+
+        recon = _array_to_mask(recon)
+        self._count_frames()
+        timer.mark('mask')
+        return recon
+
+    def _reconstruction_mask_pil(self, gr_mask, mim, grid_name, timer=None):
+        '''Find the reconstructed pixels with Pillow image operations'''
+        if timer is None:
+            timer = _StageTimer()
+        chops = self._chops() # Every operation allocates a new frame
+        s = self.settings.scale # Grid lines are s pixels wide
+        
+        # Isolate the horizontal lines in the grid
+        # Shift the grid mask left and right
+        sl_grm = chops.offset(gr_mask, -s, 0)
+        sr_grm = chops.offset(gr_mask, s, 0)
+        
+        h_grm = chops.logical_and(chops.add(sr_grm, gr_mask), chops.add(sl_grm, gr_mask))
+
+        # Isolate the vertical  lines in the grid
+        # Shift the grid mask up and down
+        su_grm = chops.offset(gr_mask, 0, -s)
+        sd_grm = chops.offset(gr_mask, 0, s)
+        
+        v_grm = chops.logical_and(chops.add(sd_grm, gr_mask), chops.add(su_grm, gr_mask))
+        timer.mark('grid-lines')
+
+        # Find where a horizontal grid line is bounded by trace pixels above and below
+        su_mim = chops.offset(mim, 0, -s)
+        sd_mim = chops.offset(mim, 0, s)
+        h_mim = chops.logical_or(su_mim, sd_mim)
+        h_mim = chops.logical_or(h_mim, chops.logical_or(chops.invert(v_grm), h_grm))
+
+        # Find where a vertical grid line is bounded by trace pixels left and right
+        sl_mim = chops.offset(mim, -s, 0)
+        sr_mim = chops.offset(mim, s, 0)
+        v_mim = chops.logical_or(sl_mim, sr_mim)
+        v_mim = chops.logical_or(v_mim, chops.logical_or(chops.invert(h_grm), v_grm))
+
+        # Fill in cross points of horiz. and vert. lines if upper left and lower right corners have
+        # pixels from a trace
+        sul_mim = chops.offset(mim, -s, -s)
+        sdr_mim = chops.offset(mim, s, s)
+        d_mim = chops.logical_or(sul_mim, sdr_mim)
+        d_mim = chops.logical_or(d_mim, chops.logical_or(h_grm, v_grm))
+        
+        recon = chops.logical_and(h_mim, v_mim)
+        recon = chops.logical_and(recon, d_mim)
+        timer.mark('neighbors')
+
+        # Mask out the grid borders from the reconstruction
+        layers = self._static_layers(grid_name)
+        recon = chops.logical_or(recon, layers.recon_border)
+        timer.mark('border')
+        return recon
+    
+class ColorizerSequence(object):
+    '''Colorize a sequence of captures by only rendering what changed
+
+    The mask and output of the previous capture are kept. The rows of the
+    new mask are compared against the previous one in bands and only the
+    changed areas are rendered again with a halo for the trace
+    reconstruction. A full render is used for the first capture and when the
+    grid, the channel and menu boxes, or the settings change.
+    '''
+    def __init__(self, colorizer, no_reconstruct=False, band_height=16):
+        self.colorizer = colorizer
+        self.no_reconstruct = no_reconstruct
+        self.band_height = band_height
+        self.full_renders = 0
+        self.partial_renders = 0
+        self.reset()
+
+    def reset(self):
+        '''Forget the previous capture so the next one is fully rendered'''
+        self._analysis = None
+        self._capture_layers = None
+        self._image = None
+        self._settings_key = None
+
+    def colorize(self, in_file):
+        '''Colorize the next capture in the sequence
+
+        Returns a ColorizeResult that is identical to colorize().
+        '''
+        analysis = self.colorizer.analyze(in_file)
+        c = self.colorizer._layout_colorizer(analysis.mask.size)
+        prev = self._analysis
+        settings_key = c._settings_key()
+
+        if prev is None or settings_key != self._settings_key or analysis.grid_name != prev.grid_name or \
+            analysis.mask.size != prev.mask.size or analysis.channel_boxes != prev.channel_boxes or \
+            analysis.menu_boxes != prev.menu_boxes:
+
+            result = c.render(analysis, self.no_reconstruct)
+            self._analysis = analysis
+            self._capture_layers = c._capture_layers(analysis, c._static_layers(analysis.grid_name))
+            self._image = result.image.copy()
+            self._settings_key = settings_key
+            self.full_renders += 1
+            return result
+
+        timer = _StageTimer()
+        layers = c._static_layers(analysis.grid_name)
+        for box in self._dirty_boxes(prev.mask, analysis.mask, c.settings.scale):
+            region = c._render_region(analysis, self._capture_layers, layers, box, self.no_reconstruct)
+            self._image.paste(region, box[:2])
+        timer.mark('incremental')
+
+        self._analysis = analysis
+        self.partial_renders += 1
+        return analysis.rendered(self._image.copy(), timer.timings)
+
+    def _dirty_boxes(self, prev_mask, mask, halo=1):
+        '''Find the boxes around the changed pixels
+
+        Adjacent bands of rows with changes are merged into a single box. The
+        halo is the width of the grid lines in the layout of the capture.
+        '''
+        diff = ImageChops.logical_xor(prev_mask, mask)
+        width, height = mask.size
+
+        boxes = []
+        cur = None
+        for y in range(0, height, self.band_height):
+            bb = diff.crop((0, y, width, min(y + self.band_height, height))).getbbox()
+            if bb is None:
+                if cur is not None:
+                    boxes.append(cur)
+                    cur = None
+                continue
+
+            # Expand by the halo for the reconstruction neighbors
+            bb = (max(bb[0] - halo, 0), max(bb[1] + y - halo, 0), min(bb[2] + halo, width), \
+                min(bb[3] + y + halo, height))
+            if cur is None:
+                cur = bb
+            else:
+                cur = (min(cur[0], bb[0]), cur[1], max(cur[2], bb[2]), bb[3])
+
+        if cur is not None:
+            boxes.append(cur)
+        return boxes
+
+
+# Default color ramp for persistence images from the fewest to the most hits
+PERSISTENCE_RAMP = ('blue', 'cyan', 'lime', 'yellow', 'red')
+PERSISTENCE_SCALES = ('log', 'linear')
+
+class PersistenceMap(object):
+    '''Number of captures that had trace pixels at each position
+
+    Counts are kept in a NumPy array when available or a Pillow mode 'I'
+    image otherwise. Maps are picklable and can be merged so that partial
+    results from several workers can be combined.
+    '''
+    def __init__(self, size=IMAGE_SIZE):
+        self.size = size
+        self.grid_name = None
+        self.frames = 0
+        if _have_numpy():
+            self.counts = np.zeros((size[1], size[0]), dtype=np.uint32)
+        else:
+            self.counts = Image.new('I', size, 0)
+
+    def check_grid(self, grid_name):
+        '''Make sure all captures use the same grid'''
+        if self.grid_name is None:
+            self.grid_name = grid_name
+        elif grid_name is not None and grid_name != self.grid_name:
+            raise ValueError, 'Capture grid ({0}) does not match the persistence grid ({1})'.format( \
+                grid_name, self.grid_name)
+
+    def check_size(self, size):
+        '''Make sure all captures are the same size'''
+        if tuple(size) != tuple(self.size):
+            raise ValueError, 'Capture size ({0[0]}x{0[1]}) does not match the persistence size ' \
+                '({1[0]}x{1[1]})'.format(size, self.size)
+
+    def merge(self, other):
+        '''Add the counts from another map'''
+        if other.frames == 0 and other.grid_name is None:
+            return
+        if self.frames == 0 and self.grid_name is None:
+            # Take on the size of the first map with captures
+            self.size = other.size
+            self.counts = other.counts.copy()
+            self.grid_name = other.grid_name
+            self.frames = other.frames
+            return
+
+        self.check_grid(other.grid_name)
+        self.check_size(other.size)
+        if isinstance(self.counts, Image.Image) or isinstance(other.counts, Image.Image):
+            self.counts = ImageMath.eval('a + b', a=self._counts_image(), b=other._counts_image())
+        else:
+            self.counts += other.counts
+        self.frames += other.frames
+
+    def _counts_image(self):
+        if isinstance(self.counts, Image.Image):
+            return self.counts
+        return Image.frombytes('I', self.size, self.counts.astype(np.int32).tobytes())
+
+    def levels(self, scale='log'):
+        '''Convert the counts to a mode 'L' image
+
+        Positions without any hits are 0 and the counts are scaled to 1-255.
+        '''
+        if scale not in PERSISTENCE_SCALES:
+            raise ValueError, 'Unknown persistence scale: {0}'.format(scale)
+
+        if isinstance(self.counts, Image.Image):
+            counts = list(self.counts.getdata())
+            max_count = max(counts)
+            if max_count == 0:
+                return Image.new('L', self.size, 0)
+            if scale == 'log':
+                k = 254.0 / math.log1p(max_count)
+                level = [1 + int(math.log1p(c) * k + 0.5) if c else 0 for c in counts]
+            else:
+                k = 254.0 / max_count
+                level = [1 + int(c * k + 0.5) if c else 0 for c in counts]
+            return Image.frombytes('L', self.size, bytes(bytearray(level)))
+
+        max_count = int(self.counts.max())
+        if max_count == 0:
+            return Image.new('L', self.size, 0)
+        hit = self.counts > 0
+        if scale == 'log':
+            f = np.log1p(self.counts[hit]) / math.log1p(max_count)
+        else:
+            f = self.counts[hit] / float(max_count)
+        level = np.zeros(self.counts.shape, dtype=np.uint8)
+        level[hit] = 1 + np.round(f * 254.0).astype(np.uint8)
+        return Image.frombytes('L', self.size, level.tobytes())
+
+
+class PersistenceAccumulator(object):
+    '''Accumulate the trace pixels of many captures into a persistence image
+
+    Captures are validated and their grids identified by the colorizer. The
+    trace pixels inside the grid boxes, including reconstructed pixels, are
+    added to a PersistenceMap without keeping any of the captures.
+
+    grid_name and size fix the grid and the capture size. Otherwise they are
+    taken from the first capture that is added.
+    '''
+    def __init__(self, colorizer, no_reconstruct=False, grid_name=None, size=None):
+        self.colorizer = colorizer
+        self.no_reconstruct = no_reconstruct
+        self.persistence = PersistenceMap(size if size is not None else colorizer.settings.image_size)
+        self.persistence.grid_name = grid_name
+        self._box_slices = None
+        self._box_mask = None
+
+    def add(self, in_file):
+        '''Add a capture to the counts'''
+        analysis = self.colorizer.analyze(in_file)
+        c = self.colorizer._layout_colorizer(analysis.mask.size)
+        p = self.persistence
+        if p.frames == 0 and p.grid_name is None and p.size != analysis.mask.size:
+            # Start over with a map for the layout of the first capture
+            p = self.persistence = PersistenceMap(analysis.mask.size)
+            self._box_slices = None
+            self._box_mask = None
+        p.check_grid(analysis.grid_name)
+        p.check_size(analysis.mask.size)
+        layers = c._static_layers(analysis.grid_name)
+
+        if isinstance(p.counts, Image.Image):
+            self._add_image(c, analysis, layers)
+        else:
+            self._add_array(c, analysis, layers)
+        p.frames += 1
+
+    def merge(self, persistence):
+        '''Add a partial PersistenceMap from another accumulator'''
+        self.persistence.merge(persistence)
+
+    def _add_array(self, c, analysis, layers):
+        if layers.gr_array is None:
+            layers.gr_array = _mask_to_array(layers.gr_mask)
+        if self._box_slices is None:
+            width, height = self.persistence.size
+            self._box_slices = [(slice(max(b[1], 0), min(b[3] + 1, height)), slice(max(b[0], 0), \
+                min(b[2] + 1, width))) for b in c.settings.grid_boxes[analysis.grid_name]]
+
+        # Trace pixels are ink that isn't on a grid line
+        trace = ~_mask_to_array(analysis.mask)
+        trace &= layers.gr_array
+
+        if not self.no_reconstruct:
+            recon = c._reconstruction(layers, analysis)
+            if c.recon_backend == 'sparse':
+                if recon:
+                    points = np.array(recon, dtype=np.intp).reshape(-1, 2)
+                    trace[points[:, 1], points[:, 0]] = True
+            else:
+                trace |= ~_mask_to_array(recon)
+
+        counts = self.persistence.counts
+        for rows, cols in self._box_slices:
+            counts[rows, cols] += trace[rows, cols]
+
+    def _add_image(self, c, analysis, layers):
+        if self._box_mask is None:
+            self._box_mask = Image.new('1', self.persistence.size, 0)
+            drawer = ImageDraw.Draw(self._box_mask)
+            for box in c.settings.grid_boxes[analysis.grid_name]:
+                drawer.rectangle(box, fill=255)
+            del drawer
+
+        trace = ImageChops.subtract(ImageChops.invert(analysis.mask), layers.grid_lines)
+        if not self.no_reconstruct:
+            recon = c._reconstruction(layers, analysis)
+            if c.recon_backend == 'sparse':
+                if recon:
+                    ImageDraw.Draw(trace).point(recon, fill=255)
+            else:
+                trace = ImageChops.logical_or(trace, ImageChops.invert(recon))
+        trace = ImageChops.logical_and(trace, self._box_mask)
+
+        # Count each trace pixel once
+        hits = trace.convert('L').point([0] + [1] * 255)
+        self.persistence.counts = ImageMath.eval('a + b', a=self.persistence.counts, b=hits)
+
+    def render(self, ramp=PERSISTENCE_RAMP, scale='log'):
+        '''Render the counts with a color ramp over the styled background and grid'''
+        p = self.persistence
+        if p.grid_name is None:
+            raise ValueError, 'No captures have been added'
+
+        c = self.colorizer._layout_colorizer(p.size)
+        layers = c._static_layers(p.grid_name)
+        if c._uses_labels():
+            im = c._label_layers(layers, p.grid_name)[1].copy()
+            im.putpalette(c._palette)
+            im = im.convert('RGB')
+        else:
+            im = layers.background.copy()
+
+        level = p.levels(scale)
+        lut = persistence_ramp(ramp)
+        heat = Image.merge('RGB', [level.point(lut[i::3]) for i in range(3)])
+        im.paste(heat, None, level.point([0] + [255] * 255))
+        return im
+
+
+def persistence_ramp(colors):
+    '''Interpolate a list of colors into a lookup table for levels 0-255
+
+    Returns a flat list of R, G, B values for each level.
+    '''
+    stops = [ImageColor.getcolor(c, 'RGB') if isinstance(c, basestring) else c for c in colors]
+    if len(stops) == 1:
+        stops = stops * 2
+
+    lut = [0, 0, 0] # Level 0 is never shown
+    for level in range(1, 256):
+        pos = (level - 1) / 254.0 * (len(stops) - 1)
+        i = min(int(pos), len(stops) - 2)
+        f = pos - i
+        lut.extend(int(round(a + (b - a) * f)) for a, b in zip(stops[i], stops[i + 1]))
+    return lut
+
+
+def _as_tuples(value):
+    '''Convert the lists in a setting value to tuples so it can be hashed'''
+    if isinstance(value, (list, tuple)):
+        return tuple(_as_tuples(v) for v in value)
+    return value
+
+
+def _scale_box(box, scale):
+    '''Scale a box that includes its right and bottom edges'''
+    return (box[0] * scale, box[1] * scale, (box[2] + 1) * scale - 1, (box[3] + 1) * scale - 1)
+
+
+class ColorizerSettings(object):
+    '''process the option settings files'''
+    def __init__(self, setting_file=None, defaults_file=None, script_dir=None):
+        self.script_dir = script_dir
+        
+        self.colors = {}
+        self.regions = {}
+        self.opt_regions = {}
+        self.box_detection = {}
+        self.grids = {}
+        self.grid_boxes = {}
+        self.grid_test_points = {}
+        self.layout = dict(DEFAULT_LAYOUT)
+        self.layout_profiles = {}
+        self.scale = 1 # Scale of the coordinates for the layout profile
+        
+        if defaults_file is not None:
+            default_settings = self.get_settings(defaults_file)
+            self.colors = default_settings['colors']
+            self.regions = default_settings['regions']
+            self.opt_regions = default_settings['optional regions']
+            self.box_detection = default_settings['box detection']
+            self.grids = default_settings['grids']
+            self.grid_boxes = default_settings['grid boxes']
+            self.grid_test_points = default_settings['grid test points']
+            self.layout.update(default_settings['layout'])
+            self.layout_profiles = default_settings['layout profiles']
+
+        if setting_file is not None:
+            settings = self.get_settings(setting_file)
+            if 'colors' in settings: self.colors.update(settings['colors'])
+            if 'regions' in settings: self.regions.update(settings['regions'])
+            if 'optional regions' in settings: self.opt_regions.update(settings['optional regions'])
+            if 'box detection' in settings: self.box_detection.update(settings['box detection'])
+            if 'grids' in settings: self.grids.update(settings['grids'])
+            if 'grid boxes' in settings: self.grid_boxes.update(settings['grid boxes'])
+            if 'grid test points' in settings: self.grid_test_points.update(settings['grid test points'])
+            if 'layout' in settings: self.layout.update(settings['layout'])
+            if 'layout profiles' in settings: self.layout_profiles.update(settings['layout profiles'])
+
+        
+    def get_settings(self, setting_file):
+        '''Read the settings from a file into a plain dict'''
+        if sys.version_info.major < 3:
+          parser = SafeConfigParser()
+        else:
+          parser = SafeConfigParser(inline_comment_prefixes=(';',))
+        
+        try:
+            parser.read(setting_file)
+        
+            settings = {}
+            settings['colors'] = {}
+            if 'colors' in parser.sections():
+                settings['colors'] = dict(parser.items('colors'))
+                
+                # Validate the colors
+                for k, v in settings['colors'].iteritems():
+                    try:
+                        rgb = ImageColor.getrgb(v)
+                    except ValueError:
+                        raise ValueError, 'Invalid color format {0} = {1} in file {2}'.format(k, v, setting_file)
+                    else:
+                        settings['colors'][k] = v #rgb
+
+
+            for section in ['regions', 'optional regions', 'box detection', 'grids', 'grid boxes', 'grid test points', \
+                'layout', 'layout profiles']:
+                settings[section] = {}
+                if section in parser.sections():
+                    try:
+                        settings[section] = dict([(k, _as_tuples(ast.literal_eval(v))) for k, v in parser.items(section)])
+                    except ValueError:
+                        raise ValueError, 'Unable to parse setting value in [{0}] section'.format(section)
+
+
+        except ConfigParser.InterpolationMissingOptionError as e:
+            e.file_name = setting_file
+            raise e
+        except ConfigParser.ParsingError as e:
+            e.file_name = setting_file
+            raise e
+        except SyntaxError as e:
+            e.file_name = setting_file
+            raise e
+
+                
+        return settings
+
+    @property
+    def image_size(self):
+        '''Size of the captures these settings apply to'''
+        width, height = self.layout['image-size']
+        return (width * self.scale, height * self.scale)
+
+    def capture_sizes(self):
+        '''Get the sizes of the captures that have a layout profile'''
+        sizes = set([self.image_size])
+        for size, _ in self.layout_profiles.values():
+            sizes.add(tuple(size))
+        return sizes
+
+    def layout_scale(self, size):
+        '''Find the scale of the layout profile for a capture size'''
+        width, height = self.layout['image-size']
+        for name, (profile_size, scale) in sorted(self.layout_profiles.items()):
+            if tuple(profile_size) != tuple(size):
+                continue
+            if not isinstance(scale, int) or scale < 1 or (width * scale, height * scale) != tuple(size):
+                raise ValueError, 'Layout profile {0} must scale {1}x{2} by a whole number'.format(name, width, height)
+            return scale
+
+        raise ValueError, 'No layout profile for {0[0]}x{0[1]} captures'.format(size)
+
+    def scaled(self, scale):
+        '''Copy of the settings for captures enlarged by a whole number scale
+
+        Boxes cover the same pixels of the enlarged capture and points move
+        to the top left of their enlarged pixel. The box detection columns
+        keep their width.
+        '''
+        def scale_points(points):
+            return None if points is None else tuple((x * scale, y * scale) for x, y in points)
+        def scale_column(c):
+            return (c[0] * scale, c[1] * scale, c[0] * scale + c[2] - c[0], c[3] * scale)
+
+        settings = copy.copy(self)
+        settings.scale = self.scale * scale
+        settings.colors = dict(self.colors)
+        settings.regions = dict((k, _scale_box(v, scale)) for k, v in self.regions.items())
+        settings.opt_regions = dict((k, _scale_box(v, scale)) for k, v in self.opt_regions.items())
+        settings.box_detection = dict((k, scale_column(v)) for k, v in self.box_detection.items())
+        settings.grid_boxes = dict((k, tuple(_scale_box(b, scale) for b in v)) for k, v in self.grid_boxes.items())
+        settings.grid_test_points = dict((k, (scale_points(v[0]), scale_points(v[1]))) \
+            for k, v in self.grid_test_points.items())
+        return settings
+
+    def resolve_colors(self):
+        '''Convert the color strings into RGB tuples so they are only parsed once'''
+        for k, v in self.colors.items():
+            if isinstance(v, basestring):
+                try:
+                    self.colors[k] = ImageColor.getcolor(v, 'RGB')
+                except ValueError:
+                    raise ValueError, 'Invalid color format {0} = {1}'.format(k, v)
+
+
+def adjust_colors(options, colors):
+  '''Set regions identified as hidden to the background color and overridden colors'''
+  for r, c in options.override_colors.iteritems():
+    if r in colors:
+      colors[r] = c
+
+
+  for r in options.hide_regions:
+    if r in colors:
+      colors[r] = colors['background']
+
+  if 'menu' in options.hide_regions:
+    colors['menu-background']  = colors['background']
+    colors['menu-text'] = colors['background']
+
+  if 'channels' in options.hide_regions:
+    colors['channels-background']  = colors['background']
+    colors['channels-text'] = colors['background']
+
+
+
+
+def apply_colors(override_colors, colors):
+  '''Set colors specified on the command line'''
+
+  for r, c in override_colors.iteritems():
+    if r in colors:
+      colors[r] = c
+
+def new_style_template(fname, script_dir):
+  import shutil
+
+  # Find the style template
+  template_file = os.path.join(script_dir, 'data', 'style_template.cfg')
+  if not os.path.exists(template_file):
+    print('error: Unable to find default style template file ({0}).'.format(template_file))
+    sys.exit(1)
+
+  print('Copying style template to:', fname)
+  shutil.copyfile(template_file, fname)
+
+
+class _ColorizerOptionParser(OptionParser):
+    '''Option parser that only lists the styles when the usage is shown'''
+    def __init__(self, script_dir, **kwargs):
+        OptionParser.__init__(self, **kwargs)
+        self.script_dir = script_dir
+
+    def get_usage(self):
+        _, color_styles = find_styles(self.script_dir)
+        return OptionParser.get_usage(self).replace('{styles}', ', '.join(sorted(color_styles.keys())))
+
+
+def find_styles(script_dir):
+  '''Find the named color styles in the styles directory'''
+  color_styles = {}
+  style_dir = os.path.join(script_dir, 'styles')
+  if os.path.exists(style_dir):
+    color_styles = dict([(os.path.splitext(v)[0], v) for v in os.listdir(style_dir)])
+  return (style_dir, color_styles)
+
+
+def resolve_style(setting_file, style_dir, color_styles):
+  '''Convert a named style into the path of its settings file'''
+  if setting_file in color_styles:
+    return os.path.join(style_dir, color_styles[setting_file])
+  return setting_file
+
+
+def parse_hide_regions(hide_regions):
+  '''Convert a comma separated list of regions into a set'''
+  if hide_regions is None:
+    return set()
+  return set(r.strip().lower() for r in hide_regions.split(','))
+
+
+def parse_crop(crop):
+  '''Convert 'grid' or a comma separated box into a crop for LecroyColorizer.render()'''
+  if crop is None or crop.strip().lower() == 'grid':
+    return None if crop is None else 'grid'
+  box = tuple(int(v) for v in crop.split(','))
+  if len(box) != 4:
+    raise ValueError, 'Crop needs four coordinates'
+  return box
+
+
+def parse_thumbnail(thumbnail):
+  '''Convert a <width>x<height> or <size> string into a thumbnail size'''
+  if thumbnail is None:
+    return None
+  size = tuple(int(v) for v in thumbnail.lower().split('x'))
+  if len(size) == 1:
+    size = size * 2
+  if len(size) != 2 or min(size) < 1:
+    raise ValueError, 'Invalid thumbnail size'
+  return size
+
+
+def thumbnail_size(size, max_size):
+  '''Get the largest size within max_size with the same aspect ratio
+
+  Images are never enlarged.
+  '''
+  scale = min(float(max_size[0]) / size[0], float(max_size[1]) / size[1], 1.0)
+  return (max(1, int(round(size[0] * scale))), max(1, int(round(size[1] * scale))))
+
+
+def split_color_list(colors):
+  '''Split a comma separated list while preserving commas within rgb() and hsl() colors'''
+  return re.sub(r'(,)(?=(?:[^()]|\([^)]*\))*$)', ';', colors).split(';')
+
+
+def parse_override_colors(override_colors):
+  '''Convert a comma separated list of <name>:<color> pairs into a dict'''
+  if override_colors is None:
+    return {}
+
+  pairs = [c.split(':') for c in split_color_list(override_colors)]
+  return dict((p[0].strip().lower(), p[1].strip()) for p in pairs)
+
+
+# Exceptions raised for invalid settings files
+SETTINGS_ERRORS = (ConfigParser.InterpolationMissingOptionError, ConfigParser.ParsingError, \
+  ValueError, SyntaxError)
+
+# Version of the compiled settings stored in the cache
+SETTINGS_CACHE_VERSION = 4
+
+def settings_cache_dir():
+  '''Directory for the compiled settings cache'''
+  cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+  return os.path.join(cache_home, 'lecroy-colorizer')
+
+
+def _settings_cache_key(files, script_dir, hide_regions, override_colors):
+  '''Hash the contents of the settings files and the command line adjustments'''
+  h = hashlib.sha1()
+  h.update(repr((SETTINGS_CACHE_VERSION, __version__, script_dir, sorted(hide_regions), \
+    sorted(override_colors.items()))).encode('utf-8'))
+  for fname in files:
+    h.update(b'\0')
+    if fname is not None and os.path.exists(fname):
+      with open(fname, 'rb') as fh:
+        h.update(fh.read())
+  return h.hexdigest()
+
+
+def _read_settings_cache(cache_file):
+  '''Load compiled settings from the cache
+
+  Returns None if the cache file is missing or unreadable.
+  '''
+  try:
+    with open(cache_file, 'rb') as fh:
+      attrs = pickle.load(fh)
+  except Exception:
+    return None
+
+  settings = ColorizerSettings()
+  settings.__dict__.update(attrs)
+  return settings
+
+
+def _write_settings_cache(cache_file, settings):
+  '''Save compiled settings in the cache
+
+  The file is renamed into place so that readers never see a partial file.
+  A cache that can't be written is ignored.
+  '''
+  try:
+    cache_dir = os.path.dirname(cache_file)
+    if not os.path.exists(cache_dir):
+      os.makedirs(cache_dir)
+    fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as fh:
+      pickle.dump(settings.__dict__, fh, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_file, cache_file)
+  except (IOError, OSError):
+    pass
+
+
+def load_settings(setting_file, script_dir, hide_regions=None, override_colors=None, cache=True):
+  '''Load the default settings merged with a settings file
+
+  Hidden regions and override colors are applied to the result and the
+  colors are resolved to RGB tuples. The compiled settings are kept in a
+  cache keyed by the contents of the settings files when cache is True.
+  Raises one of SETTINGS_ERRORS when the settings are invalid.
+  '''
+  hide_regions = hide_regions or set()
+  override_colors = override_colors or {}
+  defaults_file = os.path.join(script_dir, 'data', 'default_settings.cfg')
+
+  if cache:
+    key = _settings_cache_key((defaults_file, setting_file), script_dir, hide_regions, override_colors)
+    cache_file = os.path.join(settings_cache_dir(), 'settings-{0}.pickle'.format(key))
+    settings = _read_settings_cache(cache_file)
+    if settings is not None:
+      return settings
+
+  settings = ColorizerSettings(setting_file=setting_file, defaults_file=defaults_file, \
+    script_dir=script_dir)
+  grid_index(settings) # Check the grid test points
+
+  color_options = Values({'hide_regions': hide_regions, 'override_colors': override_colors})
+  adjust_colors(color_options, settings.colors)
+  settings.resolve_colors()
+
+  if cache:
+    _write_settings_cache(cache_file, settings)
+  return settings
+
+
+def _settings_digest(settings):
+  '''Hash all of the values in a settings object'''
+  h = hashlib.sha1()
+  for name in sorted(vars(settings)):
+    value = getattr(settings, name)
+    if isinstance(value, dict):
+      value = sorted(value.items())
+    h.update(repr((name, value)).encode('utf-8'))
+  return h.hexdigest()
+
+
+def hash_file(fname):
+  '''SHA-1 digest of the contents of a file'''
+  h = hashlib.sha1()
+  with open(fname, 'rb') as fh:
+    for block in iter(lambda: fh.read(1 << 16), b''):
+      h.update(block)
+  return h.hexdigest()
+
+
+class ResultCache(object):
+    '''Cache of colorized images keyed by the capture contents and settings
+
+    Entries are stored by the hash of their key and renamed into place so that
+    several processes can share the cache. The least recently used entries are
+    removed when the total size exceeds max_size bytes. The hit and miss counts
+    and the total size are kept in a stats file. Each process counts its own
+    lookups and merges them into the stats file under a lock when flush() is
+    called, after every flush_interval lookups, and when enough new data has
+    been stored that the size limit may have been reached.
+    '''
+    def __init__(self, cache_dir=None, max_size=500 * 1024 * 1024, flush_interval=256):
+        if cache_dir is None:
+            cache_dir = os.path.join(settings_cache_dir(), 'results')
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self._stats_file = os.path.join(cache_dir, 'stats.json')
+        self._lock_file = os.path.join(cache_dir, 'lock')
+        self._reset_counts()
+        self._size = None # Total size as of the last flush
+        if not os.path.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError: # Created by another process
+                pass
+
+    def __getstate__(self):
+        # Worker processes start with their own empty counters
+        state = self.__dict__.copy()
+        del state['_counts']
+        state['_size'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset_counts()
+
+    def _reset_counts(self):
+        self._counts = {'hits': 0, 'misses': 0, 'stores': 0, 'size': 0}
+
+    def key(self, data_hash, settings, no_reconstruct, out_format, indexed=False, save_options=None, \
+        render_options=None):
+        '''Build the key for a colorized image
+
+        The engine and reconstruction backend are not included since they
+        produce identical images.
+        '''
+        key = (__version__, data_hash, _settings_digest(settings), bool(no_reconstruct), out_format.lower(), \
+            bool(indexed), sorted((save_options or {}).items()), sorted((render_options or {}).items()))
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key, out_file):
+        '''Copy a cached image to out_file
+
+        Returns True on a hit.
+        '''
+        import shutil
+
+        entry = self._entry(key)
+        try:
+            shutil.copyfile(entry, out_file)
+            os.utime(entry, None) # Mark as recently used
+        except (IOError, OSError): # Missing or evicted by another process
+            self._count(misses=1)
+            return False
+
+        self._count(hits=1)
+        return True
+
+    def put(self, key, out_file):
+        '''Store a copy of a colorized image file'''
+        import shutil
+
+        entry = self._entry(key)
+        try:
+            entry_dir = os.path.dirname(entry)
+            if not os.path.exists(entry_dir):
+                try:
+                    os.makedirs(entry_dir)
+                except OSError:
+                    pass
+            fd, tmp_file = tempfile.mkstemp(dir=entry_dir, suffix='.tmp')
+            os.close(fd)
+            shutil.copyfile(out_file, tmp_file)
+            size = os.path.getsize(tmp_file)
+            if os.path.exists(entry): # Stored by another process
+                size -= os.path.getsize(entry)
+            os.rename(tmp_file, entry)
+        except (IOError, OSError):
+            return
+
+        self._count(stores=1, size=size)
+        # Other processes may have filled the cache since the last flush so the
+        # shared size is checked after a fraction of the limit has been stored
+        if self._size is None or self._counts['size'] > self.max_size // 20:
+            self.flush()
+        if self._size + self._counts['size'] > self.max_size:
+            self.evict()
+
+    def _count(self, **deltas):
+        for k, v in deltas.items():
+            self._counts[k] += v
+        if self._counts['hits'] + self._counts['misses'] >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        '''Merge the counts from this process into the stats file
+
+        Returns the merged counters.
+        '''
+        with self._locked():
+            return self._merge_counts()
+
+    close = flush
+
+    def _merge_counts(self):
+        stats = self._read_stats()
+        if any(self._counts.values()):
+            for k, v in self._counts.items():
+                stats[k] += v
+            self._write_stats(stats)
+            self._reset_counts()
+        self._size = stats['size']
+        return stats
+
+    def evict(self):
+        '''Remove the least recently used entries until the cache is below 90% of its size limit'''
+        with self._locked():
+            entries = []
+            for dirpath, _, fnames in os.walk(self.cache_dir):
+                if dirpath == self.cache_dir:
+                    continue
+                for f in fnames:
+                    if f.endswith('.tmp'): # Being stored
+                        continue
+                    path = os.path.join(dirpath, f)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+
+            entries.sort()
+            total = sum(e[1] for e in entries)
+            evicted = 0
+            target = self.max_size * 0.9
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                evicted += 1
+
+            stats = self._read_stats()
+            for k, v in self._counts.items():
+                stats[k] += v
+            self._reset_counts()
+            stats['size'] = total
+            stats['evictions'] += evicted
+            self._write_stats(stats)
+            self._size = total
+
+    def stats(self):
+        '''Get the counters for the cache including the lookups from this process'''
+        return self.flush()
+
+    def _read_stats(self):
+        stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'size': 0}
+        try:
+            with open(self._stats_file) as fh:
+                stats.update(json.load(fh))
+        except (IOError, ValueError):
+            pass
+        return stats
+
+    def _write_stats(self, stats):
+        try:
+            with open(self._stats_file, 'w') as fh:
+                json.dump(stats, fh)
+        except IOError:
+            pass
+
+    def _locked(self):
+        return _FileLock(self._lock_file)
+
+
+class _FileLock(object):
+    '''Exclusive lock on a file shared between processes
+
+    Locking is skipped on platforms without fcntl.
+    '''
+    def __init__(self, fname):
+        self.fname = fname
+        self._fh = None
+
+    def __enter__(self):
+        try:
+            import fcntl
+        except ImportError:
+            return self
+        self._fh = open(self.fname, 'a')
+        fcntl.flock(self._fh.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        if self._fh is not None:
+            self._fh.close() # Releases the lock
+            self._fh = None
+
+
+def settings_error_message(e):
+  '''Describe an exception raised while loading settings'''
+  if isinstance(e, (ConfigParser.InterpolationMissingOptionError, ConfigParser.ParsingError)):
+    return 'error: Unable to parse settings file {0}\n'.format(e.file_name) + e.message
+  elif isinstance(e, SyntaxError):
+    return 'error: ' + e.msg + ' in file ' + e.file_name + '\n' + \
+      '    ' + e.text + '\n' + \
+      '    ' + ' ' * (e.offset-1) + '^'
+  else:
+    return 'error: ' + e.message
+
+
+def output_file_name(in_file, out_dir=None):
+    '''Derive the default output file name from an input file'''
+    path, in_file = os.path.split(in_file)
+    if out_dir is not None:
+        path = out_dir
+    # We will prefer png output to minimize file size since PIL doesn't support RLE
+    # for bitmaps.
+    out_file = os.path.splitext('color_' + in_file)[0] + '.png'
+    return os.path.join(path, out_file)
+
+
+def png_save_options(compress_level=None, compress_strategy=None):
+    '''Build the keyword arguments for saving PNG images
+
+    Other image formats ignore these options.
+    '''
+    save_options = {}
+    if compress_level is not None:
+        if not 0 <= compress_level <= 9:
+            raise ValueError, 'Invalid PNG compression level: {0}'.format(compress_level)
+        save_options['compress_level'] = compress_level
+    if compress_strategy is not None:
+        if compress_strategy not in PNG_STRATEGIES:
+            raise ValueError, 'Unknown PNG compression strategy: {0}'.format(compress_strategy)
+        save_options['compress_type'] = PNG_STRATEGIES[compress_strategy]
+    return save_options
+
+
+def write_profile(profile, dest):
+    '''Write a profile as JSON to a file or to stdout when dest is "-"'''
+    report = json.dumps(profile.as_dict(), indent=2, sort_keys=True)
+    if dest == '-':
+        print(report)
+    else:
+        with open(dest, 'w') as fh:
+            fh.write(report)
+        print('  Profile written to:', dest)
+
+
+def styled_file_name(out_file, label):
+    '''Add a style label to an output file name'''
+    if not label:
+        return out_file
+    base, ext = os.path.splitext(out_file)
+    return '{0}_{1}{2}'.format(base, label, ext)
+
+
+def colorize_styles(colorizers, in_file, no_reconstruct):
+    '''Colorize a capture in several styles
+
+    The capture is read and analyzed once for all colorizers with the same
+    geometry settings and only the rendering is repeated for each style.
+    Returns a list of ColorizeResult in the order of the colorizers.
+    '''
+    analyses = {}
+    share_labels = len(colorizers) > 1
+    return [c.render(_shared_analysis(c, in_file, analyses, share_labels), no_reconstruct) for c in colorizers]
+
+
+def _shared_analysis(colorizer, in_file, analyses, share_labels=False):
+    '''Analyze a capture once for each set of geometry settings
+
+    analyses is a dict of the analyses already made for the capture.
+    share_labels lets the label engines render the labels once for all of
+    the styles that only differ in their colors.
+    '''
+    key = colorizer.geometry_key()
+    analysis = analyses.get(key)
+    if analysis is None:
+        # Reuse the mask when the capture has already been read
+        source = analyses.values()[0].mask if analyses else in_file
+        analysis = colorizer.analyze(source)
+        if share_labels:
+            analysis.labels = {}
+        analyses[key] = analysis
+    return analysis
+
+
+def colorize_to_files(colorizers, in_file, out_files, no_reconstruct, save_options=None, cache=None, \
+    render_options=None):
+    '''Colorize a capture with each colorizer and save the images
+
+    render_options is a dict with the crop and thumbnail arguments for
+    LecroyColorizer.render(). Images found in the ResultCache are copied from
+    the cache without colorizing. Returns a list with the ColorizeResult for
+    each colorizer or None when the image came from the cache.
+    '''
+    save_options = save_options or {}
+    render_options = render_options or {}
+    pending = range(len(colorizers))
+    keys = None
+    if cache is not None:
+        data_hash = hash_file(in_file)
+        keys = [cache.key(data_hash, c.settings, no_reconstruct, os.path.splitext(f)[1], c.indexed, save_options, \
+            render_options) for c, f in zip(colorizers, out_files)]
+        pending = [i for i in pending if not cache.get(keys[i], out_files[i])]
+
+    results = [None] * len(colorizers)
+    analyses = {}
+    share_labels = len(pending) > 1
+    for i in pending:
+        c = colorizers[i]
+        results[i] = c.render_to_file(_shared_analysis(c, in_file, analyses, share_labels), out_files[i], \
+            no_reconstruct, None, render_options.get('crop'), render_options.get('thumbnail'), **save_options)
+        if cache is not None:
+            cache.put(keys[i], out_files[i])
+
+    return results
+
+
+def expand_inputs(inputs, pattern='*.bmp'):
+    '''Expand directories and glob patterns into a list of input files'''
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            matches = sorted(glob.glob(os.path.join(item, pattern)))
+        elif glob.has_magic(item):
+            matches = sorted(glob.glob(item))
+        else:
+            matches = [item]
+
+        for f in matches:
+            if f not in files and not os.path.isdir(f):
+                files.append(f)
+
+    return files
+
+
+# Per-process colorizers used by the batch workers
+_batch_colorizers = []
+_batch_no_reconstruct = False
+_batch_save_options = {}
+_batch_profile = False
+_batch_cache = None
+_batch_render_options = {}
+
+def _batch_init(settings, no_reconstruct, engine, recon_backend, indexed=False, save_options=None, \
+    profile=False, cache=None, render_options=None):
+    '''Create the colorizers once for each worker process
+
+    settings is a ColorizerSettings object or a list of (label, settings)
+    pairs for each style.
+    '''
+    global _batch_colorizers, _batch_no_reconstruct, _batch_save_options, _batch_profile, _batch_cache, \
+        _batch_render_options
+    if isinstance(settings, ColorizerSettings):
+        settings = [(None, settings)]
+    _batch_colorizers = [(label, LecroyColorizer(s, engine, recon_backend, indexed)) for label, s in settings]
+    _batch_no_reconstruct = no_reconstruct
+    _batch_save_options = save_options or {}
+    _batch_profile = profile
+    _batch_cache = cache
+    _batch_render_options = render_options or {}
+
+def _pool_init(*args):
+    '''Initialize a pool worker
+
+    Interrupts are left to the parent process so that it can shut down the pool.
+    '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _batch_init(*args)
+    if _batch_cache is not None:
+        # Merge the cache counts of the worker when it exits
+        multiprocessing.util.Finalize(_batch_cache, _batch_cache.close, exitpriority=10)
+
+def _batch_colorize(job):
+    '''Colorize a single file from a batch job
+
+    Failures are returned to the caller rather than raised so that
+    one bad file doesn't stop the run. The profile of the job is returned
+    as a dict when profiling is enabled.
+    '''
+    in_file, out_file = job
+    start = time.time()
+
+    profile = ColorizerProfile() if _batch_profile else None
+    for _, c in _batch_colorizers:
+        c.profile = profile
+
+    try:
+        out_files = [styled_file_name(out_file, label) for label, _ in _batch_colorizers]
+        colorize_to_files([c for _, c in _batch_colorizers], in_file, out_files, _batch_no_reconstruct, \
+            _batch_save_options, _batch_cache, _batch_render_options)
+        out_file = ', '.join(out_files)
+    except Exception as e:
+        return (in_file, out_file, '{0}: {1}'.format(e.__class__.__name__, e), time.time() - start, None)
+
+    return (in_file, out_file, None, time.time() - start, profile.as_dict() if profile else None)
+
+
+def run_batch(in_files, out_dir, settings, no_reconstruct, jobs, engine='composite', recon_backend='auto', \
+    indexed=False, save_options=None, profile=None, cache=None, render_options=None):
+    '''Colorize a list of files on a pool of worker processes
+
+    The profiles of the jobs are merged into profile when it is a ColorizerProfile.
+    Images are taken from and added to cache when it is a ResultCache.
+    render_options are the crop and thumbnail arguments for LecroyColorizer.render().
+    Returns the number of files that failed.
+    '''
+    if out_dir is not None and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    job_list = [(f, output_file_name(f, out_dir)) for f in in_files]
+    jobs = max(1, min(jobs, len(job_list)))
+    print('  Batch: {0} files, {1} worker(s)'.format(len(job_list), jobs))
+
+    start = time.time()
+    if jobs == 1:
+        _batch_init(settings, no_reconstruct, engine, recon_backend, indexed, save_options, profile is not None, \
+            cache, render_options)
+        results = (_batch_colorize(j) for j in job_list)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(jobs, _pool_init, (settings, no_reconstruct, engine, recon_backend, \
+            indexed, save_options, profile is not None, cache, render_options))
+        chunk_size = max(1, min(16, len(job_list) // (jobs * 4)))
+        results = pool.imap_unordered(_batch_colorize, job_list, chunk_size)
+
+    cache_start = cache.stats() if cache is not None else None
+    failures = []
+    try:
+        for i, (in_file, out_file, error, elapsed, job_profile) in enumerate(results):
+            if job_profile is not None:
+                profile.merge(job_profile)
+            if error is None:
+                print('  [{0}/{1}] {2} -> {3}'.format(i + 1, len(job_list), in_file, out_file))
+            else:
+                print('  [{0}/{1}] error: {2}: {3}'.format(i + 1, len(job_list), in_file, error))
+                failures.append((in_file, error))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    elapsed = time.time() - start
+    done = len(job_list) - len(failures)
+    rate = len(job_list) / elapsed if elapsed > 0 else 0.0
+    print('\n  Processed {0} files in {1:.2f}s ({2:.1f} files/s), {3} colorized, {4} failed'.format( \
+        len(job_list), elapsed, rate, done, len(failures)))
+    for in_file, error in failures:
+        print('    failed: {0}: {1}'.format(in_file, error))
+    if cache is not None:
+        cache_end = cache.stats()
+        print('  Result cache: {0} hits, {1} misses, {2} evictions, {3:.1f}MB'.format( \
+            *[cache_end[k] - cache_start[k] for k in ('hits', 'misses', 'evictions')] + \
+            [cache_end['size'] / (1024.0 * 1024.0)]))
+
+    return len(failures)
+
+
+def _persistence_chunk(job):
+    '''Accumulate a group of files from a persistence job
+
+    job is the list of files and the (grid_name, size) of the persistence
+    image or None.
+    Returns the partial PersistenceMap and a list of (in_file, error) failures.
+    '''
+    in_files, reference = job
+    acc = PersistenceAccumulator(_batch_colorizers[0][1], _batch_no_reconstruct, *(reference or ()))
+    failures = []
+    for in_file in in_files:
+        try:
+            acc.add(in_file)
+        except Exception as e:
+            failures.append((in_file, '{0}: {1}'.format(e.__class__.__name__, e)))
+    return (acc.persistence, failures)
+
+
+def run_persistence(in_files, out_file, settings, no_reconstruct, jobs, engine='composite', recon_backend='auto', \
+    ramp=PERSISTENCE_RAMP, scale='log', save_options=None):
+    '''Build a persistence image from many captures in a single pass
+
+    The files are split into groups that are accumulated by a pool of worker
+    processes and the partial counts are merged in the order of the files.
+    The grid and size of the first valid capture apply to every group so
+    the captures that are skipped don't depend on the number of workers.
+    Returns the number of files that failed.
+    '''
+    jobs = max(1, min(jobs, len(in_files)))
+    print('  Persistence: {0} files, {1} worker(s)'.format(len(in_files), jobs))
+
+    start = time.time()
+    colorizer = LecroyColorizer(settings, engine, recon_backend)
+    reference = None
+    for in_file in in_files:
+        try:
+            analysis = colorizer.analyze(in_file)
+        except Exception: # Reported by the worker
+            continue
+        reference = (analysis.grid_name, analysis.mask.size)
+        break
+
+    chunk_size = max(1, min(1000, len(in_files) // (jobs * 4)))
+    chunks = [(in_files[i:i + chunk_size], reference) for i in range(0, len(in_files), chunk_size)]
+    if jobs == 1:
+        _batch_init(settings, no_reconstruct, engine, recon_backend)
+        results = (_persistence_chunk(c) for c in chunks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(jobs, _pool_init, (settings, no_reconstruct, engine, recon_backend))
+        results = pool.imap(_persistence_chunk, chunks)
+
+    acc = PersistenceAccumulator(colorizer, no_reconstruct, *(reference or ()))
+    failures = []
+    try:
+        for partial, chunk_failures in results:
+            for in_file, error in chunk_failures:
+                print('  error: {0}: {1}'.format(in_file, error))
+            failures.extend(chunk_failures)
+            if partial.frames > 0:
+                try:
+                    acc.merge(partial)
+                except ValueError as e:
+                    print('  error: {0} captures skipped: {1}'.format(partial.frames, e))
+                    failures.extend([(None, str(e))] * partial.frames)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    elapsed = time.time() - start
+    rate = len(in_files) / elapsed if elapsed > 0 else 0.0
+    print('  Accumulated {0} captures in {1:.2f}s ({2:.1f} files/s), {3} failed'.format( \
+        acc.persistence.frames, elapsed, rate, len(failures)))
+
+    if acc.persistence.frames == 0:
+        print('error: No captures were accumulated')
+        return max(1, len(failures))
+
+    print('  Saving persistence image:', out_file)
+    acc.render(ramp, scale).save(out_file, **(save_options or {}))
+    return len(failures)
+
+
+def _read_exactly_or_eof(fh, size):
+    '''Read a block from a stream
+
+    Returns an empty string at the end of the stream. A partial block is an error.
+    '''
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        data = fh.read(remaining)
+        if not data:
+            break
+        chunks.append(data)
+        remaining -= len(data)
+
+    data = b''.join(chunks)
+    if data and remaining > 0:
+        raise ValueError, 'Truncated frame ({0} of {1} bytes)'.format(len(data), size)
+    return data
+
+
+def read_frames(fh, raw=False, size=IMAGE_SIZE):
+    '''Read concatenated capture frames from a stream
+
+    BMP frames are delimited by the sizes in their headers. Raw frames are
+    packed 1-bit rows, top to bottom, with 1 for white pixels. Frames are
+    yielded one at a time as a mode '1' mask or a file object for other
+    image formats so that memory use is independent of the stream length.
+    '''
+    stride = (size[0] + 7) // 8
+    raw_size = stride * size[1]
+    header_size = _bmp_file_header.size + _bmp_info_header.size
+
+    while True:
+        if raw:
+            data = _read_exactly_or_eof(fh, raw_size)
+            if not data:
+                return
+            mim = Image.frombytes('1', size, data)
+            mim.info['file_size'] = raw_size
+            yield mim
+            continue
+
+        header = _read_exactly_or_eof(fh, header_size)
+        if not header:
+            return
+        try:
+            magic, file_size, _, _, data_offset = _bmp_file_header.unpack_from(header, 0)
+            _, width, height, _, bpp, _, _, _, _, _, _ = _bmp_info_header.unpack_from(header, _bmp_file_header.size)
+        except struct.error:
+            raise ValueError, 'Invalid frame header'
+        if magic != b'BM':
+            raise ValueError, 'Frame is not a BMP image'
+
+        # Use the file size unless it is too small to hold the pixel data
+        pixel_size = ((width * bpp + 31) // 32) * 4 * abs(height)
+        frame_size = max(file_size, data_offset + pixel_size)
+        frame = header + _read_exactly_or_eof(fh, frame_size - header_size)
+        if len(frame) != frame_size:
+            raise ValueError, 'Truncated frame'
+
+        mim = bmp_mask_from_buffer(frame, None)
+        if mim is not None:
+            mim.info['file_size'] = frame_size
+            yield mim
+        else:
+            yield io.BytesIO(frame)
+
+
+def run_stream(colorizer, in_stream, out_stream, no_reconstruct, raw=False, out_format='PNG', save_options=None, \
+    render_options=None):
+    '''Colorize a stream of frames and write the encoded images in order
+
+    Frames that can't be colorized are reported and skipped. render_options
+    are the crop and thumbnail arguments for LecroyColorizer.render().
+    Returns the number of failed frames.
+    '''
+    render_options = render_options or {}
+    count = 0
+    failures = 0
+    start = time.time()
+    try:
+        for i, frame in enumerate(read_frames(in_stream, raw)):
+            count += 1
+            try:
+                analysis = colorizer.analyze(frame)
+            except (ValueError, IOError) as e:
+                print('error: Frame {0}: {1}'.format(i, e), file=sys.stderr)
+                failures += 1
+                continue
+
+            colorizer.render_to_file(analysis, out_stream, no_reconstruct, out_format, render_options.get('crop'), \
+                render_options.get('thumbnail'), **(save_options or {}))
+            out_stream.flush()
+    except ValueError as e:
+        # A truncated frame at the end of the stream is the next frame
+        print('error: Frame {0}: {1}'.format(count, e), file=sys.stderr)
+        count += 1
+        failures += 1
+
+    elapsed = time.time() - start
+    print('  Streamed {0} frames in {1:.2f}s, {2} failed'.format(count, elapsed, failures), file=sys.stderr)
+    return failures
+
+
+class LatencyStats(object):
+    '''Summary statistics over a bounded window of recent samples'''
+    def __init__(self, window=1000):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self._recent = collections.deque(maxlen=window)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.maximum = max(self.maximum, value)
+        self._recent.append(value)
+
+    def summary(self):
+        '''Get the statistics as a dict'''
+        recent = sorted(self._recent)
+        def percentile(p):
+            if not recent:
+                return 0.0
+            return recent[min(len(recent) - 1, int(p * len(recent)))]
+
+        return {'count': self.count, 'mean': self.total / self.count if self.count else 0.0, \
+            'p50': percentile(0.50), 'p95': percentile(0.95), 'max': self.maximum}
+
+
+class FolderWatcher(object):
+    '''Poll a directory for new captures
+
+    The directory is only listed when its modification time changes and only
+    the names that weren't listed before are matched against the pattern. While
+    files keep arriving the listings are spaced out so they take no more than a
+    tenth of the time, which keeps the cost of polling a large directory flat.
+    New files are
+    held until their size and modification time have been stable for the settle
+    time to avoid reading partially written captures. Files that are still empty
+    after empty_timeout seconds are ignored.
+    '''
+    def __init__(self, watch_dir, pattern='*.bmp', settle=1.0, empty_timeout=60.0):
+        self.watch_dir = watch_dir
+        self.pattern = pattern
+        self.settle = settle
+        self.empty_timeout = empty_timeout
+        self.seen = set()
+        self._listed = set() # Every name found by a listing of the directory
+        self._pending = {} # name -> (stat signature, time of last change, time first seen)
+        self._dir_mtime = None
+        self._dir_changed = 0.0 # Local time the directory modification time last changed
+        self._last_scan = None # Local time of the last listing
+        self._next_scan = 0.0 # Earliest time for the next listing
+
+    def list_files(self):
+        '''List the names of the files matching the pattern'''
+        return fnmatch.filter(self._list_names(), self.pattern)
+
+    def _list_names(self):
+        if hasattr(os, 'scandir'):
+            return [e.name for e in os.scandir(self.watch_dir)]
+        return os.listdir(self.watch_dir)
+
+    def poll(self, now=None):
+        '''Check for new files
+
+        Returns a list of (path, time first seen) for files that are ready.
+        '''
+        if now is None:
+            now = time.time()
+
+        dir_mtime = os.stat(self.watch_dir).st_mtime
+        if dir_mtime != self._dir_mtime:
+            self._dir_mtime = dir_mtime
+            self._dir_changed = now
+
+        # Rescan on a change and once more at least 2 seconds later in case a change lands
+        # within the resolution of the directory timestamp. Only local times are compared
+        # so clock skew with a network share doesn't matter.
+        if (self._last_scan is None or self._last_scan < self._dir_changed + 2.0) and now >= self._next_scan:
+            start = timeit.default_timer()
+            self._last_scan = now
+            new_names = set(self._list_names())
+            new_names.difference_update(self._listed)
+            self._listed.update(new_names)
+            for name in fnmatch.filter(new_names, self.pattern):
+                if name not in self.seen and name not in self._pending:
+                    self._pending[name] = (None, now, now)
+            self._next_scan = now + (timeit.default_timer() - start) * 10.0
+
+        ready = []
+        for name, (sig, changed, first_seen) in list(self._pending.items()):
+            path = os.path.join(self.watch_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError: # Removed before it was ready
+                del self._pending[name]
+                self._listed.discard(name)
+                continue
+
+            new_sig = (st.st_size, st.st_mtime)
+            if new_sig != sig:
+                self._pending[name] = (new_sig, now, first_seen)
+            elif now - changed >= self.settle:
+                if st.st_size > 0:
+                    del self._pending[name]
+                    self.seen.add(name)
+                    ready.append((path, first_seen))
+                elif now - first_seen >= self.empty_timeout:
+                    # Stop checking files that stay empty
+                    del self._pending[name]
+                    self.seen.add(name)
+
+        return ready
+
+    def skip(self, name):
+        '''Mark a file as already processed'''
+        self.seen.add(name)
+
+    @property
+    def pending_count(self):
+        '''Number of new files waiting to settle'''
+        return len(self._pending)
+
+
+def run_watch(watch_dir, out_dir, settings, options):
+    '''Colorize new captures as they appear in a directory
+
+    Ready files are submitted to a pool of worker processes with at most
+    queue_depth files in flight. Runs until interrupted.
+    '''
+    if out_dir is None:
+        out_dir = watch_dir
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    watcher = FolderWatcher(watch_dir, options.pattern, options.settle)
+
+    # Files that were already colorized before we started are skipped
+    label = settings[0][0] if isinstance(settings, list) else None
+    for name in watcher.list_files():
+        if os.path.exists(styled_file_name(output_file_name(name, out_dir), label)):
+            watcher.skip(name)
+
+    jobs = max(1, options.jobs)
+    queue_depth = max(1, options.queue_depth)
+    pool = multiprocessing.Pool(jobs, _pool_init, (settings, options.no_reconstruct, options.engine, \
+        options.recon_backend, options.indexed, options.save_options, False, options.result_cache, \
+        options.render_options))
+    done_queue = Queue.Queue()
+
+    backlog = collections.deque() # Ready files waiting for a free slot
+    in_flight = 0
+    stats = {'queue_wait': LatencyStats(), 'latency': LatencyStats(), 'colorize': LatencyStats()}
+    counts = {'colorized': 0, 'failed': 0}
+    last_export = time.time()
+
+    def export_stats():
+        if options.stats_file is None:
+            return
+        report = {'time': time.time(), 'backlog': len(backlog), 'in_flight': in_flight, \
+            'pending': watcher.pending_count}
+        report.update(counts)
+        for k, v in stats.items():
+            report[k] = v.summary()
+        tmp_file = options.stats_file + '.tmp'
+        with open(tmp_file, 'w') as fh:
+            json.dump(report, fh, indent=2, sort_keys=True)
+        os.rename(tmp_file, options.stats_file)
 
-        for key in self.settings.grid_test_points.keys():
-            points = self.settings.grid_test_points[key]
-            white_pixels = points[0]
-            black_pixels = points[1]
-            
-            match = True
-            if white_pixels != None:
-                for tp in white_pixels:
-                    if bw_im.getpixel(tp) != 255:
-                        match = False
-                        break
-            
-            if black_pixels != None:
-                for tp in black_pixels:
-                    if bw_im.getpixel(tp) != 0:
-                        match = False
-                        break
-            
-            if match: # All pixel tests passed
-                return key
-        
-        return 'Unknown'
+    print('  Watching: {0} -> {1} ({2} worker(s), queue depth {3})'.format(watch_dir, out_dir, jobs, queue_depth))
+    try:
+        while True:
+            now = time.time()
+            for path, first_seen in watcher.poll(now):
+                backlog.append((path, first_seen, now))
 
+            # Submit as many files as the queue depth allows
+            while backlog and in_flight < queue_depth:
+                path, first_seen, ready_time = backlog.popleft()
+                job = (path, output_file_name(path, out_dir))
+                pool.apply_async(_batch_colorize, (job,), \
+                    callback=lambda r, t=(first_seen, ready_time): done_queue.put((r, t)))
+                in_flight += 1
 
-    def colorize(self, in_file, no_reconstruct):
-        '''colorize the input image'''
-        im = Image.open(in_file).convert('RGB')
+            # Collect finished files
+            timeout = options.poll
+            while True:
+                try:
+                    (in_file, out_file, error, elapsed, _), (first_seen, ready_time) = done_queue.get(timeout=timeout)
+                except Queue.Empty:
+                    break
+                timeout = 0
+                in_flight -= 1
 
+                finished = time.time()
+                stats['queue_wait'].add(max(0.0, finished - elapsed - ready_time))
+                stats['latency'].add(finished - first_seen)
+                stats['colorize'].add(elapsed)
+                if error is None:
+                    counts['colorized'] += 1
+                    print('  {0} -> {1} ({2:.0f}ms)'.format(in_file, out_file, (finished - first_seen) * 1000.0))
+                else:
+                    counts['failed'] += 1
+                    print('  error: {0}: {1}'.format(in_file, error))
 
-        # Validate the image to ensure it is from a 93xx scope
-        valid = True
-        if im.size != IMAGE_SIZE: valid = False
-        
-        # The histogram should have all values at 0 and 255 with nothing but 0's in between
-        red_hist = im.histogram()[:256]
-        for color in red_hist[1:255]:
-            if color != 0: valid = False
-            
-        if not valid:
-            raise ValueError, 'Not a proper {0[0]}x{0[1]} black and white image'.format(IMAGE_SIZE)
+            if time.time() - last_export >= options.stats_interval:
+                export_stats()
+                last_export = time.time()
 
-        # The image is valid... proceed
-        mim = im.convert('1')
-        cim = im.copy()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.terminate()
+        pool.join()
 
+    export_stats()
+    print('\n  Colorized {0} files, {1} failed'.format(counts['colorized'], counts['failed']))
+    for k in ('queue_wait', 'latency', 'colorize'):
+        st = stats[k].summary()
+        print('    {0:<10} mean {1:.3f}s  p50 {2:.3f}s  p95 {3:.3f}s  max {4:.3f}s'.format(k, st['mean'], \
+            st['p50'], st['p95'], st['max']))
 
-        mask_bg = Image.new('RGB', IMAGE_SIZE, (0, 0, 0))
+    return 0
 
-        # Colorize the regions around the perimeter
-        m = mask_bg.copy()
-        m_drawer = ImageDraw.Draw(m)
-        for key, box in self.settings.regions.items():
-            m_drawer.rectangle(box, fill=self.settings.colors[key])
 
-        # Identify the grid type
-        grid_name = self.identify_grid(im)
-        if grid_name == 'Unknown':
-            raise ValueError, 'Cannot identify image grid'
+class ColorizerServer(object):
+    '''Serve colorization requests on a Unix domain socket
 
-        # Colorize additional regions for special grids
-        if grid_name == 'param':
-            m_drawer.rectangle(self.settings.opt_regions['parameters'], fill=self.settings.colors['parameters'])
-            m_drawer.rectangle(self.settings.opt_regions['parameters-span'], fill=self.settings.colors['parameters-span'])
-        elif grid_name[0:2] == 'xy':
-            m_drawer.rectangle(self.settings.opt_regions['xy-cursors'], fill=self.settings.colors['xy-cursors'])
-            
-        # Find the bottommost grid so we can colorize the strip where the trigger delay marker
-        # appears.
-        max_y = 0
-        for box in self.settings.grid_boxes[grid_name]:
-            if box[3] > max_y:
-                max_y = box[3]
+    Colorizers are kept warm for each combination of style, hidden regions,
+    and override colors so that only the pixel work is done per request.
+    Each client connection is handled in its own thread.
+    '''
+    def __init__(self, socket_path, script_dir, engine='composite', recon_backend='auto'):
+        self.script_dir = script_dir
+        self.engine = engine
+        self.recon_backend = recon_backend
+        self.style_dir, self.color_styles = find_styles(script_dir)
+        self._colorizers = {}
+        self._lock = threading.Lock()
+        self.requests = 0
 
-        if grid_name == 'xy':
-            delay_box_height = 35
-        else:
-            delay_box_height = 25
-        delay_box = (self.settings.regions['left-marker'][0], max_y, self.settings.regions['right-marker'][2], max_y + delay_box_height)
-        m_drawer.rectangle(delay_box, fill=self.settings.colors['left-marker'])
+        self._server = _unix_stream_server(socket_path, self)
 
-        # Colorize the traces
-        for box in self.settings.grid_boxes[grid_name]:
-            m_drawer.rectangle(box, fill=self.settings.colors['trace'])
+    def serve_forever(self):
+        '''Handle requests until interrupted'''
+        self._server.serve_forever()
 
-        # Find the boxes for the channel labels and the menu buttons
-        channel_boxes, menu_boxes = self._find_boxes(mim)
-            
-        # Paint the text for the channel and menu boxes
-        for box in channel_boxes:
-            adj_box = (box[0] + 1, box[1] + 12, box[2] - 1, box[3] - 1)
-            m_drawer.rectangle(adj_box, fill=self.settings.colors['channels-text'])
+    def server_close(self):
+        '''Close the listening socket'''
+        self._server.server_close()
 
-        for box in menu_boxes:
-            adj_box = (box[0] + 1, box[1] + 12, box[2] - 1, box[3] - 1)
-            m_drawer.rectangle(adj_box, fill=self.settings.colors['menu-text'])
-            
-        del m_drawer
-        
-        #m.save('regions.png')
+    def colorizer(self, style, hide_regions, override_colors):
+        '''Get a warm colorizer for a style and color adjustments'''
+        key = (style, hide_regions, override_colors)
+        with self._lock:
+            colorizer = self._colorizers.get(key)
+            if colorizer is None:
+                setting_file = None
+                if style is not None:
+                    setting_file = resolve_style(style, self.style_dir, self.color_styles)
+                    if not os.path.exists(setting_file):
+                        raise ValueError, 'Settings file ({0}) does not exist'.format(setting_file)
 
-        # Sreeen the colorized regions onto the image
-        cim = ImageChops.screen(cim, m)
+                settings = load_settings(setting_file, self.script_dir, parse_hide_regions(hide_regions), \
+                    parse_override_colors(override_colors))
+                colorizer = LecroyColorizer(settings, self.engine, self.recon_backend)
+                self._colorizers[key] = colorizer
 
+            self.requests += 1
+        return colorizer
 
-        # Create the background image
-        bg_im = Image.new('RGB', im.size, self.settings.colors['background'])
-        bg_im_drawer = ImageDraw.Draw(bg_im)
-        
-        # Add the grid backgrounds
-        for box in self.settings.grid_boxes[grid_name]:
-            bg_im_drawer.rectangle(box, fill=self.settings.colors['grid-background'])
+    def process(self, header, payload):
+        '''Colorize the image for a request
 
-        # Fill the channel and menu box backgrounds
-        for box in channel_boxes:
-            bg_im_drawer.rectangle(box, fill=self.settings.colors['channels-background'])
-        for box in menu_boxes:
-            bg_im_drawer.rectangle(box, fill=self.settings.colors['menu-background']) 
-            
-        del bg_im_drawer
-        
+        Returns the response header and payload.
+        '''
+        colorizer = self.colorizer(header.get('style'), header.get('hide'), header.get('color'))
 
-        # Create the grid mask
-        grid_image_file = os.path.join(self.settings.script_dir, 'data', self.settings.grids[grid_name][GRID_IMAGE])
-        gr_im = Image.open(grid_image_file).convert('RGB')
-        gr_mask = gr_im.convert('1')
+        if payload is not None:
+            in_file = io.BytesIO(payload)
+        elif header.get('path') is not None:
+            in_file = header['path']
+        else:
+            raise ValueError, 'Missing input image'
 
-        # Add the colored grid lines to the background
-        gline_im = Image.new('RGB', im.size, self.settings.colors['grid'])
-        bg_im = Image.composite(bg_im, gline_im, gr_mask)
+        result = colorizer.colorize(in_file, bool(header.get('no_reconstruct', False)))
 
+        response = {'status': 'ok', 'grid': result.grid_name, \
+            'grid_descr': colorizer.settings.grids[result.grid_name][GRID_DESCR]}
+        out_path = header.get('out_path')
+        if out_path is not None:
+            result.image.save(out_path)
+            response['out_path'] = out_path
+            return (response, None)
 
-        # Remove the grid from the original image mask
-        ol_mask = ImageChops.subtract(ImageChops.invert(mim), ImageChops.invert(gr_mask))
+        buf = io.BytesIO()
+        result.image.save(buf, header.get('format', 'PNG'))
+        return (response, buf.getvalue())
 
-        # Overlay the colorized imagery over the background
-        cim = Image.composite(cim, bg_im, ol_mask)
 
+def _unix_stream_server(socket_path, colorizer_server):
+    '''Create a threaded Unix domain socket server for a ColorizerServer
 
-        if not no_reconstruct:
-            cim = self._reconstruct_trace(cim, gr_mask, mim, grid_name)
+    SocketServer is imported here so that it isn't loaded for the other modes.
+    '''
+    import SocketServer
 
-        return cim
-        
-    def _find_boxes(self, mim):
-        '''Scan down a 1-pixel wide column to find the channel and menu box regions'''
-        channel_box_column = self.settings.box_detection['channel-box-column']
-        menu_box_column = self.settings.box_detection['menu-box-column']
-        
-        # Extract 1-pixel wide column from mask image
-        channel_box_data = list(mim.crop(channel_box_column).getdata())
-        channel_box_edges = self._find_box_edges(channel_box_data, channel_box_column[1])
-        channel_boxes = []
-        for edge in channel_box_edges:
-            box = (channel_box_column[0] + 1, edge[0], channel_box_column[0] + 126, edge[1])
-            channel_boxes.append(box)
+    class RequestHandler(SocketServer.StreamRequestHandler):
+        '''Handle a stream of requests from one client connection'''
+        def handle(self):
+            while True:
+                try:
+                    message = recv_message(self.rfile)
+                except ValueError as e:
+                    send_message(self.wfile, {'status': 'error', 'message': str(e)})
+                    break
 
-        menu_box_data = list(mim.crop(menu_box_column).getdata())
-        menu_box_edges = self._find_box_edges(menu_box_data, menu_box_column[1])
-        menu_boxes = []
-        for edge in menu_box_edges:
-            box = (menu_box_column[0] + 1, edge[0], menu_box_column[0] + 136, edge[1])
-            menu_boxes.append(box)
-        
-        return (channel_boxes, menu_boxes)
+                if message is None: # Client closed the connection
+                    break
 
-            
-    def _find_box_edges(self, column_data, y_offset):
-        '''Search a column for continuous spans of dark pixels signifying the edge of a box'''
-        box_edges = []
-        in_box = False
-        box_start = 0
-        for i in range(len(column_data)):
-            if column_data[i] == 0 and not in_box:
-                box_start = i
-                in_box = True
-            elif column_data[i] > 0 and in_box:
-                # The XY grid cursors have pixels in the same column we're testing for channel box edges
-                # Remove any edge that is too short to be a real box
-                if i - box_start > 20: # Must be more than 20-pixels tall
-                    box_edges.append((box_start + y_offset - 1, i + y_offset))
-                in_box = False
-        return box_edges
-        
-    def _reconstruct_trace(self, cim, gr_mask, mim, grid_name):
-        '''Reconstruct the trace portions covered by the grid'''
-        
-        # Isolate the horizontal lines in the grid
-        # Shift the grid mask left and right
-        sl_grm = ImageChops.offset(gr_mask, -1, 0)
-        sr_grm = ImageChops.offset(gr_mask, 1, 0)
-        
-        h_grm = ImageChops.logical_and(ImageChops.add(sr_grm, gr_mask), ImageChops.add(sl_grm, gr_mask))
+                header, payload = message
+                try:
+                    response, data = colorizer_server.process(header, payload)
+                except Exception as e:
+                    response, data = ({'status': 'error', 'message': '{0}: {1}'.format(e.__class__.__name__, e)}, \
+                        None)
 
-        # Isolate the vertical  lines in the grid
-        # Shift the grid mask up and down
-        su_grm = ImageChops.offset(gr_mask, 0, -1)
-        sd_grm = ImageChops.offset(gr_mask, 0, 1)
-        
-        v_grm = ImageChops.logical_and(ImageChops.add(sd_grm, gr_mask), ImageChops.add(su_grm, gr_mask))
+                send_message(self.wfile, response, data)
 
-        # Find where a horizontal grid line is bounded by trace pixels above and below
-        su_mim = ImageChops.offset(mim, 0, -1)
-        sd_mim = ImageChops.offset(mim, 0, 1)
-        h_mim = ImageChops.logical_or(su_mim, sd_mim)
-        h_mim = ImageChops.logical_or(h_mim, ImageChops.logical_or(ImageChops.invert(v_grm), h_grm))
+    class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+        daemon_threads = True
 
-        # Find where a vertical grid line is bounded by trace pixels left and right
-        sl_mim = ImageChops.offset(mim, -1, 0)
-        sr_mim = ImageChops.offset(mim, 1, 0)
-        v_mim = ImageChops.logical_or(sl_mim, sr_mim)
-        v_mim = ImageChops.logical_or(v_mim, ImageChops.logical_or(ImageChops.invert(h_grm), v_grm))
+    return Server(socket_path, RequestHandler)
 
-        # Fill in cross points of horiz. and vert. lines if upper left and lower right corners have
-        # pixels from a trace
-        sul_mim = ImageChops.offset(mim, -1, -1)
-        sdr_mim = ImageChops.offset(mim, 1, 1)
-        d_mim = ImageChops.logical_or(sul_mim, sdr_mim)
-        d_mim = ImageChops.logical_or(d_mim, ImageChops.logical_or(h_grm, v_grm))
-        
-        recon = ImageChops.logical_and(h_mim, v_mim)
-        recon = ImageChops.logical_and(recon, d_mim)
 
-        # Mask out the grid borders from the reconstruction
-        m = Image.new('1', IMAGE_SIZE, 1)
-        m_drawer = ImageDraw.Draw(m)
-        for box in self.settings.grid_boxes[grid_name]:
-            m_drawer.rectangle(box, 0)
-        del m_drawer
-        
-        recon = ImageChops.logical_or(recon, m)
-        
-        # Composite the reconstructed trac segments onto the colorized image
-        ol_color = Image.new('RGB', IMAGE_SIZE, self.settings.colors['trace-reconstruction'])
-        new_cim = ImageChops.composite(cim, ol_color, recon)
-        
-        return new_cim
-    
-class ColorizerSettings(object):
-    '''process the option settings files'''
-    def __init__(self, setting_file=None, defaults_file=None, script_dir=None):
-        self.script_dir = script_dir
-        
-        self.colors = {}
-        self.regions = {}
-        self.opt_regions = {}
-        self.box_detection = {}
-        self.grids = {}
-        self.grid_boxes = {}
-        self.grid_test_points = {}
-        
-        if defaults_file is not None:
-            default_settings = self.get_settings(defaults_file)
-            self.colors = default_settings['colors']
-            self.regions = default_settings['regions']
-            self.opt_regions = default_settings['optional regions']
-            self.box_detection = default_settings['box detection']
-            self.grids = default_settings['grids']
-            self.grid_boxes = default_settings['grid boxes']
-            self.grid_test_points = default_settings['grid test points']
+# Messages are a 4-byte length followed by a JSON header and an optional payload
+# with the length given by the 'size' key in the header
+_message_length = struct.Struct('>I')
 
-        if setting_file is not None:
-            settings = self.get_settings(setting_file)
-            if 'colors' in settings: self.colors.update(settings['colors'])
-            if 'regions' in settings: self.regions.update(settings['regions'])
-            if 'optional regions' in settings: self.opt_regions.update(settings['optional regions'])
-            if 'box detection' in settings: self.box_detection.update(settings['box detection'])
-            if 'grids' in settings: self.grids.update(settings['grids'])
-            if 'grid boxes' in settings: self.grids.update(settings['grid boxes'])
-            if 'grid test points' in settings: self.grids.update(settings['grid test points'])
+def send_message(fh, header, payload=None):
+    '''Send a message on a socket file'''
+    header = dict(header)
+    if payload is not None:
+        header['size'] = len(payload)
 
-        
-    def get_settings(self, setting_file):
-        '''Read the settings from a file into a plain dict'''
-        if sys.version_info.major < 3:
-          parser = SafeConfigParser()
-        else:
-          parser = SafeConfigParser(inline_comment_prefixes=(';',))
-        
-        try:
-            parser.read(setting_file)
-        
-            settings = {}
-            settings['colors'] = {}
-            if 'colors' in parser.sections():
-                settings['colors'] = dict(parser.items('colors'))
-                
-                # Validate the colors
-                for k, v in settings['colors'].iteritems():
-                    try:
-                        rgb = PIL.ImageColor.getrgb(v)
-                    except ValueError:
-                        print('error: Invalid color format {0} = {1} in file {2}'.format(k, v, setting_file))
-                        sys.exit(1)
-                    else:
-                        settings['colors'][k] = v #rgb
+    data = json.dumps(header).encode('utf-8')
+    fh.write(_message_length.pack(len(data)))
+    fh.write(data)
+    if payload is not None:
+        fh.write(payload)
+    fh.flush()
 
+def _read_exactly(fh, size):
+    data = fh.read(size)
+    if len(data) != size:
+        raise ValueError, 'Truncated message'
+    return data
 
-            for section in ['regions', 'optional regions', 'box detection', 'grids', 'grid boxes', 'grid test points']:
-                settings[section] = {}
-                if section in parser.sections():
-                    try:
-                        settings[section] = dict([(k, ast.literal_eval(v)) for k, v in parser.items(section)])
-                    except ValueError:
-                        raise ValueError, 'Unable to parse setting value in [{0}] section'.format(section)
+def recv_message(fh):
+    '''Receive a message from a socket file
 
+    Returns the header and payload or None when the connection is closed.
+    '''
+    prefix = fh.read(_message_length.size)
+    if not prefix:
+        return None
+    if len(prefix) != _message_length.size:
+        raise ValueError, 'Truncated message'
 
-        except ConfigParser.InterpolationMissingOptionError as e:
-            e.file_name = setting_file
-            raise e
-        except ConfigParser.ParsingError as e:
-            e.file_name = setting_file
-            raise e
-        except SyntaxError as e:
-            e.file_name = setting_file
-            raise e
+    header = json.loads(_read_exactly(fh, _message_length.unpack(prefix)[0]).decode('utf-8'))
+    if not isinstance(header, dict):
+        raise ValueError, 'Invalid message header'
 
-                
-        return settings
+    payload = None
+    if header.get('size') is not None:
+        payload = _read_exactly(fh, int(header['size']))
 
+    return (header, payload)
 
-def adjust_colors(options, colors):
-  '''Set regions identified as hidden to the background color and overridden colors'''
-  for r, c in options.override_colors.iteritems():
-    if r in colors:
-      colors[r] = c
 
+def run_server(socket_path, script_dir, engine='composite', recon_backend='auto'):
+    '''Run the colorizer server until interrupted'''
+    if os.path.exists(socket_path):
+        # Remove a stale socket left behind by a server that is no longer running
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except socket.error:
+            os.unlink(socket_path)
+        else:
+            print('error: A server is already listening on {0}'.format(socket_path))
+            return 1
+        finally:
+            probe.close()
 
-  for r in options.hide_regions:
-    if r in colors:
-      colors[r] = colors['background']
+    server = ColorizerServer(socket_path, script_dir, engine, recon_backend)
+    print('  Serving on:', socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+        print('  Served {0} requests'.format(server.requests))
 
-  if 'menu' in options.hide_regions:
-    colors['menu-background']  = colors['background']
-    colors['menu-text'] = colors['background']
+    return 0
 
-  if 'channels' in options.hide_regions:
-    colors['channels-background']  = colors['background']
-    colors['channels-text'] = colors['background']
 
+def run_client(socket_path, in_file, out_file, request, send_data=False):
+    '''Send a colorization request to a running server
 
+    The server reads the input file and writes the output file itself unless
+    send_data is set. In that case the image data is sent over the socket.
+    '''
+    header = dict(request)
+    payload = None
+    if send_data:
+        with open(in_file, 'rb') as fh:
+            payload = fh.read()
+        header['format'] = os.path.splitext(out_file)[1][1:].upper() or 'PNG'
+        if header['format'] == 'JPG':
+            header['format'] = 'JPEG'
+    else:
+        header['path'] = os.path.abspath(in_file)
+        header['out_path'] = os.path.abspath(out_file)
 
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        fh = sock.makefile('rwb')
+        send_message(fh, header, payload)
+        message = recv_message(fh)
+        fh.close()
+    except socket.error as e:
+        print('error: Unable to connect to server on {0}: {1}'.format(socket_path, e))
+        return 1
+    finally:
+        sock.close()
 
-def apply_colors(override_colors, colors):
-  '''Set colors specified on the command line'''
+    if message is None:
+        print('error: No response from server')
+        return 1
 
-  for r, c in override_colors.iteritems():
-    if r in colors:
-      colors[r] = c
+    response, data = message
+    if response.get('status') != 'ok':
+        print('error: {0}'.format(response.get('message')))
+        return 1
 
-import shutil
+    print('  Grid type:', response.get('grid_descr'))
+    if data is not None:
+        try:
+            with open(out_file, 'wb') as fh:
+                fh.write(data)
+        except IOError:
+            print('error: Unable to write to file {0}'.format(out_file))
+            return 1
 
-def new_style_template(fname, script_dir):
-  # Find the style template
-  template_file = os.path.join(script_dir, 'data', 'style_template.cfg')
-  if not os.path.exists(template_file):
-    print('error: Unable to find default style template file ({0}).'.format(template_file))
-    sys.exit(1)
+    print('  Saved colorized image:', out_file)
+    return 0
 
-  print('Copying style template to:', fname)
-  shutil.copyfile(template_file, fname)
+
+def compile_grid_bundle(script_dir):
+  '''Precompile the grid images named in the default settings'''
+  defaults_file = os.path.join(script_dir, 'data', 'default_settings.cfg')
+  settings = ColorizerSettings(defaults_file=defaults_file, script_dir=script_dir)
+  bundle = grid_mask_bundle(os.path.join(script_dir, 'data'))
+
+  print('Compiling grid masks to:', bundle.bundle_file)
+  try:
+    bundle.compile(g[GRID_IMAGE] for g in settings.grids.values())
+  except (IOError, OSError) as e:
+    print('error: Unable to compile grid masks: {0}'.format(e))
+    sys.exit(1)
 
 
 def main():
     '''Entry point for colorizer script'''
-    print('LeCroy 93xx colorizer {0}\n'.format(__version__))
     script_dir = os.path.dirname(os.path.realpath(__file__))
     
-    # Look up color styles
-    color_styles = {}
-    style_dir = os.path.join(script_dir, 'styles')
-    if os.path.exists(style_dir):
-        color_styles = dict([(os.path.splitext(v)[0], v) for v in os.listdir(style_dir)])
-    
     # Process arguments
     usage = '''%prog [-i] input [-o output] [-s settings] [-r] [--hide=HIDE_REGIONS]
                           [--color=<name>:<color>[,...]]
+       %prog [-i] input [-o output] --styles=<style>[,...] [--color=... ...]
+
+       %prog [-d out_dir] [-j jobs] input_dir|glob [...]
+
+       %prog --watch=<dir> [-d out_dir] [-j jobs] [--queue-depth=N] [--stats=<file>]
+
+       %prog --persistence=<output> [-j jobs] [--ramp=<color>,...] input_dir|glob [...]
+
+       %prog --stream [--raw] [-s settings] [-r] < frames > images
+
+       %prog --serve=<socket>
+       %prog --connect=<socket> [-i] input [-o output] [-s settings] [-r] ...
 
        %prog --new-style=<file name>
+       %prog --list-styles
 
   Any image format suported by the Python Imaging Library is supported
   for input and output.
@@ -452,22 +3959,97 @@ def main():
   
   The settings can be a text file in ini format or one of the following
   style names:
-    {0}'''.format(', '.join(sorted(color_styles.keys())))
+    {styles}'''
 
-    parser = OptionParser(usage=usage)
+    parser = _ColorizerOptionParser(script_dir, usage=usage, version='%prog ' + __version__)
     parser.add_option('-i', dest='in_file', help='input image')
     parser.add_option('-o', dest='out_file', help='output image')
     parser.add_option('-s', '--settings', dest='setting_file', help='settings to control colors and configuration')
     parser.add_option('-r', '--no-reconstruction', action='store_true', default=False, dest='no_reconstruct', \
         help='disable trace reconstruction over grid')
+    parser.add_option('--engine', dest='engine', type='choice', choices=ENGINES, default='composite',
+      help='rendering engine: {0} [composite]'.format(', '.join(ENGINES)))
+    parser.add_option('--recon-backend', dest='recon_backend', type='choice', choices=RECON_BACKENDS,
+      default='auto', help='trace reconstruction backend: {0} [auto]'.format(', '.join(RECON_BACKENDS)))
     parser.add_option('--hide', dest='hide_regions', help='comma separated list of regions to hide')
-    parser.add_option('--color', dest='override_colors', help='comma separated list of <name>:<color> pairs')
+    parser.add_option('--color', dest='override_colors', action='append',
+      help='comma separated list of <name>:<color> pairs (repeat to render each set)')
+    parser.add_option('--styles', dest='styles',
+      help='comma separated list of styles to render from a single analysis of each capture')
+    parser.add_option('--indexed', dest='indexed', action='store_true', default=False,
+      help='save paletted images with the exact style colors')
+    parser.add_option('--compress-level', dest='compress_level', type='int',
+      help='PNG compression level from 0 to 9 [6]')
+    parser.add_option('--compress-strategy', dest='compress_strategy', type='choice',
+      choices=sorted(PNG_STRATEGIES.keys()),
+      help='PNG zlib strategy: {0} [default]'.format(', '.join(sorted(PNG_STRATEGIES.keys()))))
+    parser.add_option('--crop', dest='crop',
+      help='render only a box <left>,<upper>,<right>,<lower> or "grid" for the grid area')
+    parser.add_option('--thumbnail', dest='thumbnail', metavar='SIZE',
+      help='render a thumbnail that fits in <width>x<height> or <size>')
     parser.add_option('--new-style', dest='new_style', help='create a new style file from the default template')
+    parser.add_option('--list-styles', dest='list_styles', action='store_true', default=False,
+      help='list the named styles')
+    parser.add_option('--compile-grids', dest='compile_grids', action='store_true', default=False,
+      help='precompile the grid images into a packed mask bundle')
+    parser.add_option('-d', '--out-dir', dest='out_dir', help='output directory for batch mode')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int',
+      help='number of worker processes for batch mode [number of CPUs]')
+    parser.add_option('--pattern', dest='pattern', default='*.bmp',
+      help='file pattern for input directories in batch mode [*.bmp]')
+    parser.add_option('--watch', dest='watch', metavar='DIR',
+      help='colorize new files as they appear in a directory')
+    parser.add_option('--queue-depth', dest='queue_depth', type='int', default=16,
+      help='maximum number of files queued for the workers in watch mode [16]')
+    parser.add_option('--settle', dest='settle', type='float', default=1.0,
+      help='seconds a new file must be unchanged before it is colorized in watch mode [1.0]')
+    parser.add_option('--poll', dest='poll', type='float', default=0.25,
+      help='polling interval in seconds for watch mode [0.25]')
+    parser.add_option('--stats', dest='stats_file', metavar='FILE',
+      help='write queue latency statistics to a JSON file in watch mode')
+    parser.add_option('--stats-interval', dest='stats_interval', type='float', default=10.0,
+      help='seconds between updates of the statistics file [10]')
+    parser.add_option('--persistence', dest='persistence', metavar='FILE',
+      help='accumulate the traces of all inputs into a persistence image')
+    parser.add_option('--ramp', dest='ramp', default=','.join(PERSISTENCE_RAMP),
+      help='comma separated colors for the persistence image [{0}]'.format(','.join(PERSISTENCE_RAMP)))
+    parser.add_option('--scale', dest='scale', type='choice', choices=PERSISTENCE_SCALES, default='log',
+      help='scaling of the persistence counts: {0} [log]'.format(', '.join(PERSISTENCE_SCALES)))
+    parser.add_option('--stream', dest='stream', action='store_true', default=False,
+      help='colorize a stream of frames from stdin to stdout')
+    parser.add_option('--raw', dest='raw', action='store_true', default=False,
+      help='stream frames are raw 1-bit images instead of BMP')
+    parser.add_option('--format', dest='out_format', default='PNG',
+      help='image format for streamed output [PNG]')
+    parser.add_option('--serve', dest='serve', metavar='SOCKET',
+      help='run a colorizer server on a Unix domain socket')
+    parser.add_option('--connect', dest='connect', metavar='SOCKET',
+      help='send the request to a colorizer server')
+    parser.add_option('--send-data', dest='send_data', action='store_true', default=False,
+      help='send the image data to the server instead of the file name')
+    parser.add_option('--profile', dest='profile', metavar='FILE',
+      help='write stage times and counters as JSON to a file or - for stdout')
+    parser.add_option('--cprofile', dest='cprofile', metavar='FILE',
+      help='save cProfile statistics for a single file run')
+    parser.add_option('--no-settings-cache', dest='settings_cache', action='store_false', default=True,
+      help='always parse the settings files instead of using the compiled settings cache')
+    parser.add_option('--cache', dest='cache', action='store_true', default=False,
+      help='reuse colorized images from the result cache')
+    parser.add_option('--cache-dir', dest='cache_dir', metavar='DIR',
+      help='directory for the result cache (implies --cache)')
+    parser.add_option('--cache-size', dest='cache_size', type='int', default=500, metavar='MB',
+      help='size limit for the result cache in MB [500]')
     parser.add_option('-v', '--verbose', dest='verbose', action='store_true', default=False,
       help='verbose output')
 
     options, args = parser.parse_args()
 
+    # Keep stdout clean for the image data when streaming
+    out_stream = getattr(sys.stdout, 'buffer', sys.stdout)
+    if options.stream:
+        sys.stdout = sys.stderr
+
+    print('LeCroy 93xx colorizer {0}\n'.format(__version__))
 
     
     # Validate options
@@ -476,65 +4058,142 @@ def main():
       new_style_template(options.new_style, script_dir)
       sys.exit(0)
 
-    if not options.in_file:
-      if len(args) > 0:
-        options.in_file = args[0]
+    # Look up color styles
+    style_dir, color_styles = find_styles(script_dir)
+
+    if options.list_styles:
+      for name in sorted(color_styles.keys()):
+        print('  {0}'.format(name))
+      sys.exit(0)
+
+    if options.jobs is None:
+      options.jobs = multiprocessing.cpu_count()
+
+    if options.compile_grids:
+      compile_grid_bundle(script_dir)
+      sys.exit(0)
+
+    if options.serve is not None:
+      sys.exit(run_server(options.serve, script_dir, options.engine, options.recon_backend))
+
+    inputs = args
+    if options.in_file:
+        inputs = [options.in_file] + args
 
-    if options.in_file is None:
+    if options.watch is not None:
+        if not os.path.isdir(options.watch):
+            print('error: Watch directory ({0}) does not exist.\n'.format(options.watch))
+            sys.exit(1)
+    elif options.stream:
+        pass
+    elif len(inputs) == 0:
         print('error: Missing input file\n')
         parser.print_help()
         sys.exit(1)
 
-    if not os.path.exists(options.in_file):
-        print('error: Input file ({0}) does not exist.\n'.format(options.in_file))
-        parser.print_help()
-        sys.exit(1)
+    # Render every style for each set of override colors
+    style_names = [options.setting_file]
+    if options.styles is not None:
+      if options.setting_file is not None:
+        parser.error('Use either -s or --styles')
+      style_names = [st.strip() for st in options.styles.split(',') if st.strip()]
+    color_sets = options.override_colors or [None]
+
+    if len(style_names) * len(color_sets) > 1 and (options.connect is not None or options.stream):
+      parser.error('Multiple styles are not supported with --connect or --stream')
 
-    if options.out_file is None:
-        # Make the output file from the input name
-        path, in_file = os.path.split(options.in_file)
-        # We will prefer png output to minimize file size since PIL doesn't support RLE
-        # for bitmaps.
-        out_file = os.path.splitext('color_' + in_file)[0] + '.png'
-        options.out_file = os.path.join(path, out_file)
+    if (options.crop is not None or options.thumbnail is not None) and \
+        (options.connect is not None or options.persistence is not None):
+      parser.error('--crop and --thumbnail are not supported with --connect or --persistence')
 
+    if options.connect is not None:
+      # Let the server validate the style and colors
+      in_file = inputs[0]
+      out_file = options.out_file if options.out_file is not None else output_file_name(in_file)
+      request = {'style': options.setting_file, 'hide': options.hide_regions, \
+        'color': color_sets[0], 'no_reconstruct': options.no_reconstruct}
+      if options.setting_file is not None and os.path.exists(options.setting_file):
+        request['style'] = os.path.abspath(options.setting_file)
 
-    if options.setting_file is not None:
-        print('  Style: {0}'.format(options.setting_file))
-        # Check if the argument is a named style
-        if options.setting_file in color_styles:
-            options.setting_file = os.path.join(style_dir, color_styles[options.setting_file])
+      print('  Reading image:', in_file)
+      sys.exit(run_client(options.connect, in_file, out_file, request, options.send_data))
 
-        if not os.path.exists(options.setting_file):
-            print('error: Settings file ({0}) does not exist.\n'.format(options.setting_file))
+    # Multiple inputs, directories, and glob patterns are colorized in batch mode
+    batch_mode = options.watch is None and not options.stream and (options.persistence is not None or \
+        options.out_dir is not None or len(inputs) > 1 or os.path.isdir(inputs[0]) or glob.has_magic(inputs[0]))
+
+    if batch_mode:
+        in_files = expand_inputs(inputs, options.pattern)
+        if len(in_files) == 0:
+            print('error: No input files found.\n')
+            sys.exit(1)
+        for f in in_files:
+            if not os.path.exists(f):
+                print('error: Input file ({0}) does not exist.\n'.format(f))
+                sys.exit(1)
+    elif options.watch is None and not options.stream:
+        options.in_file = inputs[0]
+
+        if not os.path.exists(options.in_file):
+            print('error: Input file ({0}) does not exist.\n'.format(options.in_file))
             parser.print_help()
             sys.exit(1)
 
+        if options.out_file is None:
+            # Make the output file from the input name
+            options.out_file = output_file_name(options.in_file)
+
 
+    setting_files = []
+    for setting_file in style_names:
+        if setting_file is not None:
+            print('  Style: {0}'.format(setting_file))
+            # Check if the argument is a named style
+            setting_file = resolve_style(setting_file, style_dir, color_styles)
+
+            if not os.path.exists(setting_file):
+                print('error: Settings file ({0}) does not exist.\n'.format(setting_file))
+                parser.print_help()
+                sys.exit(1)
+        setting_files.append(setting_file)
+
+
+    try:
+      options.save_options = png_save_options(options.compress_level, options.compress_strategy)
+    except ValueError as e:
+      parser.error(e.message)
+
+    options.render_options = {}
+    try:
+      if options.crop is not None:
+        options.render_options['crop'] = parse_crop(options.crop)
+    except ValueError:
+      parser.error('Invalid argument to --crop: {0}'.format(options.crop))
     try:
-      if options.hide_regions is not None:
-        options.hide_regions = set(r.strip().lower() for r in options.hide_regions.split(','))
+      if options.thumbnail is not None:
+        options.render_options['thumbnail'] = parse_thumbnail(options.thumbnail)
+    except ValueError:
+      parser.error('Invalid argument to --thumbnail: {0}'.format(options.thumbnail))
+
+    try:
+      options.hide_regions = parse_hide_regions(options.hide_regions)
+      if options.hide_regions:
         print('  Hide regions:', ', '.join(list(options.hide_regions)))
-      else:
-        options.hide_regions = set()
     except:
       parser.error('Invalid argument to --hide: {0}'.format(options.hide_regions))
       sys.exit(1)
 
-    try:
-      if options.override_colors is not None:
-        # Preserve commas within rgb() and hsl() colors
-        oc = re.sub(r'(,)(?=(?:[^()]|\([^)]*\))*$)', ';', options.override_colors)
-
-        pairs = [c.split(':') for c in oc.split(';')]
-        options.override_colors = dict((p[0].strip().lower(), p[1].strip()) for p in pairs)
-        print('  Overriding colors:', ', '.join(['{0}:{1}'.format(k, v)
-          for k, v in options.override_colors.iteritems()]))
-      else:
-        options.override_colors = {}
-    except:
-      parser.error('Invalid argument to --color: {0}'.format(options.override_colors))
-      sys.exit(1)
+    override_sets = []
+    for override_colors in color_sets:
+      try:
+        override_colors = parse_override_colors(override_colors)
+        if override_colors:
+          print('  Overriding colors:', ', '.join(['{0}:{1}'.format(k, v)
+            for k, v in override_colors.iteritems()]))
+      except:
+        parser.error('Invalid argument to --color: {0}'.format(override_colors))
+        sys.exit(1)
+      override_sets.append(override_colors)
 
 
     # Find the default settings
@@ -543,28 +4202,30 @@ def main():
         print('error: Unable to find default settings file ({0}).'.format(defaults_file))
         sys.exit(1)
     
-    # Get the settings
+    # Get the settings and apply hidden regions and override colors from the command line.
+    # Each combination of style and override colors is labeled for its output file name.
+    variants = []
     try:
-        settings = ColorizerSettings(setting_file=options.setting_file, defaults_file=defaults_file, \
-            script_dir=script_dir)
-    except ConfigParser.InterpolationMissingOptionError as e:
-        print('error: Unable to parse settings file {0}\n'.format(e.file_name) + e.message)
-        sys.exit(1)
-    except ConfigParser.ParsingError as e:
-        print('error: Unable to parse settings file {0}\n'.format(e.file_name) + e.message)
-        sys.exit(1)
-    except ValueError as e:
-        print('error: ' + e.message)
-        sys.exit(1)
-    except SyntaxError as e:
-        print('error: ' + e.msg + ' in file ' + e.file_name)
-        print('    ' + e.text)
-        print('    ' + ' ' * (e.offset-1) + '^')
+        for style_name, setting_file in zip(style_names, setting_files):
+            for i, override_colors in enumerate(override_sets):
+                label = []
+                if len(setting_files) > 1:
+                    label.append(os.path.splitext(os.path.basename(style_name))[0])
+                if len(override_sets) > 1:
+                    label.append('color{0}'.format(i + 1))
+                settings = load_settings(setting_file, script_dir, options.hide_regions, override_colors, \
+                    options.settings_cache)
+                variants.append(('_'.join(label), settings))
+    except SETTINGS_ERRORS as e:
+        print(settings_error_message(e))
         sys.exit(1)
+    settings = variants[0][1]
 
+    profile = ColorizerProfile() if options.profile is not None else None
 
-    # Apply hidden regions and override colors from the command line
-    adjust_colors(options, settings.colors)
+    options.result_cache = None
+    if options.cache or options.cache_dir is not None:
+      options.result_cache = ResultCache(options.cache_dir, options.cache_size * 1024 * 1024)
 
     if options.verbose:
       print('  Colors:')
@@ -575,26 +4236,85 @@ def main():
           cval = settings.colors[c]
         print('    {0}: {1}'.format(c, cval))
 
+    if options.watch is not None:
+        sys.exit(run_watch(options.watch, options.out_dir, variants, options))
+
+    if options.stream:
+        colorizer = LecroyColorizer(settings, options.engine, options.recon_backend, options.indexed, profile)
+        in_stream = getattr(sys.stdin, 'buffer', sys.stdin)
+        failures = run_stream(colorizer, in_stream, out_stream, options.no_reconstruct, options.raw, \
+            options.out_format, options.save_options, options.render_options)
+        if profile is not None:
+            write_profile(profile, options.profile)
+        sys.exit(1 if failures > 0 else 0)
+
+    if options.persistence is not None:
+        try:
+            ramp = [ImageColor.getcolor(c.strip(), 'RGB') for c in split_color_list(options.ramp)]
+        except ValueError:
+            parser.error('Invalid argument to --ramp: {0}'.format(options.ramp))
+        failures = run_persistence(in_files, options.persistence, settings, options.no_reconstruct, options.jobs, \
+            options.engine, options.recon_backend, ramp, options.scale, options.save_options)
+        sys.exit(1 if failures > 0 else 0)
+
+    if batch_mode:
+        failures = run_batch(in_files, options.out_dir, variants, options.no_reconstruct, options.jobs, \
+            options.engine, options.recon_backend, options.indexed, options.save_options, profile, \
+            options.result_cache, options.render_options)
+        if profile is not None:
+            write_profile(profile, options.profile)
+        sys.exit(1 if failures > 0 else 0)
+
     # Colorize the image
-    colorizer = LecroyColorizer(settings)
+    colorizers = [LecroyColorizer(s, options.engine, options.recon_backend, options.indexed, profile) \
+      for _, s in variants]
 
     print('  Reading image:', options.in_file)
+    if options.cprofile is not None:
+      import cProfile
+      profiler = cProfile.Profile()
+      profiler.enable()
+    out_files = [styled_file_name(options.out_file, label) for label, _ in variants]
     try:
-        color_im = colorizer.colorize(options.in_file, options.no_reconstruct)
+        results = colorize_to_files(colorizers, options.in_file, out_files, options.no_reconstruct, \
+            options.save_options, options.result_cache, options.render_options)
     except ValueError as e:
         print('error: {0}'.format(e.message))
         sys.exit(1)
+    except IOError as e:
+        fname = e.filename if e.filename is not None else ', '.join(out_files)
+        print('error: Unable to write to file {0}: {1}'.format(fname, e.strerror or e))
+        sys.exit(1)
+    finally:
+        if options.result_cache is not None:
+            options.result_cache.close()
+        if options.cprofile is not None:
+          profiler.disable()
+          profiler.dump_stats(options.cprofile)
+          print('  cProfile statistics written to:', options.cprofile)
 
-    grid_name = colorizer.identify_grid(options.in_file)
-    print('  Grid type:', settings.grids[grid_name][GRID_DESCR])
+    colorized = [r for r in results if r is not None]
+    if colorized:
+      result = colorized[0]
+      print('  Grid type:', settings.grids[result.grid_name][GRID_DESCR])
+      if options.verbose:
+        print('  Channel boxes: {0}, menu boxes: {1}'.format(len(result.channel_boxes), len(result.menu_boxes)))
+    if options.verbose:
+      for (label, _), result in zip(variants, results):
+        if result is None:
+          continue
+        print('  Timings{0}:'.format(' ({0})'.format(label) if label else ''), \
+          ', '.join('{0} {1:.1f}ms'.format(k, v * 1000.0) for k, v in \
+          sorted(result.timings.items(), key=lambda t: -t[1])))
 
-    print('  Saving colorized image:', options.out_file)
-    
-    try:
-        color_im.save(options.out_file)
-    except IOError:
-        print('error: Unable to write to file {0}'.format(options.out_file))
-        sys.exit(1)
+    for out_file, result in zip(out_files, results):
+      if result is None:
+        print('  Copied cached image:', out_file)
+      else:
+        print('  Saving colorized image:', out_file)
+
+    if profile is not None:
+      write_profile(profile, options.profile)
         
     sys.exit(0)
 
@@ -28,6 +28,7 @@ setup(name='lecroy-colorizer',
     description='A utility to colorize black and white screen captures from LeCroy 93xx series oscilloscopes',
     long_description=long_description,
     install_requires = ['pillow >= 2.8.0'],
+    extras_require = {'numpy': ['numpy']},
     packages = ['data', 'styles'],
     py_modules = ['colorize_lecroy'],
     entry_points = {